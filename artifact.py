@@ -0,0 +1,264 @@
+import argparse
+import json
+import os
+import struct
+import time
+
+import numpy as np
+
+import manifest
+
+# one file per trained model for serving: a json header (what to build, label map,
+# vocabulary, preprocessing) followed by every weight of the model, frozen backbone included,
+# each at an aligned offset. loading maps the file and assigns all weights in one batch, so a
+# prediction process needs neither the imagenet weights nor the experiment directory.
+# models are rebuilt in code like everywhere else, so the header names the builder and its
+# arguments instead of carrying a serialized graph
+magic = b'RNETART\x00'
+format_version = 1
+alignment = 64
+# preprocessing modes: raw 0-255 rgb pixels (classifiers), or keras' vgg16 preprocess_input
+# (bgr, mean subtracted) like titling_data.load_image
+vgg16_bgr_mean = [103.939, 116.779, 123.68]
+kinds = ['classifier', 'student', 'main', 'titling']
+# kinds whose model maps an image to subreddit probabilities
+classifier_kinds = ['classifier', 'student', 'main']
+
+def aligned(offset):
+    return (offset + alignment - 1) // alignment * alignment
+
+def write(path, header, tensors):
+    # tensors: (name, array) in the order the loader assigns them
+    entries = []
+    offset = 0
+    for name, array in tensors:
+        offset = aligned(offset)
+        entries.append({'name': name, 'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset})
+        offset += array.nbytes
+    header = dict(header, format_version=format_version, tensors=entries)
+    header_bytes = json.dumps(header).encode('utf-8')
+    data_start = aligned(len(magic) + 8 + len(header_bytes))
+    # write next to the target and rename, so a server never maps half an artifact
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(magic)
+        f.write(struct.pack('<Q', len(header_bytes)))
+        f.write(header_bytes)
+        for (_, array), entry in zip(tensors, entries):
+            f.write(b'\0' * (data_start + entry['offset'] - f.tell()))
+            np.ascontiguousarray(array).tofile(f)
+    os.rename(tmp_path, path)
+
+def read_header(path):
+    with open(path, 'rb') as f:
+        if f.read(len(magic)) != magic:
+            raise ValueError('{} is not a model artifact (see artifact.py)'.format(path))
+        header_length = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(header_length).decode('utf-8'))
+    if header['format_version'] != format_version:
+        raise ValueError('{} is artifact format {}, this code reads format {}; export it again'.format(
+            path, header['format_version'], format_version))
+    return header, aligned(len(magic) + 8 + header_length)
+
+def read(path):
+    # (header, {name: read-only array}), the arrays being views of one memory map
+    header, data_start = read_header(path)
+    data = np.memmap(path, dtype=np.uint8, mode='r')
+    tensors = {}
+    for entry in header['tensors']:
+        dtype = np.dtype(entry['dtype'])
+        count = int(np.prod(entry['shape']))
+        tensors[entry['name']] = np.frombuffer(data, dtype=dtype, count=count,
+            offset=data_start + entry['offset']).reshape(entry['shape'])
+    return header, tensors
+
+def named(group, arrays):
+    return [('{}/{}'.format(group, i), array) for i, array in enumerate(arrays)]
+
+def bind(weights, tensors, group):
+    # (variable, array) pairs for K.batch_set_value, checked against the rebuilt model
+    from keras import backend as K
+    names = ['{}/{}'.format(group, i) for i in range(len(weights))]
+    stored = len([name for name in tensors if name.startswith(group + '/')])
+    if stored != len(weights):
+        raise ValueError('artifact has {} {} weights, the rebuilt model {}'.format(stored, group, len(weights)))
+    for name, weight in zip(names, weights):
+        if K.int_shape(weight) != tensors[name].shape:
+            raise ValueError('artifact weight {} has shape {}, the model expects {} for {}'.format(
+                name, tensors[name].shape, K.int_shape(weight), weight.name))
+    return [(weight, tensors[name]) for name, weight in zip(names, weights)]
+
+def labels_for(json_path):
+    # subreddit names by index
+    indices = manifest.get_subreddit_indices_map(json_path)
+    labels = [None] * len(indices)
+    for name, index in indices.items():
+        labels[index] = name
+    return labels
+
+#*********************************** EXPORT ************************************
+def model_weights(model):
+    from keras import backend as K
+    return K.batch_get_value(model.weights)
+
+def classifier_path(config):
+    import classifier
+    return classifier.experiments_path + config.experiment
+
+def export_classifier(config):
+    import classifier
+    path = classifier_path(config)
+    size = config.size or classifier.get_image_size(config.train_json)[0]
+    model = classifier.create_model(size, weights=None)
+    model.load_weights(path + classifier.best_weights)
+    header = {'config': {'size': size}, 'preprocessing': {'mode': 'raw', 'size': [size, size]}}
+    return header, named('model', model_weights(model))
+
+def export_student(config):
+    import distill
+    path = classifier_path(config)
+    model, size = distill.load_student(path)
+    with open(path + distill.student_config) as f:
+        width = json.load(f)['width']
+    header = {'config': {'size': size[0], 'width': width}, 'preprocessing': {'mode': 'raw', 'size': list(size)}}
+    return header, named('model', model_weights(model))
+
+def export_main(config):
+    import main
+    model = main.create_model(weights=None)
+    model.load_weights('experiments/{}/best-checkpoint.hdf5'.format(config.experiment))
+    # any image size, like main.predict
+    header = {'config': {}, 'preprocessing': {'mode': 'raw', 'size': None}}
+    return header, named('model', model_weights(model))
+
+def export_titling(config):
+    from keras import backend as K
+    from keras.optimizers import Adam
+    from titling_model import ImageTitlingModel
+    import vocab
+    experiment_dir = 'experiments/titling/{}/'.format(config.experiment)
+    max_len = config.max_len
+    if max_len is None and os.path.exists(experiment_dir + 'config.json'):
+        with open(experiment_dir + 'config.json') as f:
+            max_len = json.load(f).get('max_len')
+    max_len = max_len or 30
+    words_by_id, ids_by_word = vocab.load_for_experiment(experiment_dir, config.train_json)
+    checkpoint_path = experiment_dir + config.checkpoint
+    # npz checkpoints leave the frozen encoder out, so only they need the imagenet weights
+    npz = checkpoint_path.endswith('.npz')
+    model = ImageTitlingModel(words_by_id, ids_by_word, num_subreddits=config.num_subreddits, max_len=max_len,
+        encoder_weights='imagenet' if npz else None, prefix_cache_mb=0)
+    if npz:
+        model.train_model.compile(optimizer=Adam(), loss='categorical_crossentropy')
+        model.restore_checkpoint(checkpoint_path)
+    else:
+        model.load_weights(checkpoint_path)
+    encoder = K.batch_get_value(model.inference_encoder_model.weights)
+    decoder = K.batch_get_value(model.inference_decoder_model.weights)
+    header = {
+        'config': {'num_subreddits': config.num_subreddits, 'max_len': max_len},
+        'vocab': [words_by_id[i] for i in range(len(words_by_id))],
+        'preprocessing': {'mode': 'vgg16', 'size': None},
+    }
+    return header, named('encoder', encoder) + named('decoder', decoder) + [('embedding_matrix', model.embedding_matrix)]
+
+exporters = {'classifier': export_classifier, 'student': export_student, 'main': export_main, 'titling': export_titling}
+
+def export(config):
+    header, tensors = exporters[config.kind](config)
+    header.update(kind=config.kind, experiment=config.experiment, labels=labels_for(config.train_json), exported_at=time.time())
+    write(config.output, header, tensors)
+    print('wrote {} {} tensors ({:.1f} MB) to {}'.format(len(tensors), config.kind,
+        sum(array.nbytes for _, array in tensors) / (1024. * 1024.), config.output))
+
+#************************************ LOAD *************************************
+class Artifact(object):
+    # a loaded artifact: .model predicts like the experiment's model (an ImageTitlingModel
+    # for titling), .labels are the subreddit names by index
+    def __init__(self, path, header, model):
+        self.path = path
+        self.header = header
+        self.kind = header['kind']
+        self.model = model
+        self.labels = header['labels']
+
+    def load_image(self, path):
+        from PIL import Image, ImageOps
+        preprocessing = self.header['preprocessing']
+        img = Image.open(path).convert('RGB')
+        size = tuple(preprocessing['size']) if preprocessing['size'] else None
+        if size and img.size != size:
+            img = ImageOps.fit(img, size, Image.ANTIALIAS)
+        if preprocessing['mode'] == 'vgg16':
+            return np.array(img, dtype=np.float64)[..., ::-1] - vgg16_bgr_mean
+        return np.array(img)
+
+def build(header, tensors, prefix_cache_mb=None):
+    # (model to return, [(variable, array)]) for the artifact's kind, built without weights
+    kind = header['kind']
+    config = header['config']
+    if kind == 'classifier':
+        import classifier
+        model = classifier.create_model(config['size'], weights=None)
+        return model, bind(model.weights, tensors, 'model')
+    if kind == 'student':
+        import distill
+        _, model = distill.create_student(config['size'], config['width'])
+        return model, bind(model.weights, tensors, 'model')
+    if kind == 'main':
+        import main
+        model = main.create_model(weights=None)
+        return model, bind(model.weights, tensors, 'model')
+    from titling_model import ImageTitlingModel
+    import prefix_cache
+    words_by_id = dict(enumerate(header['vocab']))
+    ids_by_word = {word: i for i, word in words_by_id.items()}
+    model = ImageTitlingModel(words_by_id, ids_by_word, num_subreddits=config['num_subreddits'], max_len=config['max_len'],
+        encoder_weights=None, prefix_cache_mb=prefix_cache.max_mb_default if prefix_cache_mb is None else prefix_cache_mb)
+    # the inference models only; the train model's own decoder layers stay untrained
+    model.embedding_matrix = tensors['embedding_matrix']
+    return model, bind(model.inference_encoder_model.weights, tensors, 'encoder') + bind(model.inference_decoder_model.weights, tensors, 'decoder')
+
+def load(path, prefix_cache_mb=None, kinds=kinds):
+    start = time.time()
+    header, tensors = read(path)
+    if header['kind'] not in kinds:
+        raise ValueError('{} is a {} artifact, expected one of {}'.format(path, header['kind'], ', '.join(kinds)))
+    model, assignments = build(header, tensors, prefix_cache_mb)
+    built = time.time()
+    from keras import backend as K
+    K.batch_set_value(assignments)
+    print('loaded {} artifact {} in {:.2f}s ({:.2f}s building, {:.2f}s assigning weights)'.format(
+        header['kind'], path, time.time() - start, built - start, time.time() - built))
+    return Artifact(path, header, model)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='export a trained model to one self-contained, memory mappable file, or inspect one')
+    parser.add_argument('--kind', type=str, choices=kinds, help='model to export')
+    parser.add_argument('--experiment', type=str, help='experiment to export (classifier.py -p, main.py/main_titling.py --experiment)')
+    parser.add_argument('--output', type=str, help='artifact to write (default: <kind>-<experiment>.rnet)')
+    parser.add_argument('--train_json', type=str, default=manifest.train_path_default, help='split the label map (and legacy vocabulary) come from')
+    parser.add_argument('--size', type=int, help='classifier input resolution (default: that of the training images)')
+    parser.add_argument('--checkpoint', type=str, default='best-checkpoint.hdf5', help='titling checkpoint in the experiment directory')
+    parser.add_argument('--max_len', type=int, help="titling max title length (default: the experiment's config.json)")
+    parser.add_argument('--num_subreddits', type=int, default=20, help='titling subreddits')
+    parser.add_argument('--show', type=str, help='print the header of an artifact')
+    parser.add_argument('--check', type=str, help='load an artifact and report the time it takes')
+    config = parser.parse_args()
+
+    if config.show:
+        header, _ = read_header(config.show)
+        header['tensors'] = '{} tensors'.format(len(header['tensors']))
+        if 'vocab' in header:
+            header['vocab'] = '{} words'.format(len(header['vocab']))
+        print(json.dumps(header, indent=1))
+    elif config.check:
+        start = time.time()
+        from keras import backend as K
+        print('keras ({} backend) imported in {:.2f}s'.format(K.backend(), time.time() - start))
+        load(config.check)
+    elif config.kind and config.experiment:
+        config.output = config.output or '{}-{}.rnet'.format(config.kind, config.experiment)
+        export(config)
+    else:
+        parser.print_help()
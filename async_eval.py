@@ -0,0 +1,246 @@
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+import create_small
+import manifest
+
+# validation off the training loop: at the end of every epoch the trainer only writes the
+# trainable weights (async_validation.py) and goes on, while this evaluator, started next to
+# it on a few spare cores, scores them on the validation split or a stratified subsample of
+# it. the evaluator keeps the best weights where the trainer's best checkpoint used to go,
+# and the trainer stops early from its results, an epoch or so behind
+eval_dir = 'async_eval/'
+spec_file = 'spec.json'
+results_file = 'results.jsonl'
+done_file = 'done'
+snapshot_file = 'epoch-{:04d}.npz'
+poll_interval = 2.
+# 95% intervals
+interval_z = 1.96
+# the evaluator yields the cpu to the trainer when they compete
+niceness = 10
+
+def default_threads():
+    return max(1, multiprocessing.cpu_count() // 4)
+
+def add_arguments(parser):
+    parser.add_argument('--async_eval', action='store_true', help='validate every epoch in a separate evaluator process instead of in the training loop')
+    parser.add_argument('--eval_sample', type=int, help='stratified validation subsample scored with --async_eval (default: the whole split)')
+    parser.add_argument('--eval_threads', type=int, help='tensorflow threads of the evaluator (default: a quarter of the cores)')
+    parser.add_argument('--eval_patience', type=int, help='with --async_eval, stop after this many evaluated epochs without a better result')
+
+def spec(config, task, validation_path, best_path, monitor, mode, batch_size, resolution=None, **task_config):
+    # everything the evaluator needs to rebuild the model and score it like the trainer would
+    return {
+        'task': task,
+        'validation_path': validation_path,
+        'best_path': best_path,
+        'monitor': monitor,
+        'mode': mode,
+        'batch_size': batch_size,
+        'sample': getattr(config, 'eval_sample', None),
+        'seed': create_small.seed_default,
+        'threads': getattr(config, 'eval_threads', None) or default_threads(),
+        'resolution': resolution,
+        'task_config': task_config,
+    }
+
+def eval_path_for(output_dir):
+    return output_dir + eval_dir
+
+def snapshot_path(eval_path, epoch):
+    return eval_path + snapshot_file.format(epoch)
+
+def write_spec(eval_path, spec):
+    if not os.path.isdir(eval_path):
+        os.makedirs(eval_path)
+    with open(eval_path + spec_file, 'w') as f:
+        json.dump(spec, f, indent=1)
+
+def load_results(eval_path):
+    path = eval_path + results_file
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        # a line the evaluator is still writing has no newline yet
+        return [json.loads(line) for line in f if line.endswith('\n')]
+
+def append_result(eval_path, result):
+    with open(eval_path + results_file, 'a') as f:
+        f.write(json.dumps(result) + '\n')
+
+def start(eval_path, threads):
+    # on the cpu, so a gpu trainer keeps its device memory
+    env = dict(os.environ)
+    env['OMP_NUM_THREADS'] = str(threads)
+    env['CUDA_VISIBLE_DEVICES'] = ''
+    return subprocess.Popen([sys.executable, os.path.abspath(__file__), eval_path], env=env)
+
+def finish(eval_path):
+    # tells the evaluator that no more snapshots will come
+    open(eval_path + done_file, 'w').close()
+
+def improved(value, best, mode):
+    return best is None or (value > best if mode == 'max' else value < best)
+
+#********************************** SCORING ************************************
+def wilson(successes, n, z=interval_z):
+    # interval of a binomial proportion that stays inside [0, 1] and is sane for small n
+    if n == 0:
+        return 0., 1.
+    p = successes / float(n)
+    denominator = 1 + z * z / n
+    center = (p + z * z / (2 * n)) / denominator
+    half = z * np.sqrt(p * (1 - p) / n + z * z / (4. * n * n)) / denominator
+    return max(0., float(center - half)), min(1., float(center + half))
+
+def summarize(losses, hits, z=interval_z):
+    # losses per post (keras' val_loss is their mean); hits per prediction (posts, or tokens
+    # of the titles, whose interval is then somewhat optimistic since a title's tokens are
+    # not independent)
+    loss = float(np.mean(losses))
+    half = z * float(np.std(losses)) / np.sqrt(len(losses))
+    acc_low, acc_high = wilson(int(np.sum(hits)), len(hits), z)
+    return {
+        'val_loss': loss,
+        'val_loss_low': loss - half,
+        'val_loss_high': loss + half,
+        'val_acc': float(np.mean(hits)),
+        'val_acc_low': acc_low,
+        'val_acc_high': acc_high,
+        'posts': len(losses),
+        'predictions': len(hits),
+    }
+
+def classification_scorer(model, columns, batch_size):
+    from PIL import Image
+    # loaded once, every epoch is scored on the same arrays
+    X = np.array([np.array(Image.open(path)) for path in columns['path']])
+    labels = np.asarray(columns['subreddit'])
+
+    def score():
+        probs = model.predict(X, batch_size=batch_size)
+        losses = -np.log(np.maximum(probs[np.arange(len(labels)), labels], 1e-7))
+        return summarize(losses, np.argmax(probs, axis=1) == labels)
+    return score
+
+def classifier_task(spec, columns, indices):
+    import classifier
+    model = classifier.create_model(spec['task_config']['size'])
+    return model, classification_scorer(model, columns, spec['batch_size'])
+
+def main_task(spec, columns, indices):
+    import main
+    model = main.create_model()
+    return model, classification_scorer(model, columns, spec['batch_size'])
+
+def titling_task(spec, columns, indices):
+    from titling_model import ImageTitlingModel
+    from titling_data import ImageTitlingDataGenerator
+    import vocab
+    task_config = spec['task_config']
+    words_by_id, id_by_words = vocab.load_for_experiment(task_config['experiment_dir'], task_config['train_json'])
+    # a sampled softmax layer holds the same [kernel, bias] as the dense layer of the same
+    # name, so every run is scored with the exact full softmax, accuracy included
+    model = ImageTitlingModel(words_by_id, id_by_words, num_subreddits=task_config['num_subreddits'],
+        max_len=task_config['max_len'], prefix_cache_mb=0)
+    generator = ImageTitlingDataGenerator(spec['validation_path'], id_by_words, max_len=task_config['max_len'],
+        num_subreddits=task_config['num_subreddits'], batch_size=spec['batch_size'], indices=indices)
+
+    def score():
+        losses = []
+        hits = []
+        for i in range(len(generator)):
+            inputs, y = generator[i]
+            probs = model.train_model.predict_on_batch(inputs)
+            # padding targets are all zeros
+            mask = y.sum(axis=2) > 0
+            token_losses = -np.log(np.maximum((probs * y).sum(axis=2), 1e-7)) * mask
+            losses.extend(token_losses.sum(axis=1) / np.maximum(mask.sum(axis=1), 1))
+            hits.append((np.argmax(probs, axis=2) == np.argmax(y, axis=2))[mask])
+        return summarize(np.array(losses), np.concatenate(hits))
+    return model.train_model, score
+
+tasks = {'classifier': classifier_task, 'main': main_task, 'titling': titling_task}
+
+#********************************* EVALUATOR ***********************************
+def validation_posts(spec):
+    # (path and label columns of the posts to score, their positions in the split or None for all of it)
+    columns = manifest.load_columns(spec['validation_path'], ['path', 'subreddit'])
+    labels = columns['subreddit']
+    if not spec['sample'] or spec['sample'] >= len(labels):
+        return columns, None
+    subsets, _ = create_small.sample_labels(enumerate(labels.tolist()), sizes=[spec['sample']], seed=spec['seed'])
+    indices = subsets['size', spec['sample']]
+    print('scoring a stratified subsample of {} of {} validation posts'.format(len(indices), len(labels)))
+    return {'path': [columns['path'][i] for i in indices], 'subreddit': labels[indices]}, indices
+
+def pending(eval_path):
+    # (epoch, path) of the snapshots not scored yet, oldest first; the .tmp files being written don't match
+    paths = sorted(glob.glob(eval_path + snapshot_file.replace('{:04d}', '*')))
+    return [(int(os.path.basename(path)[len('epoch-'):-len('.npz')]), path) for path in paths]
+
+def save_best(model, path):
+    tmp_path = path + '.tmp'
+    model.save_weights(tmp_path)
+    os.rename(tmp_path, path)
+
+def evaluate_pending(model, score, spec, eval_path):
+    import checkpoint
+    results = load_results(eval_path)
+    scored = set(result['epoch'] for result in results)
+    best = None
+    for result in results:
+        if result.get('best'):
+            best = result[spec['monitor']]
+    for epoch, path in pending(eval_path):
+        if epoch not in scored:
+            start_time = time.time()
+            checkpoint.restore(model, path)
+            result = score()
+            result['epoch'] = epoch
+            result['best'] = improved(result[spec['monitor']], best, spec['mode'])
+            if result['best']:
+                best = result[spec['monitor']]
+                save_best(model, spec['best_path'])
+            result['seconds'] = time.time() - start_time
+            result['time'] = time.time()
+            append_result(eval_path, result)
+            print('epoch {}: val_loss {:.4f} [{:.4f}, {:.4f}], val_acc {:.4f} [{:.4f}, {:.4f}] in {:.1f}s{}'.format(
+                epoch + 1, result['val_loss'], result['val_loss_low'], result['val_loss_high'], result['val_acc'],
+                result['val_acc_low'], result['val_acc_high'], result['seconds'], ', best so far' if result['best'] else ''))
+        os.remove(path)
+
+def run(eval_path, once=False):
+    import pyramid
+    import session_config
+    with open(eval_path + spec_file) as f:
+        spec = json.load(f)
+    pyramid.select(spec['resolution'])
+    os.nice(niceness)
+    session_config.configure_session(spec['threads'], 1)
+    columns, indices = validation_posts(spec)
+    model, score = tasks[spec['task']](spec, columns, indices)
+    parent = os.getppid()
+    while True:
+        # checked before scanning, so the snapshots written before it are all scored
+        finished = once or os.path.exists(eval_path + done_file)
+        evaluate_pending(model, score, spec, eval_path)
+        if finished or os.getppid() != parent:
+            break
+        time.sleep(poll_interval)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="score an experiment's epoch snapshots as the trainer writes them (see --async_eval)")
+    parser.add_argument('eval_path', type=str, help='async_eval/ directory of the experiment')
+    parser.add_argument('--once', action='store_true', help='score the snapshots that are there and exit, e.g. after the evaluator died')
+    args = parser.parse_args()
+    run(os.path.join(args.eval_path, ''), args.once)
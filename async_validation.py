@@ -0,0 +1,92 @@
+import os
+import threading
+import time
+
+from keras.callbacks import Callback
+
+import async_eval
+import checkpoint
+
+class AsyncValidation(Callback):
+    # the trainer's side of async_eval.py: starts the evaluator, hands it the trainable
+    # weights of every epoch (written on a background thread, like AsyncCheckpoint) and
+    # reads back its results. the evaluator saves the best weights itself; this stops
+    # training once `patience` scored epochs came after the best one
+    def __init__(self, output_dir, spec, patience=None):
+        super(AsyncValidation, self).__init__()
+        self.eval_path = async_eval.eval_path_for(output_dir)
+        self.spec = spec
+        # with data-parallel workers, distributed.callbacks sends the chief's decision to the others
+        self.patience = patience
+        self.process = None
+        self.thread = None
+        self.results = {}
+        self.best_epoch = None
+        self.exit_reported = False
+
+    def on_train_begin(self, logs=None):
+        async_eval.write_spec(self.eval_path, self.spec)
+        if os.path.exists(self.eval_path + async_eval.done_file):
+            os.remove(self.eval_path + async_eval.done_file)
+        # epochs scored before a resume still count for the best and for patience
+        self.read_results(verbose=False)
+        self.process = async_eval.start(self.eval_path, self.spec['threads'])
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def on_epoch_end(self, epoch, logs=None):
+        start = time.time()
+        self.wait()
+        arrays = checkpoint.snapshot(self.model, epoch, optimizer=False)
+        blocked = time.time() - start
+        path = async_eval.snapshot_path(self.eval_path, epoch)
+        self.thread = threading.Thread(target=checkpoint.write, args=(path, arrays))
+        self.thread.daemon = True
+        self.thread.start()
+        self.read_results()
+        lag = epoch - max(self.results) if self.results else epoch + 1
+        print('\nepoch {} handed to the evaluator in {:.3f}s, {} epochs behind'.format(epoch + 1, blocked, lag))
+        if self.process.poll() is not None and not self.exit_reported:
+            print('evaluator exited with {}; training goes on, score the snapshots with python async_eval.py {} --once'.format(
+                self.process.returncode, self.eval_path))
+            self.exit_reported = True
+        if self.patience is not None and self.best_epoch is not None and max(self.results) - self.best_epoch >= self.patience:
+            print('no better {} in the {} epochs scored after epoch {}, stopping'.format(
+                self.spec['monitor'], max(self.results) - self.best_epoch, self.best_epoch + 1))
+            self.model.stop_training = True
+
+    def read_results(self, verbose=True):
+        for result in async_eval.load_results(self.eval_path):
+            if result['epoch'] in self.results:
+                continue
+            self.results[result['epoch']] = result
+            if result['best']:
+                self.best_epoch = result['epoch']
+            if verbose:
+                monitor = self.spec['monitor']
+                print('\nvalidation of epoch {}: {} {:.4f} [{:.4f}, {:.4f}]{}'.format(result['epoch'] + 1, monitor,
+                    result[monitor], result[monitor + '_low'], result[monitor + '_high'], ', best so far' if result['best'] else ''))
+
+    def on_train_end(self, logs=None):
+        self.wait()
+        async_eval.finish(self.eval_path)
+        if self.process is not None and self.process.poll() is None:
+            print('waiting for the evaluator to score the last epochs')
+            self.process.wait()
+        self.read_results()
+        self.update_history()
+        if self.best_epoch is not None:
+            print('best {} {:.4f} at epoch {}, saved to {}'.format(self.spec['monitor'],
+                self.results[self.best_epoch][self.spec['monitor']], self.best_epoch + 1, self.spec['best_path']))
+
+    def update_history(self):
+        # keras never validated, so the history fit returns gets the evaluator's series instead,
+        # nan for epochs it didn't score, for the plots and pickles made from it
+        history = getattr(self.model, 'history', None)
+        if history is None:
+            return
+        for key in ['val_loss', 'val_acc']:
+            history.history[key] = [self.results[epoch][key] if epoch in self.results else float('nan') for epoch in history.epoch]
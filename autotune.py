@@ -0,0 +1,225 @@
+import argparse
+import json
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+import distributed
+
+# picks tensorflow's intra/inter-op thread counts (and, for training, the data loader's
+# worker threads) per host from short timed trials of the real models, and applies the
+# winner on later runs. every trial runs in a fresh process, since thread pools are fixed
+# once tensorflow has started
+autotune_path_default = 'autotune.json'
+workloads = ['fit', 'predict', 'generate']
+batch_size_default = 16
+steps_default = 10
+resolution_default = 224
+trial_timeout = 900
+
+def host():
+    return socket.gethostname()
+
+def load(path=autotune_path_default):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def save(entries, path=autotune_path_default):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(entries, f, indent=1)
+    os.rename(tmp_path, path)
+
+def tuned(workload, path=autotune_path_default):
+    # this host's best configuration for the workload, if it was tuned on the same cores
+    entry = load(path).get(host(), {}).get(workload)
+    if entry is None or entry.get('cpu_count') != multiprocessing.cpu_count():
+        return None
+    return entry
+
+def add_arguments(parser):
+    parser.add_argument('--threads', type=str, help='tensorflow threads as intra:inter, instead of the tuned ones')
+    parser.add_argument('--no_autotune', action='store_true', help="don't apply this host's tuned threads (see autotune.py)")
+
+def apply(workload, config=None, path=autotune_path_default):
+    # configures the session before any model is built; returns the settings used, e.g.
+    # {'intra': 4, 'inter': 2, 'workers': 2}, or {} for tensorflow's defaults
+    import session_config
+    if distributed.rank_env in os.environ:
+        # a data-parallel worker; the launcher already split the cores
+        return {}
+    if getattr(config, 'threads', None):
+        intra, inter = session_config.parse_threads(config.threads)
+        session_config.configure_session(intra, inter)
+        return {'intra': intra, 'inter': inter}
+    if getattr(config, 'no_autotune', False):
+        return {}
+    entry = tuned(workload, path)
+    if entry is None:
+        return {}
+    print('using tuned {} settings for {}: {} intra-op, {} inter-op threads, {} loader workers'.format(
+        workload, host(), entry['intra'], entry['inter'], entry['workers']))
+    session_config.configure_session(entry['intra'], entry['inter'])
+    return entry
+
+#*********************************** TRIALS ************************************
+def image_sequence(batch_size, resolution, steps, train_path):
+    # batches decoded from the training images when there are some, so loader workers have
+    # real work; random pixels otherwise
+    import keras
+    import classifier
+    posts = []
+    if os.path.exists(train_path):
+        import manifest
+        posts = manifest.load(train_path)['posts'][:batch_size * steps]
+    rng = np.random.RandomState(0)
+
+    class Sequence(keras.utils.Sequence):
+        def __len__(self):
+            return steps
+
+        def __getitem__(self, index):
+            batch = posts[index * batch_size:(index + 1) * batch_size]
+            if len(batch) == batch_size:
+                X = np.array([classifier.load_image(post['path'], (resolution, resolution)) for post in batch])
+            else:
+                X = rng.randint(0, 256, size=(batch_size, resolution, resolution, 3)).astype(np.float32)
+            return X, np.eye(classifier.NUM_CLASSES)[rng.randint(0, classifier.NUM_CLASSES, size=batch_size)]
+    return Sequence()
+
+def trial_fit(config):
+    # a few fit steps of main.create_model; the vgg16 blocks are frozen like in training
+    import main
+    model = main.create_model(weights=None)
+    model.compile(optimizer='adam', loss='categorical_crossentropy')
+    sequence = image_sequence(config.batch_size, config.resolution, config.steps + 2, config.train_path)
+    fit = lambda steps: model.fit_generator(sequence, steps_per_epoch=steps, epochs=1, workers=config.workers,
+        max_queue_size=2 * config.workers, verbose=0)
+    fit(2)
+    start = time.time()
+    fit(config.steps)
+    return config.steps * config.batch_size / (time.time() - start)
+
+def trial_predict(config):
+    import main
+    from bench_inference import random_images
+    model = main.create_model(weights=None)
+    X = random_images(np.random.RandomState(0), config.batch_size, config.resolution)
+    model.predict(X, batch_size=config.batch_size)
+    start = time.time()
+    for _ in range(config.steps):
+        model.predict(X, batch_size=config.batch_size)
+    return config.steps * config.batch_size / (time.time() - start)
+
+def trial_generate(config):
+    # greedy titles for a batch of images, the generate_title path batched
+    from bench_inference import random_images, synthetic_vocab, vocab_size_default, NUM_SUBREDDITS
+    from titling_model import ImageTitlingModel
+    words_by_id, ids_by_word = synthetic_vocab(vocab_size_default)
+    # without the prefix cache, which would turn every repeat into lookups
+    model = ImageTitlingModel(words_by_id, ids_by_word, num_subreddits=NUM_SUBREDDITS, encoder_weights=None, prefix_cache_mb=0)
+    X = random_images(np.random.RandomState(0), config.batch_size, config.resolution)
+    subreddits = np.arange(config.batch_size) % NUM_SUBREDDITS
+    model.generate_titles(X, subreddits)
+    start = time.time()
+    for _ in range(config.steps):
+        model.generate_titles(X, subreddits)
+    return config.steps * config.batch_size / (time.time() - start)
+
+trials = {'fit': trial_fit, 'predict': trial_predict, 'generate': trial_generate}
+
+def run_trial(config):
+    import session_config
+    session_config.configure_session(config.intra, config.inter)
+    print(json.dumps({'items_per_sec': trials[config.trial](config)}))
+
+def measure(config, workload, intra, inter, workers):
+    env = dict(os.environ)
+    env['OMP_NUM_THREADS'] = str(intra)
+    args = [sys.executable, os.path.abspath(__file__), '--trial', workload, '--intra', str(intra), '--inter', str(inter),
+        '--workers', str(workers), '--batch_size', str(config.batch_size), '--steps', str(config.steps),
+        '--resolution', str(config.resolution), '--train_path', config.train_path]
+    try:
+        output = subprocess.check_output(args, env=env, stderr=subprocess.STDOUT, timeout=trial_timeout)
+        result = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired, ValueError, IndexError) as e:
+        print('  {}:{} workers {} failed: {}'.format(intra, inter, workers, e))
+        return None
+    print('  {}:{} workers {}: {:.2f} items/s'.format(intra, inter, workers, result['items_per_sec']))
+    return result['items_per_sec']
+
+def candidates(cpu_count):
+    powers = [2 ** i for i in range(int(np.log2(cpu_count)) + 1)]
+    return {
+        'intra': sorted(set(powers + [cpu_count])),
+        'inter': [n for n in [1, 2, 4] if n <= cpu_count],
+        'workers': [n for n in [1, 2, 4, 8] if n <= cpu_count],
+    }
+
+def tune(config, workload):
+    # coordinate search from (all cores, 1, 1): sweep one knob with the others at their best
+    # so far, which needs a dozen trials instead of the whole grid
+    cpu_count = multiprocessing.cpu_count()
+    options = candidates(cpu_count)
+    if workload != 'fit':
+        options['workers'] = [1]
+    best = {'intra': cpu_count, 'inter': 1, 'workers': 1}
+    scores = {}
+    for knob in ['intra', 'inter', 'workers']:
+        for value in options[knob]:
+            setting = dict(best, **{knob: value})
+            key = (setting['intra'], setting['inter'], setting['workers'])
+            if key not in scores:
+                scores[key] = measure(config, workload, *key)
+        scored = [(scores[k], k) for k in scores if scores[k] is not None]
+        if scored:
+            best = dict(zip(['intra', 'inter', 'workers'], max(scored)[1]))
+    if not any(s is not None for s in scores.values()):
+        raise RuntimeError('every {} trial failed'.format(workload))
+    default = scores.get((cpu_count, 1, 1))
+    entry = dict(best,
+        items_per_sec=scores[(best['intra'], best['inter'], best['workers'])],
+        cpu_count=cpu_count,
+        batch_size=config.batch_size,
+        resolution=config.resolution,
+        tuned_at=time.time(),
+        trials=[{'intra': k[0], 'inter': k[1], 'workers': k[2], 'items_per_sec': v} for k, v in sorted(scores.items())])
+    print('{}: best {}:{} with {} workers, {:.2f} items/s{}'.format(workload, best['intra'], best['inter'], best['workers'],
+        entry['items_per_sec'], ' ({:.2f}x all-cores default)'.format(entry['items_per_sec'] / default) if default else ''))
+    return entry
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="tune this host's tensorflow threads and loader workers from timed trials")
+    parser.add_argument('--workloads', type=str, nargs='+', default=workloads, choices=workloads, help='workloads to tune')
+    parser.add_argument('--output', type=str, default=autotune_path_default, help='per-host results, read by the entry points')
+    parser.add_argument('--batch_size', type=int, default=batch_size_default, help='images per trial step')
+    parser.add_argument('--steps', type=int, default=steps_default, help='timed steps per trial')
+    parser.add_argument('--resolution', type=int, default=resolution_default, help='image resolution of the trials')
+    parser.add_argument('--train_path', type=str, default='train.json', help='images for the fit trials, random pixels if missing')
+    parser.add_argument('--show', action='store_true', help="print this host's tuned settings")
+    parser.add_argument('--trial', type=str, choices=workloads, help=argparse.SUPPRESS)
+    parser.add_argument('--intra', type=int, default=0, help=argparse.SUPPRESS)
+    parser.add_argument('--inter', type=int, default=0, help=argparse.SUPPRESS)
+    parser.add_argument('--workers', type=int, default=1, help=argparse.SUPPRESS)
+    config = parser.parse_args()
+
+    if config.trial:
+        run_trial(config)
+    elif config.show:
+        print(json.dumps(load(config.output).get(host(), {}), indent=1))
+    else:
+        for workload in config.workloads:
+            print('tuning {} on {} ({} cpus)'.format(workload, host(), multiprocessing.cpu_count()))
+            entry = tune(config, workload)
+            # re-read, so concurrent tuning of other hosts sharing the file isn't lost
+            entries = load(config.output)
+            entries.setdefault(host(), {})[workload] = entry
+            save(entries, config.output)
+        print('wrote ' + config.output)
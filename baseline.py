@@ -11,27 +11,29 @@ from PIL import Image, ImageOps
 import json
 import numpy as np
 from collections import Counter
+import memory_profile
+import manifest
+import pyramid
 
 NUM_CLASSES=20
 k_default = 5
 train_path_default = "train.json"
 train_small_path_default = "small_train.json"
+memory_path_default = "baseline_memory.json"
 
 #*********************************** HELPERS ***********************************
+@memory_profile.phased('load')
 def get_data(json_path):
     X_train = []
     y_train = []
-    with open(json_path) as f:
-        data = json.load(f)
-        for post in data['posts']:
-            path = post['path']
-            label = post['subreddit']
-            img = np.array(Image.open(path))
-            X_train.append(img)
-
-            one_hot = np.zeros(NUM_CLASSES)
-            one_hot[label] = 1
-            y_train.append(one_hot)
+    columns = manifest.load_columns(json_path, ['path', 'subreddit'])
+    for path, label in zip(columns['path'], columns['subreddit']):
+        img = np.array(Image.open(path))
+        X_train.append(img)
+
+        one_hot = np.zeros(NUM_CLASSES)
+        one_hot[label] = 1
+        y_train.append(one_hot)
 
     X_train = np.array(X_train)
     y_train = np.array(y_train)
@@ -39,16 +41,22 @@ def get_data(json_path):
     return X_train, y_train
 
 def get_subreddit_indices_map(path):
-    with open(path) as f:
-        data = json.load(f)
-        return data['subreddit_indices_map']
+    return manifest.get_subreddit_indices_map(path)
 
 def get_subreddit_for_index(index):
-    subreddit_indices_map = get_subreddit_indices_map(train_path_default)
-    reverse_map = {}
-    for k, v in subreddit_indices_map.items():
-        reverse_map[v] = k
-    return reverse_map[index]
+    return manifest.get_subreddit_for_index(index, train_path_default)
+
+def nearest_label(img, X_train, y_train, k):
+    d = []
+    for i in range(0, X_train.shape[0]):
+        dist = np.sum(np.abs(img - X_train[i]))
+        d.append(dist)
+    idx = np.argpartition(d, k)[:k]
+    b = []
+    for i in range(0, k):
+        label = np.where(y_train[idx[i]] != 0)[0][0]
+        b.append(label)
+    return Counter(b).most_common(1)[0][0]
 
 def evaluate(config):
     img_path = config.i
@@ -57,23 +65,14 @@ def evaluate(config):
     size = X_train.shape[1], X_train.shape[2]
     num = X_val.shape[0]
     acc = 0
-    for i in range(0, num):
-    	d = []
-    	img = X_val[i]
-    	for j in range(0, X_train.shape[0]):
-    		dist = np.sum(np.abs(img - X_train[j]))
-    		d.append(dist)
-    	idx = np.argpartition(d, config.k)[:config.k]
-    	b = []
-    	for j in range(0, config.k):
-    		label = np.where(y_train[idx[j]] != 0)[0][0]
-    		b.append(label)
-    	label_i = Counter(b).most_common(1)[0][0]
-    	label = get_subreddit_for_index(label_i)
-
-    	if label_i == np.where(y_val[i] != 0)[0][0]:
-    		acc += 1
-    	print(str(i) + ": Predicting " + label + " acc:" + str(acc))
+    with memory_profile.phase('evaluate'):
+        for i in range(0, num):
+            label_i = nearest_label(X_val[i], X_train, y_train, config.k)
+            label = get_subreddit_for_index(label_i)
+
+            if label_i == np.where(y_val[i] != 0)[0][0]:
+                acc += 1
+            print(str(i) + ": Predicting " + label + " acc:" + str(acc))
     print("validation accuracy of " + str(float(100 * acc) / num) + "%...")
 
 def predict(config):
@@ -83,16 +82,7 @@ def predict(config):
     img = Image.open(img_path).convert('RGB')
     new = ImageOps.fit(img, size, Image.ANTIALIAS)
     img = np.array(new)
-    d = []
-    for i in range(0, X_train.shape[0]):
-    	dist = np.sum(np.abs(img - X_train[i]))
-    	d.append(dist)
-    idx = np.argpartition(d, config.k)[:config.k]
-    b = []
-    for i in range(0, config.k):
-    	label = np.where(y_train[idx[i]] != 0)[0][0]
-    	b.append(label)
-    label_i = Counter(b).most_common(1)[0][0]
+    label_i = nearest_label(img, X_train, y_train, config.k)
     label = get_subreddit_for_index(label_i)
     print('Predicting {}'.format(label))
 
@@ -105,6 +95,8 @@ if __name__ == "__main__":
 	parser.add_argument("-k", type=int, help="k value for baseline")
 	parser.add_argument("-e", action="store_true", help="evaluate baseline")
 	parser.add_argument("-i", type=str, help='path of img to predict')
+	parser.add_argument("-m", action="store_true", help="trace numpy allocations in the memory report")
+	parser.add_argument("-r", type=int, help="image resolution, i.e. pyramid level to load (default: the pyramid's default level)")
 	config = parser.parse_args()
 
 	if len(sys.argv) <= 1:
@@ -114,6 +106,7 @@ if __name__ == "__main__":
 	    print("python baseline.py -k=5 -i=datasets/cats50.jpg")
 
 	else:
+		pyramid.select(config.r)
 		config.train_path = train_path_default
 		if config.s:
 			config.train_path = train_small_path_default
@@ -121,7 +114,13 @@ if __name__ == "__main__":
 			config.k = k_default
 		print(config)
 
-		if config.e:
-			evaluate(config)
-		if config.i:
-			predict(config)
\ No newline at end of file
+		memory_profile.start(memory_path_default, trace=config.m)
+		try:
+			if config.e:
+				with memory_profile.phase('evaluate'):
+					evaluate(config)
+			if config.i:
+				with memory_profile.phase('predict'):
+					predict(config)
+		finally:
+			memory_profile.stop()
\ No newline at end of file
@@ -0,0 +1,239 @@
+import argparse
+import contextlib
+import importlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+import numpy as np
+from PIL import Image
+
+import bench_utils
+
+NUM_SUBREDDITS = 20
+posts_default = [64]
+resolution_default = [224]
+repeat_default = 3
+batch_size_default = 8
+max_len_default = 30
+glove_words_default = 2000
+glove_size = 50
+validation_fraction = 0.25
+output_default = 'bench_data.json'
+
+# small fixed word list so the vocab loaders see repeated words above their count thresholds
+title_words = ['my', 'cat', 'this', 'is', 'the', 'when', 'first', 'finally', 'after', 'years',
+    'found', 'made', 'new', 'old', 'dog', 'art', 'painting', 'shoes', 'outfit', 'today',
+    'sunset', 'flower', 'game', 'design', 'perfect', 'timing', 'cozy', 'room', 'comic', 'nature']
+
+#*********************************** FIXTURES **********************************
+def make_image(rng, width, height):
+    # upsampled low frequency noise compresses like a photo instead of like static
+    small = rng.randint(0, 256, size=(8, 8, 3)).astype(np.uint8)
+    img = np.array(Image.fromarray(small).resize((width, height), Image.BILINEAR), dtype=np.int16)
+    img += rng.randint(-16, 16, size=img.shape).astype(np.int16)
+    return Image.fromarray(np.clip(img, 0, 255).astype(np.uint8))
+
+def make_posts(rng, paths):
+    posts = []
+    for i, path in enumerate(paths):
+        num_words = rng.randint(2, 15)
+        title = ' '.join(rng.choice(title_words) for _ in range(num_words))
+        posts.append({
+            'id': 'bench{}'.format(i),
+            'title': title.capitalize(),
+            'subreddit': i % NUM_SUBREDDITS,
+            'url': 'http://example.com/{}.jpg'.format(i),
+            'score': str(rng.randint(1, 100000)),
+            'path': path,
+            'created': 1500000000.0 + i,
+        })
+    return posts
+
+def write_posts(path, posts):
+    subreddit_indices_map = {'r/bench{}'.format(i): i for i in range(NUM_SUBREDDITS)}
+    with open(path, 'w') as f:
+        json.dump({'posts': posts, 'subreddit_indices_map': subreddit_indices_map}, f)
+
+def make_glove(path, rng, num_words):
+    words = list(title_words) + ['word{}'.format(i) for i in range(num_words - len(title_words))]
+    with open(path, 'w') as f:
+        for word in words:
+            f.write(word + ' ' + ' '.join('{:.5f}'.format(v) for v in rng.randn(glove_size)) + '\n')
+
+def make_fixtures(root, num_posts, resolution, glove_words=glove_words_default, seed=0):
+    # preprocessed square images + train/validation json, raw images for preprocess(), and a glove file
+    rng = np.random.RandomState(seed)
+    dataset_dir = os.path.join(root, 'datasets')
+    raw_dir = os.path.join(root, 'raw', 'datasets')
+    os.makedirs(dataset_dir)
+    os.makedirs(raw_dir)
+    paths = []
+    for i in range(num_posts):
+        path = os.path.join(dataset_dir, 'bench{}.jpg'.format(i))
+        make_image(rng, resolution, resolution).save(path)
+        paths.append(path)
+        # raw crawl images are neither square nor preprocessed and some are png
+        ext = 'png' if i % 4 == 0 else 'jpg'
+        make_image(rng, resolution * 3 // 2, resolution).save(os.path.join(raw_dir, 'bench{}.{}'.format(i, ext)))
+    posts = make_posts(rng, paths)
+    num_val = max(1, int(num_posts * validation_fraction))
+    fixtures = {
+        'root': root,
+        'raw_root': os.path.join(root, 'raw'),
+        'num_posts': num_posts,
+        'resolution': resolution,
+        'train_json': os.path.join(root, 'train.json'),
+        'validation_json': os.path.join(root, 'validation.json'),
+        'glove_path': os.path.join(root, 'glove.6B.{}d.txt'.format(glove_size)),
+    }
+    write_posts(fixtures['train_json'], posts)
+    write_posts(fixtures['validation_json'], posts[:num_val])
+    make_glove(fixtures['glove_path'], rng, glove_words)
+    return fixtures
+
+@contextlib.contextmanager
+def working_directory(path):
+    cwd = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(cwd)
+
+def import_or_skip(name, skipped):
+    try:
+        return importlib.import_module(name)
+    except ImportError as e:
+        skipped[name] = str(e)
+        return None
+
+#********************************** BENCHMARKS *********************************
+def hot_paths(fixtures, config, skipped):
+    # yields (name, fn, items, setup) for every data path whose dependencies import
+    train_json = fixtures['train_json']
+    num_posts = fixtures['num_posts']
+
+    for module_name in ['baseline', 'classifier', 'main']:
+        module = import_or_skip(module_name, skipped)
+        if module is not None:
+            yield 'get_data.' + module_name, lambda m=module: m.get_data(train_json), num_posts, None
+
+    get_datasets = import_or_skip('get_datasets', skipped)
+    if get_datasets is not None:
+        raw_root = fixtures['raw_root']
+        work_root = os.path.join(fixtures['root'], 'preprocess')
+
+        def reset_raw():
+            if os.path.isdir(work_root):
+                shutil.rmtree(work_root)
+            shutil.copytree(raw_root, work_root)
+
+        def run_preprocess():
+            with working_directory(work_root):
+                get_datasets.preprocess([fixtures['resolution']])
+        yield 'get_datasets.preprocess', run_preprocess, num_posts, reset_raw
+
+    baseline = import_or_skip('baseline', skipped)
+    if baseline is not None:
+        X_train, y_train = baseline.get_data(train_json)
+        X_val, _ = baseline.get_data(fixtures['validation_json'])
+
+        def run_distances():
+            for img in X_val:
+                baseline.nearest_label(img, X_train, y_train, config.k)
+        yield 'baseline.nearest_label', run_distances, len(X_val), None
+
+    vocab = import_or_skip('vocab', skipped)
+    if vocab is None:
+        return
+    yield 'vocab.load_vocab', lambda: vocab.load_vocab(train_json), num_posts, None
+    yield 'vocab.build_vocab', lambda: vocab.build_vocab(train_json, processes=1), num_posts, None
+
+    def run_limited():
+        with working_directory(fixtures['root']):
+            vocab.load_limited_embedding_matrix(train_json, glove_size)
+    yield 'vocab.load_limited_embedding_matrix', run_limited, num_posts, None
+
+    def run_full():
+        with working_directory(fixtures['root']):
+            vocab.load_embedding_matrix()
+    yield 'vocab.load_embedding_matrix', run_full, config.glove_words, None
+
+    titling_data = import_or_skip('titling_data', skipped)
+    if titling_data is None:
+        return
+    _, ids_by_word = vocab.load_vocab(train_json)
+    with open(train_json) as f:
+        posts = json.load(f)['posts']
+
+    def run_posts():
+        for post in posts:
+            titling_data.model_input_output_from_post(post, ids_by_word, config.max_len)
+    yield 'titling_data.model_input_output_from_post', run_posts, num_posts, None
+
+    yield 'get_data.titling_data', lambda: titling_data.get_data(train_json, ids_by_word), num_posts, None
+
+    generator = titling_data.ImageTitlingDataGenerator(train_json, ids_by_word,
+        max_len=config.max_len,
+        num_subreddits=NUM_SUBREDDITS,
+        batch_size=config.batch_size)
+
+    def run_generator():
+        for i in range(len(generator)):
+            generator[i]
+    yield 'ImageTitlingDataGenerator.__getitem__', run_generator, len(generator) * config.batch_size, None
+
+def run(config):
+    results = {}
+    skipped = {}
+    for num_posts in config.posts:
+        for resolution in config.resolution:
+            root = tempfile.mkdtemp(prefix='bench_data_', dir=config.fixtures)
+            try:
+                print('generating {} posts at {}x{} in {}'.format(num_posts, resolution, resolution, root))
+                fixtures = make_fixtures(root, num_posts, resolution, glove_words=config.glove_words, seed=config.seed)
+                for name, fn, items, setup in hot_paths(fixtures, config, skipped):
+                    if config.only and not any(pattern in name for pattern in config.only):
+                        continue
+                    key = '{}@n={},r={}'.format(name, num_posts, resolution)
+                    results[key] = bench_utils.run_benchmark(key, fn, items=items,
+                        repeat=config.repeat, setup=setup, memory=not config.no_memory)
+            finally:
+                if not config.keep:
+                    shutil.rmtree(root, ignore_errors=True)
+    for name, reason in sorted(skipped.items()):
+        print('skipped {}: {}'.format(name, reason))
+    return results, skipped
+
+#************************************ MAIN *************************************
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='microbenchmarks for the data pipeline on synthetic fixtures')
+    parser.add_argument('--posts', type=int, nargs='+', default=posts_default, help='number of synthetic posts, one run per value')
+    parser.add_argument('--resolution', type=int, nargs='+', default=resolution_default, help='image resolution, one run per value')
+    parser.add_argument('--repeat', type=int, default=repeat_default, help='timed repetitions per benchmark')
+    parser.add_argument('--batch_size', type=int, default=batch_size_default, help='titling generator batch size')
+    parser.add_argument('--max_len', type=int, default=max_len_default, help='max len of titles')
+    parser.add_argument('--k', type=int, default=5, help='k value for the baseline distance loop')
+    parser.add_argument('--glove_words', type=int, default=glove_words_default, help='words in the synthetic glove file')
+    parser.add_argument('--seed', type=int, default=0, help='fixture random seed')
+    parser.add_argument('--only', type=str, nargs='*', help='only run benchmarks whose name contains one of these')
+    parser.add_argument('--no_memory', action='store_true', help='skip the traced peak memory pass')
+    parser.add_argument('--fixtures', type=str, help='directory to create fixtures in (default: system temp)')
+    parser.add_argument('--keep', action='store_true', help='keep generated fixtures')
+    parser.add_argument('--output', type=str, default=output_default, help='where to write results json')
+    parser.add_argument('--baseline', type=str, help='results json to compare against')
+    parser.add_argument('--tolerance', type=float, default=bench_utils.regression_tolerance_default, help='allowed median slowdown before flagging a regression')
+    config = parser.parse_args()
+
+    results, skipped = run(config)
+    regressions = []
+    if config.baseline:
+        regressions = bench_utils.compare(results, bench_utils.load_results(config.baseline), config.tolerance)
+        bench_utils.report_regressions(regressions)
+    bench_utils.write_results(config.output, results, meta={'config': vars(config), 'skipped': skipped})
+    print('wrote ' + config.output)
+    if regressions:
+        sys.exit(1)
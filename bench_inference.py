@@ -0,0 +1,185 @@
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+
+import numpy as np
+
+import bench_utils
+import session_config
+
+NUM_SUBREDDITS = 20
+resolution_default = 224
+batch_sizes_default = [1, 8]
+beam_widths_default = [1, 3, 5]
+max_lens_default = [30]
+threads_default = ['0:0']
+vocab_size_default = 5000
+repeat_default = 10
+output_default = 'bench_inference.json'
+
+def random_images(rng, batch_size, resolution):
+    # roughly the range of vgg16 preprocess_input output
+    return rng.uniform(-128, 128, size=(batch_size, resolution, resolution, 3)).astype(np.float32)
+
+def synthetic_vocab(vocab_size):
+    from vocab import SPECIAL_TOKENS
+    words = list(SPECIAL_TOKENS) + ['word{}'.format(i) for i in range(vocab_size - len(SPECIAL_TOKENS))]
+    words_by_id = {i: word for i, word in enumerate(words)}
+    ids_by_word = {word: i for i, word in enumerate(words)}
+    return words_by_id, ids_by_word
+
+def record(results, name, times, items=None, phase=None):
+    result = bench_utils.summarize(times, items)
+    result['phase'] = phase
+    results[name] = result
+    print('{}: p50 {:.4f}s p95 {:.4f}s p99 {:.4f}s'.format(name, result['p50_s'], result['p95_s'], result['p99_s']))
+
+#********************************** BENCHMARKS *********************************
+def bench_image_classifier(name, build, config, threads, weights_path, rng, results):
+    intra, inter = threads
+    suffix = 'threads={}:{}'.format(intra, inter)
+    times = bench_utils.timed(build, repeat=config.repeat_build, warmup=0,
+        setup=lambda: session_config.reset_session(intra, inter))
+    record(results, '{}.build@{}'.format(name, suffix), times, phase='build')
+
+    model = build()
+    model.save_weights(weights_path)
+    times = bench_utils.timed(lambda: model.load_weights(weights_path), repeat=config.repeat_build)
+    record(results, '{}.load_weights@{}'.format(name, suffix), times, phase='load_weights')
+
+    for batch_size in config.batch_sizes:
+        X = random_images(rng, batch_size, config.resolution)
+        times = bench_utils.timed(lambda: model.predict(X, batch_size=batch_size), repeat=config.repeat)
+        record(results, '{}.predict@batch={},{}'.format(name, batch_size, suffix), times, items=batch_size, phase='predict')
+
+def bench_classifier(config, threads, weights_path, rng, results):
+    import classifier
+    build = lambda: classifier.create_model(config.resolution, weights=None)
+    bench_image_classifier('classifier', build, config, threads, weights_path, rng, results)
+
+def bench_main(config, threads, weights_path, rng, results):
+    import main
+    build = lambda: main.create_model(weights=None)
+    bench_image_classifier('main', build, config, threads, weights_path, rng, results)
+
+def bench_titling(config, threads, weights_path, rng, results):
+    from titling_model import ImageTitlingModel
+    from prefix_cache import PrefixStateCache
+    intra, inter = threads
+    suffix = 'threads={}:{}'.format(intra, inter)
+    words_by_id, ids_by_word = synthetic_vocab(config.vocab_size)
+    # the prefix cache would answer every repeat from memory; it gets its own runs below
+    build = lambda: ImageTitlingModel(words_by_id, ids_by_word,
+        num_subreddits=NUM_SUBREDDITS,
+        max_len=max(config.max_lens),
+        encoder_weights=None,
+        prefix_cache_mb=0)
+    times = bench_utils.timed(build, repeat=config.repeat_build, warmup=0,
+        setup=lambda: session_config.reset_session(intra, inter))
+    record(results, 'titling.build@{}'.format(suffix), times, phase='build')
+
+    model = build()
+    model.train_model.save_weights(weights_path)
+    times = bench_utils.timed(lambda: model.load_weights(weights_path), repeat=config.repeat_build)
+    record(results, 'titling.load_weights@{}'.format(suffix), times, phase='load_weights')
+
+    for batch_size in config.batch_sizes:
+        X = random_images(rng, batch_size, config.resolution)
+        subreddits = np.eye(NUM_SUBREDDITS)[rng.randint(0, NUM_SUBREDDITS, size=batch_size)]
+        times = bench_utils.timed(lambda: model.inference_encoder_model.predict([X, subreddits]), repeat=config.repeat)
+        record(results, 'titling.encoder@batch={},{}'.format(batch_size, suffix), times, items=batch_size, phase='encoder')
+
+    img = random_images(rng, 1, config.resolution)[0]
+    decoder_predict = model.inference_decoder_model.predict
+    for max_len in config.max_lens:
+        # decoding is bounded by self.max_len only, so the sweep does not need a rebuild
+        model.max_len = max_len
+        runs = [('generate_title', lambda: model.generate_title(img, 0))]
+        for k in config.beam_widths:
+            runs.append(('generate_title_beam_search@k={}'.format(k),
+                lambda k=k: model.generate_title_beam_search(img, 0, k)))
+        # every subreddit's title from one encoder pass, vs NUM_SUBREDDITS generate_title calls
+        runs.append(('generate_titles_for_all_subreddits', lambda: model.generate_titles_for_all_subreddits(img)))
+        for run_name, fn in runs:
+            fn()
+            timer = bench_utils.CallTimer(decoder_predict)
+            model.inference_decoder_model.predict = timer
+            try:
+                times = bench_utils.timed(fn, repeat=config.repeat, warmup=0)
+            finally:
+                model.inference_decoder_model.predict = decoder_predict
+            sep = ',' if '@' in run_name else '@'
+            name = 'titling.{}{}max_len={},{}'.format(run_name, sep, max_len, suffix)
+            record(results, name, times, items=1, phase='generate')
+            if timer.times:
+                record(results, name + '.decoder_step', timer.times, items=1, phase='decoder_step')
+                results[name]['decoder_steps_per_call'] = len(timer.times) / float(config.repeat)
+
+        # the same requests with the prefix cache: one cold call, then repeats from a warm cache
+        for k in config.beam_widths:
+            model.prefix_cache = PrefixStateCache(config.prefix_cache_mb)
+            fn = lambda: model.generate_titles(np.array([img]), [0], k)
+            name = 'titling.generate_titles_cached@k={},max_len={},{}'.format(k, max_len, suffix)
+            for phase, repeat in [('cold', 1), ('warm', config.repeat)]:
+                timer = bench_utils.CallTimer(decoder_predict)
+                model.inference_decoder_model.predict = timer
+                try:
+                    times = bench_utils.timed(fn, repeat=repeat, warmup=0)
+                finally:
+                    model.inference_decoder_model.predict = decoder_predict
+                record(results, '{}.{}'.format(name, phase), times, items=1, phase='generate')
+                results['{}.{}'.format(name, phase)]['decoder_steps_per_call'] = len(timer.times) / float(repeat)
+            results[name + '.warm']['prefix_cache'] = model.prefix_cache.stats()
+        model.prefix_cache = None
+
+benchmarks = {
+    'classifier': bench_classifier,
+    'main': bench_main,
+    'titling': bench_titling,
+}
+
+def run(config):
+    results = {}
+    rng = np.random.RandomState(config.seed)
+    work_dir = tempfile.mkdtemp(prefix='bench_inference_')
+    try:
+        for spec in config.threads:
+            threads = session_config.parse_threads(spec)
+            for name in config.models:
+                print('benchmarking {} with threads {}'.format(name, spec))
+                session_config.reset_session(*threads)
+                benchmarks[name](config, threads, os.path.join(work_dir, name + '.h5'), rng, results)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+#************************************ MAIN *************************************
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='latency/throughput of the predict paths on randomly initialized models')
+    parser.add_argument('--models', type=str, nargs='+', default=sorted(benchmarks.keys()), choices=sorted(benchmarks.keys()), help='which models to benchmark')
+    parser.add_argument('--resolution', type=int, default=resolution_default, help='input image resolution')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=batch_sizes_default, help='batch sizes for predict/encoder')
+    parser.add_argument('--beam_widths', type=int, nargs='+', default=beam_widths_default, help='beam widths for generate_title_beam_search')
+    parser.add_argument('--max_lens', type=int, nargs='+', default=max_lens_default, help='max title lengths for generation')
+    parser.add_argument('--threads', type=str, nargs='+', default=threads_default, help='intra:inter op thread counts, 0 for default')
+    parser.add_argument('--prefix_cache_mb', type=float, default=64, help='prefix cache size for the cached title runs')
+    parser.add_argument('--vocab_size', type=int, default=vocab_size_default, help='synthetic titling vocab size')
+    parser.add_argument('--repeat', type=int, default=repeat_default, help='timed repetitions per measurement')
+    parser.add_argument('--repeat_build', type=int, default=2, help='timed repetitions of model construction/weight loading')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    parser.add_argument('--output', type=str, default=output_default, help='where to write results json')
+    parser.add_argument('--baseline', type=str, help='results json to compare against')
+    parser.add_argument('--tolerance', type=float, default=bench_utils.regression_tolerance_default, help='allowed median slowdown before flagging a regression')
+    config = parser.parse_args()
+
+    results = run(config)
+    regressions = []
+    if config.baseline:
+        regressions = bench_utils.compare(results, bench_utils.load_results(config.baseline), config.tolerance)
+        bench_utils.report_regressions(regressions)
+    bench_utils.write_results(config.output, results, meta={'config': vars(config)})
+    print('wrote ' + config.output)
+    if regressions:
+        sys.exit(1)
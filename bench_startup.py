@@ -0,0 +1,141 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+import bench_utils
+
+repeat_default = 5
+output_default = 'bench_startup.json'
+root = os.path.dirname(os.path.abspath(__file__))
+
+# per entry point, the functions each mode runs; a mode's import cost is the entry module
+# itself plus the imports deferred into those functions, read from their source
+modes = {
+    'classifier': {
+        'train': ['train', 'create_model'],
+        'evaluate': ['plot_history', 'score', 'plot_confusion_matrix', 'create_model'],
+        'predict': ['predict', 'create_model', 'plot_saliency'],
+        'saliency': ['plot_saliency_batch', 'create_saliency_function', 'create_model'],
+    },
+    'main': {
+        'train': ['train', 'create_model'],
+        'evaluate': ['evaluate', 'create_model'],
+        'plot_cm': ['plot_confusion_matrix', 'create_model'],
+        'predict': ['predict', 'create_model'],
+    },
+    'main_titling': {
+        'train': ['train'],
+        'evaluate': ['evaluate'],
+        'evaluate_split': ['evaluate_split'],
+        'sample_inference': ['sample_inference'],
+        'all_subreddits': ['titles_for_all_subreddits'],
+    },
+    'get_datasets': {
+        'download': ['download'],
+        'preprocess': ['preprocess'],
+        'augment': ['augment'],
+        'split': ['split'],
+        'cleanup': ['cleanup'],
+    },
+    'baseline': {
+        'evaluate': ['evaluate'],
+        'predict': ['predict'],
+    },
+    'create_small': {},
+    'verify': {},
+    'dedup': {},
+    'distill': {
+        'train': ['train', 'cache_teacher', 'create_student', 'distillation_loss', 'label_accuracy'],
+        'report': ['report', 'load_student', 'create_student'],
+    },
+    'retrieval': {
+        'build': ['build', 'create_embedding_model', 'load_image'],
+    },
+    'artifact': {
+        'export': ['export', 'export_classifier', 'export_titling', 'model_weights'],
+        'load': ['load', 'build', 'bind'],
+    },
+}
+
+# runs in a fresh interpreter: import the entry module, then each function's deferred imports
+probe = '''
+import ast, importlib, json, sys, time
+entry, functions = sys.argv[1], sys.argv[2:]
+start = time.time()
+module = importlib.import_module(entry)
+entry_s = time.time() - start
+with open(module.__file__.replace('.pyc', '.py')) as f:
+    tree = ast.parse(f.read())
+defs = dict((node.name, node) for node in tree.body if isinstance(node, ast.FunctionDef))
+names = []
+for function in functions:
+    for node in ast.walk(defs[function]):
+        if isinstance(node, ast.Import):
+            names += [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.level == 0:
+            names.append(node.module)
+start = time.time()
+for name in names:
+    importlib.import_module(name)
+mode_s = time.time() - start
+print(json.dumps({'entry_s': entry_s, 'mode_s': mode_s, 'modules': sorted(set(names)), 'loaded': len(sys.modules)}))
+'''
+
+def run_probe(entry, functions):
+    output = subprocess.check_output([sys.executable, '-c', probe, entry] + functions, cwd=root, stderr=subprocess.STDOUT)
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+def run_cli(args):
+    # wall time of a whole process, including interpreter startup
+    start = time.time()
+    subprocess.check_output([sys.executable] + args, cwd=root, stderr=subprocess.STDOUT)
+    return time.time() - start
+
+def record(results, name, times, extra=None):
+    result = bench_utils.summarize(times)
+    result.update(extra or {})
+    results[name] = result
+    print('{}: p50 {:.3f}s min {:.3f}s'.format(name, result['p50_s'], result['min_s']))
+
+def run(config):
+    results = {}
+    record(results, 'python', [run_cli(['-c', 'pass']) for _ in range(config.repeat)])
+    for entry in config.entries:
+        try:
+            record(results, entry + ' -h', [run_cli([entry + '.py', '-h']) for _ in range(config.repeat)])
+        except subprocess.CalledProcessError as e:
+            print('{} -h failed: {}'.format(entry, e.output.decode('utf-8', 'replace').strip().splitlines()[-1:]))
+        for mode, functions in sorted(modes[entry].items()):
+            name = '{} {}'.format(entry, mode)
+            try:
+                probes = [run_probe(entry, functions) for _ in range(config.repeat)]
+            except subprocess.CalledProcessError as e:
+                # e.g. a dependency that isn't installed on this machine
+                print('{}: skipped ({})'.format(name, e.output.decode('utf-8', 'replace').strip().splitlines()[-1:]))
+                continue
+            record(results, name + '.entry_import', [p['entry_s'] for p in probes])
+            record(results, name + '.mode_import', [p['mode_s'] for p in probes],
+                {'modules': probes[0]['modules'], 'loaded_modules': probes[0]['loaded']})
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='startup and import cost of every entry point and mode, each in a fresh interpreter')
+    parser.add_argument('--entries', type=str, nargs='+', default=sorted(modes.keys()), choices=sorted(modes.keys()), help='entry points to measure')
+    parser.add_argument('--repeat', type=int, default=repeat_default, help='fresh processes per measurement')
+    parser.add_argument('--output', type=str, default=output_default, help='where to write results json')
+    parser.add_argument('--baseline', type=str, help='results json to compare against')
+    parser.add_argument('--tolerance', type=float, default=bench_utils.regression_tolerance_default, help='allowed median slowdown before flagging a regression')
+    config = parser.parse_args()
+
+    results = run(config)
+    regressions = []
+    if config.baseline:
+        regressions = bench_utils.compare(results, bench_utils.load_results(config.baseline), config.tolerance)
+        bench_utils.report_regressions(regressions)
+    bench_utils.write_results(config.output, results, meta={'config': vars(config)})
+    print('wrote ' + config.output)
+    if regressions:
+        sys.exit(1)
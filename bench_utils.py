@@ -0,0 +1,132 @@
+import json
+import os
+import platform
+import socket
+import sys
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import numpy as np
+
+# a benchmark regresses when its median time grows by more than this fraction
+regression_tolerance_default = 0.10
+
+def max_rss_mb():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports kilobytes, macOS reports bytes
+    if sys.platform == 'darwin':
+        return rss / (1024. * 1024.)
+    return rss / 1024.
+
+def timed(fn, repeat=5, warmup=1, setup=None):
+    times = []
+    for i in range(warmup + repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        if i >= warmup:
+            times.append(elapsed)
+    return times
+
+def peak_traced_mb(fn, setup=None):
+    # numpy reports its buffers to tracemalloc, so this covers array allocations
+    if setup is not None:
+        setup()
+    tracemalloc.start()
+    try:
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak / (1024. * 1024.)
+
+def summarize(times, items=None):
+    times = np.array(times)
+    summary = {
+        'repeat': len(times),
+        'mean_s': float(np.mean(times)),
+        'min_s': float(np.min(times)),
+        'p50_s': float(np.percentile(times, 50)),
+        'p95_s': float(np.percentile(times, 95)),
+        'p99_s': float(np.percentile(times, 99)),
+    }
+    if items:
+        summary['items'] = items
+        summary['items_per_sec'] = items / summary['p50_s'] if summary['p50_s'] > 0 else None
+    return summary
+
+def run_benchmark(name, fn, items=None, repeat=5, warmup=1, setup=None, memory=True):
+    print('benchmarking {}...'.format(name))
+    result = summarize(timed(fn, repeat=repeat, warmup=warmup, setup=setup), items)
+    if memory:
+        result['peak_traced_mb'] = peak_traced_mb(fn, setup=setup)
+    result['max_rss_mb'] = max_rss_mb()
+    print('  p50 {:.4f}s  {}'.format(result['p50_s'],
+        '{:.1f} items/s'.format(result['items_per_sec']) if result.get('items_per_sec') else ''))
+    return result
+
+def environment():
+    return {
+        'host': socket.gethostname(),
+        'platform': platform.platform(),
+        'python': sys.version.split()[0],
+        'numpy': np.__version__,
+        'cpu_count': os.cpu_count(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+def write_results(path, results, meta=None):
+    report = {'environment': environment(), 'meta': meta or {}, 'results': results}
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    return report
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)['results']
+
+def compare(results, baseline, tolerance=regression_tolerance_default, key='p50_s'):
+    regressions = []
+    for name, result in sorted(results.items()):
+        if name not in baseline or key not in result or key not in baseline[name]:
+            continue
+        old = baseline[name][key]
+        new = result[key]
+        if old <= 0:
+            continue
+        change = (new - old) / old
+        result['baseline_' + key] = old
+        result['change'] = change
+        if change > tolerance:
+            regressions.append((name, old, new, change))
+    return regressions
+
+def report_regressions(regressions, key='p50_s'):
+    if not regressions:
+        print('no regressions against baseline')
+        return
+    print('{} regression(s) against baseline:'.format(len(regressions)))
+    for name, old, new, change in regressions:
+        print('  {}: {} {:.4f} -> {:.4f} (+{:.1f}%)'.format(name, key, old, new, 100 * change))
+
+class CallTimer(object):
+    # wraps a callable (e.g. a model's predict) and records each call's duration
+    def __init__(self, fn):
+        self.fn = fn
+        self.times = []
+
+    def __call__(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return self.fn(*args, **kwargs)
+        finally:
+            self.times.append(time.perf_counter() - start)
@@ -0,0 +1,115 @@
+import json
+import os
+import threading
+import time
+
+import numpy as np
+from keras import backend as K
+from keras.callbacks import Callback
+
+# resumable training state without the frozen backbone: weights of the trainable layers,
+# optimizer state and the epoch, in one npz. frozen layers are rebuilt from their source
+# (e.g. imagenet weights) when the model is created, so they never need to be written
+latest_checkpoint_name = 'latest-checkpoint.npz'
+meta_key = 'meta'
+
+def trainable_layers(model, prefix=''):
+    # (path, layer) for every trainable layer with weights, descending into nested models
+    # such as the VGG16 block inside the classifier's Sequential
+    for layer in model.layers:
+        path = prefix + layer.name
+        if hasattr(layer, 'layers'):
+            if layer.trainable:
+                for nested in trainable_layers(layer, path + '/'):
+                    yield nested
+        elif layer.trainable and layer.trainable_weights:
+            yield path, layer
+
+def snapshot(model, epoch, meta=None, optimizer=True):
+    # runs on the training thread: one batched read of the (small) trainable state; without
+    # the optimizer, for readers that only need the weights (e.g. async_eval.py)
+    layers = list(trainable_layers(model))
+    weights = [w for _, layer in layers for w in layer.weights]
+    optimizer_weights = model.optimizer.weights if optimizer and getattr(model, 'optimizer', None) is not None else []
+    values = K.batch_get_value(weights + optimizer_weights)
+    arrays = {}
+    i = 0
+    for path, layer in layers:
+        for j in range(len(layer.weights)):
+            arrays['layer/{}/{}'.format(path, j)] = values[i]
+            i += 1
+    for j in range(len(optimizer_weights)):
+        arrays['optimizer/{}'.format(j)] = values[i]
+        i += 1
+    info = {
+        'epoch': epoch,
+        'layers': [path for path, _ in layers],
+        'num_optimizer_weights': len(optimizer_weights),
+    }
+    info.update(meta or {})
+    arrays[meta_key] = np.array(json.dumps(info))
+    return arrays
+
+def write(path, arrays):
+    # write next to the target and rename, so a preempted write never replaces a good checkpoint
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, **arrays)
+    os.rename(tmp_path, path)
+
+def read_meta(path):
+    with np.load(path) as data:
+        return json.loads(str(data[meta_key]))
+
+def restore(model, path):
+    # loads a checkpoint into a freshly built and compiled model; returns the epoch to resume at
+    layers_by_path = dict(trainable_layers(model))
+    with np.load(path) as data:
+        info = json.loads(str(data[meta_key]))
+        for layer_path in info['layers']:
+            if layer_path not in layers_by_path:
+                raise ValueError('checkpoint layer {} is not a trainable layer of the model'.format(layer_path))
+            layer = layers_by_path[layer_path]
+            layer.set_weights([data['layer/{}/{}'.format(layer_path, j)] for j in range(len(layer.weights))])
+        if info['num_optimizer_weights']:
+            # keras creates the optimizer's slots lazily with the training function
+            model._make_train_function()
+            model.optimizer.set_weights([data['optimizer/{}'.format(j)] for j in range(info['num_optimizer_weights'])])
+    print('restored {} layers and optimizer state from {} (epoch {})'.format(len(info['layers']), path, info['epoch'] + 1))
+    return info['epoch'] + 1
+
+class AsyncCheckpoint(Callback):
+    # snapshots at the end of every epoch and writes on a background thread, so training
+    # only waits for the in-memory copy (and for the previous write, if it is still going)
+    def __init__(self, path, meta=None, period=1):
+        super(AsyncCheckpoint, self).__init__()
+        self.path = path
+        self.meta = meta
+        self.period = period
+        self.thread = None
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def on_epoch_end(self, epoch, logs=None):
+        if (epoch + 1) % self.period != 0:
+            return
+        start = time.time()
+        self.wait()
+        arrays = snapshot(self.model, epoch, self.meta)
+        blocked = time.time() - start
+
+        def run():
+            write_start = time.time()
+            write(self.path, arrays)
+            size = os.path.getsize(self.path)
+            print('\ncheckpoint for epoch {}: {:.1f} MB, {:.3f}s blocking, {:.2f}s written in background'.format(
+                epoch + 1, size / (1024. * 1024.), blocked, time.time() - write_start))
+        self.thread = threading.Thread(target=run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def on_train_end(self, logs=None):
+        self.wait()
@@ -9,20 +9,20 @@ import os
 import argparse
 import json
 import pickle
+import time
 import numpy as np
-import matplotlib.pyplot as plt
 from itertools import product
 import PIL
 from PIL import Image, ImageOps
-from keras.applications import VGG16
-from keras import models
-from keras import layers
-from keras import optimizers
-from keras.utils.vis_utils import plot_model
-from keras.callbacks import ModelCheckpoint, EarlyStopping
-from sklearn.metrics import confusion_matrix
-from vis.visualization import visualize_saliency
-plt.switch_backend('agg')
+import async_eval
+import autotune
+import distributed
+import memory_profile
+import manifest
+import pyramid
+import serving_metrics
+# keras, matplotlib and sklearn are imported by the modes that use them, so -h and
+# argument errors return immediately
 
 NUM_CLASSES=20
 train_path_default = "train.json"
@@ -40,45 +40,64 @@ acc_output = "/acc.png"
 loss_output = "/loss.png"
 confused_output = "/confused.png"
 saliency_output = "/saliency.png"
+saliency_batch_output = "/saliency/"
+saliency_index_output = "index.csv"
+saliency_batch_size_default = 32
+memory_output = "/memory.json"
 
 learning_rate_default = 1e-4
 epochs_default = 15
 
 #*********************************** HELPERS ***********************************
-def get_data(json_path):
+@memory_profile.phased('load')
+def get_data(json_path, shard=False):
     X_train = []
     y_train = []
-    with open(json_path) as f:
-        data = json.load(f)
-        for post in data['posts']:
-            path = post['path']
-            label = post['subreddit']
-            img = np.array(Image.open(path))
-            X_train.append(img)
-
-            one_hot = np.zeros(NUM_CLASSES)
-            one_hot[label] = 1
-            y_train.append(one_hot)
+    columns = manifest.load_columns(json_path, ['path', 'subreddit'])
+    rows = list(zip(columns['path'], columns['subreddit']))
+    if shard:
+        # this worker's part of the data when training data-parallel
+        rows = distributed.shard(rows)
+    for path, label in rows:
+        img = np.array(Image.open(path))
+        X_train.append(img)
+
+        one_hot = np.zeros(NUM_CLASSES)
+        one_hot[label] = 1
+        y_train.append(one_hot)
 
     X_train = np.array(X_train)
     y_train = np.array(y_train)
 
     return X_train, y_train
 
+def get_image_size(json_path):
+    # every post is preprocessed to the same resolution, so the first image is enough
+    return Image.open(manifest.load_columns(json_path, ['path'])['path'][0]).size
+
+def load_image(path, size):
+    img = Image.open(path).convert('RGB')
+    if img.size != size:
+        img = ImageOps.fit(img, size, Image.ANTIALIAS)
+    return np.array(img)
+
+def pyplot():
+    import matplotlib.pyplot as plt
+    plt.switch_backend('agg')
+    return plt
+
 def get_subreddit_indices_map(path):
-    with open(path) as f:
-        data = json.load(f)
-        return data['subreddit_indices_map']
+    return manifest.get_subreddit_indices_map(path)
 
 def get_subreddit_for_index(index):
-    subreddit_indices_map = get_subreddit_indices_map(train_path_default)
-    reverse_map = {}
-    for k, v in subreddit_indices_map.items():
-        reverse_map[v] = k
-    return reverse_map[index]
-
-def create_model(size):
-    vgg_conv = VGG16(weights='imagenet', include_top=False, input_shape=(size, size, 3))
+    return manifest.get_subreddit_for_index(index, train_path_default)
+
+@memory_profile.phased('build model')
+def create_model(size, weights='imagenet'):
+    from keras.applications import VGG16
+    from keras import models
+    from keras import layers
+    vgg_conv = VGG16(weights=weights, include_top=False, input_shape=(size, size, 3))
     for layer in vgg_conv.layers[:-4]:
         layer.trainable = False
     model = models.Sequential()
@@ -92,6 +111,7 @@ def create_model(size):
     return model
 
 def plot_history(history, config):
+    plt = pyplot()
     plt.gcf().clear()
     plt.plot(history['acc'], 'ro', markersize=12)
     plt.plot(history['val_acc'], 'go', markersize=12)
@@ -112,17 +132,22 @@ def plot_history(history, config):
     # plt.show()
 
 def score(config):
+    from keras import optimizers
     X_train, y_train = get_data(config.train_path)
     X_val, y_val = get_data(validation_path)
     model = create_model(X_train.shape[1])
     model.load_weights(config.path + best_weights)
     model.compile(loss='categorical_crossentropy', optimizer=optimizers.Adam(lr=config.l), metrics=['accuracy'])
-    scores = model.evaluate(X_val, y_val, verbose=1)
+    with memory_profile.phase('evaluate'):
+        scores = model.evaluate(X_val, y_val, verbose=1)
     print("validation accuracy of " + str(100 * scores[1]) + "%...")
     with open(config.path + score_output, 'a') as f:
         f.write(str(100 * scores[1]) + "%\n")
     
 def plot_confusion_matrix(config):
+    from keras import optimizers
+    from sklearn.metrics import confusion_matrix
+    plt = pyplot()
     X_train, y_train = get_data(config.train_path)
     y_train = np.argmax(y_train, axis=1)
     model = create_model(X_train.shape[1])
@@ -130,7 +155,8 @@ def plot_confusion_matrix(config):
     model.compile(loss='categorical_crossentropy', optimizer=optimizers.Adam(lr=config.l), metrics=['accuracy'])
     indices_map = get_subreddit_indices_map(train_path_default)
     classes = sorted(indices_map.keys(), key=lambda k: indices_map[k])
-    preds = np.argmax(model.predict(X_train), axis=1)
+    with memory_profile.phase('predict'):
+        preds = np.argmax(model.predict(X_train), axis=1)
     cm = confusion_matrix(y_train, preds)
     plt.gcf().clear()
     plt.figure()
@@ -151,31 +177,104 @@ def plot_confusion_matrix(config):
     plt.savefig(config.path + confused_output)
     # plt.show()
 
-def plot_saliency(config):
-    X_train, y_train = get_data(config.train_path)
-    model = create_model(X_train.shape[1])
+def plot_saliency(config, model=None):
+    plt = pyplot()
+    size = get_image_size(config.train_path)
+    if model is None:
+        model = create_model(size[0])
+        model.load_weights(config.path + best_weights)
+    # the same target and normalization as the -b batch maps
+    grads, _ = create_saliency_function(model)([np.array([load_image(config.i, size)]), 0])
+    heatmap = np.uint8(plt.cm.jet(saliency_maps(grads)[0])[..., :3] * 255)
+    PIL.Image.fromarray(heatmap).save(config.path + saliency_output)
+
+def create_saliency_function(model):
+    # gradient of each image's predicted class score before the softmax (which saturates for
+    # confident predictions) w.r.t. its pixels. images in a batch don't interact (no batchnorm,
+    # dropout is off at test time), so one backward pass covers the batch
+    from keras import backend as K
+    head = model.layers[-1]
+    logits = K.bias_add(K.dot(head.input, head.kernel), head.bias)
+    predicted = K.one_hot(K.argmax(logits, axis=1), NUM_CLASSES)
+    top_score = K.sum(logits * predicted)
+    grads = K.gradients(top_score, model.input)[0]
+    return K.function([model.input, K.learning_phase()], [grads, model.output])
+
+def saliency_maps(grads):
+    # max |grad| over channels, scaled to [0, 1] per image
+    maps = np.max(np.abs(grads), axis=-1)
+    lo = maps.min(axis=(1, 2), keepdims=True)
+    hi = maps.max(axis=(1, 2), keepdims=True)
+    return (maps - lo) / np.maximum(hi - lo, 1e-7)
+
+def plot_saliency_batch(config):
+    print("computing saliency maps for " + config.b + "...")
+    plt = pyplot()
+    posts = manifest.load(config.b)['posts']
+    size = get_image_size(config.b)
+    model = create_model(size[0])
     model.load_weights(config.path + best_weights)
-    img = Image.open(config.i).convert('RGB')
-    new = ImageOps.fit(img, (X_train.shape[1], X_train.shape[2]), Image.ANTIALIAS)
-    # new.show()
-    img = np.array(new)
-    model.compile(loss='categorical_crossentropy', optimizer=optimizers.Adam(lr=config.l), metrics=['accuracy'])
-    out = visualize_saliency(model, len(model.layers) - 2, None, img, backprop_modifier=None, grad_modifier="absolute")
-    out = PIL.Image.fromarray(out)
-    # out.show()
-    out.save(config.path + saliency_output)
+    saliency = create_saliency_function(model)
+    output_dir = config.path + saliency_batch_output
+    if not os.path.isdir(output_dir):
+        os.mkdir(output_dir)
+    with open(output_dir + saliency_index_output, 'w') as index:
+        index.write('id,path,label,predicted,confidence,output\n')
+        for start in range(0, len(posts), config.bs):
+            batch = posts[start:start + config.bs]
+            imgs = np.array([load_image(post['path'], size) for post in batch])
+            grads, probs = saliency([imgs, 0])
+            maps = saliency_maps(grads)
+            preds = np.argmax(probs, axis=1)
+            if config.z:
+                output = 'batch{:06d}.npz'.format(start // config.bs)
+                np.savez_compressed(output_dir + output,
+                    maps=np.uint8(maps * 255),
+                    ids=np.array([post['id'] for post in batch]),
+                    labels=np.array([post['subreddit'] for post in batch]),
+                    predicted=preds)
+            for i, post in enumerate(batch):
+                if not config.z:
+                    output = post['id'] + '.png'
+                    heatmap = np.uint8(plt.cm.jet(maps[i])[..., :3] * 255)
+                    PIL.Image.fromarray(heatmap).save(output_dir + output)
+                index.write('{},{},{},{},{:.4f},{}\n'.format(post['id'], post['path'], post['subreddit'],
+                    preds[i], probs[i][preds[i]], output))
+            print(str(start + len(batch)) + "/" + str(len(posts)))
 
 def train(config):
     print("training model...")
-    X_train, y_train = get_data(config.train_path)
-    X_val, y_val = get_data(validation_path)
+    from keras import optimizers
+    from keras.callbacks import ModelCheckpoint, EarlyStopping
+    from profiling import StepTimeline
+    import checkpoint
+    latest_checkpoint = "/" + checkpoint.latest_checkpoint_name
+    X_train, y_train = get_data(config.train_path, shard=True)
+    # only the chief validates, checkpoints and writes logs; with --async_eval a separate
+    # evaluator does the validating
+    validation_data = get_data(validation_path) if distributed.is_chief() and not config.async_eval else None
     model = create_model(X_train.shape[1])
     model.compile(loss='categorical_crossentropy', optimizer=optimizers.Adam(lr=config.l), metrics=['accuracy'])
-    checkpoint = ModelCheckpoint(config.path + best_weights, monitor='val_acc', verbose=1, save_best_only=True, mode='max')
+    initial_epoch = 0
+    if os.path.exists(config.path + latest_checkpoint):
+        # the frozen VGG16 blocks come back from the imagenet weights
+        initial_epoch = checkpoint.restore(model, config.path + latest_checkpoint)
+        print("resuming training on epoch " + str(initial_epoch + 1))
+    initial_epoch = distributed.broadcast(initial_epoch)
+    best_checkpoint = ModelCheckpoint(config.path + best_weights, monitor='val_acc', verbose=1, save_best_only=True, mode='max')
+    resume_checkpoint = checkpoint.AsyncCheckpoint(config.path + latest_checkpoint, meta={'backbone': 'vgg16/imagenet', 'size': X_train.shape[1]})
     early_stopping = EarlyStopping(monitor='val_loss', patience=2)
-    history = model.fit(X_train, y_train, validation_data=(X_val, y_val), batch_size=32, epochs=config.n, callbacks=[checkpoint], verbose=1)
-    with open(config.path + model_history, 'wb') as f:
-        pickle.dump(history.history, f)
+    timeline = StepTimeline(config.path, log_dir=config.path)
+    if config.async_eval:
+        from async_validation import AsyncValidation
+        best_checkpoint = AsyncValidation(config.path + '/', async_eval.spec(config, 'classifier', validation_path, config.path + best_weights,
+            'val_acc', 'max', 32, pyramid.selected_resolution, size=X_train.shape[1]), config.eval_patience)
+    with memory_profile.phase('fit'):
+        callbacks = distributed.callbacks([best_checkpoint, resume_checkpoint, timeline], config.sync_every, config.path)
+        history = model.fit(X_train, y_train, validation_data=validation_data, batch_size=32, epochs=config.n, initial_epoch=initial_epoch, callbacks=callbacks, verbose=1)
+    if distributed.is_chief():
+        with open(config.path + model_history, 'wb') as f:
+            pickle.dump(history.history, f)
     
 def evaluate(config):
     print("evaluating model...")
@@ -186,18 +285,39 @@ def evaluate(config):
 
 def predict(config):
     print("predicting class for image...")
-    X_train, y_train = get_data(config.train_path)
-    model = create_model(X_train.shape[1])
-    model.load_weights(config.path + best_weights)
-    img = Image.open(config.i).convert('RGB')
-    new = ImageOps.fit(img, (X_train.shape[1], X_train.shape[2]), Image.ANTIALIAS)
-    img = np.array(new)
-    pred = model.predict(np.array([img]))[0]
+    exported = None
+    if config.a:
+        # everything from one exported file (artifact.py): no imagenet weights, no train.json
+        import artifact
+        exported = artifact.load(config.a, kinds=artifact.classifier_kinds)
+        model = exported.model
+    elif config.d:
+        # the small cpu model distilled from this experiment's classifier (distill.py)
+        import distill
+        model, size = distill.load_student(config.path)
+    else:
+        size = get_image_size(config.train_path)
+        model = create_model(size[0])
+        model.load_weights(config.path + best_weights)
+    start = time.time()
+    if exported:
+        img = exported.load_image(config.i)
+    else:
+        img = Image.open(config.i).convert('RGB')
+        new = ImageOps.fit(img, size, Image.ANTIALIAS)
+        img = np.array(new)
+    model_name = exported.kind if exported else 'student' if config.d else 'vgg16'
+    with memory_profile.phase('predict'):
+        serving_metrics.observe('batch_size', 1, model=model_name)
+        pred = model.predict(np.array([img]))[0]
+    serving_metrics.inc('predict_requests_total', model=model_name)
+    serving_metrics.observe('predict_seconds', time.time() - start, model=model_name)
     print(pred)
     label_i = np.argmax(pred)
-    label = get_subreddit_for_index(label_i)
+    label = exported.labels[label_i] if exported else get_subreddit_for_index(label_i)
     print("predictiing[" + str(label_i) + "]: " + label)
-    plot_saliency(config)
+    if not (config.d or config.a):
+        plot_saliency(config, model)
 
 #************************************ MAIN *************************************
 if __name__ == "__main__":
@@ -211,12 +331,28 @@ if __name__ == "__main__":
     parser.add_argument("-n", type=int, help="number of epochs to run")
     parser.add_argument("-e", action="store_true", help="evaluate classifier")
     parser.add_argument("-i", type=str, help='path of img to predict')
+    parser.add_argument("-m", action="store_true", help="trace numpy allocations in the memory report")
+    parser.add_argument("-b", type=str, help='json of posts to compute saliency maps for')
+    parser.add_argument("-bs", type=int, help='batch size for saliency maps')
+    parser.add_argument("-z", action="store_true", help="write saliency maps as compressed arrays instead of pngs")
+    parser.add_argument("-d", action="store_true", help="predict with the distilled student (see distill.py)")
+    parser.add_argument("-a", type=str, help="predict with an exported model artifact (see artifact.py)")
+    parser.add_argument("-r", type=int, help="image resolution, i.e. pyramid level to load (default: the pyramid's default level)")
+    distributed.add_arguments(parser)
+    serving_metrics.add_arguments(parser)
+    autotune.add_arguments(parser)
+    async_eval.add_arguments(parser)
     config = parser.parse_args()
 
     if len(sys.argv) <= 1:
         print('Invalid mode! Aborting...')
         print("example usage: ")
         print("python classifier.py -t -l=5e-5 -n=20 -e -i=datasets/cats50.jpg")
+        print("python classifier.py -p=001 -b=validation.json -bs=32")
+        print("python classifier.py -t -r=224")
+        print("python classifier.py -t --workers=4 --sync_every=4")
+        print("python classifier.py -t --async_eval --eval_sample=1000 --eval_patience=3")
+        print("python classifier.py -p=001 -i=datasets/cats50.jpg -a=classifier-001.rnet")
 
     else:
         if config.p:
@@ -231,6 +367,7 @@ if __name__ == "__main__":
                 config.path = experiments_path + test_path
             os.mkdir(config.path);
 
+        pyramid.select(config.r)
         config.train_path = train_path_default
         if config.s:
             config.train_path = train_small_path_default
@@ -238,12 +375,31 @@ if __name__ == "__main__":
             config.l = learning_rate_default
         if config.n == None:
             config.n = epochs_default
+        if config.bs == None:
+            config.bs = saliency_batch_size_default
         print(config)
         with open(config.path + config_path, "w") as f:  
             json.dump(vars(config), f)
-        if config.t:
-            train(config)
-        if config.e:
-            evaluate(config)
-        if config.i:
-            predict(config)
\ No newline at end of file
+        if not (config.t and distributed.should_launch(config)):
+            autotune.apply('fit' if config.t else 'predict', config)
+        memory_profile.start(config.path + memory_output, trace=config.m)
+        serving_metrics.start_from_config(config)
+        try:
+            if config.t:
+                with memory_profile.phase('train'):
+                    if distributed.should_launch(config):
+                        distributed.launch('classifier', 'train', config, pyramid.selected_resolution)
+                    else:
+                        train(config)
+            if config.e:
+                with memory_profile.phase('evaluate'):
+                    evaluate(config)
+            if config.i:
+                with memory_profile.phase('predict'):
+                    predict(config)
+            if config.b:
+                with memory_profile.phase('saliency'):
+                    plot_saliency_batch(config)
+        finally:
+            serving_metrics.stop()
+            memory_profile.stop()
\ No newline at end of file
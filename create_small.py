@@ -1,15 +1,141 @@
 #!//usr/bin/python
+import argparse
+import heapq
 import json
+from collections import defaultdict
+
 import numpy as np
 
-with open('train.json') as f:
-    NUM_EXAMPLES = 500
-    data = json.load(f)
-    posts = data['posts']
-    indices = np.random.choice(len(posts), NUM_EXAMPLES)
-    small_posts = []
-    for i in indices:
-      small_posts.append(posts[i])
-    data['posts'] = small_posts
-    with open('small_train.json', 'w') as f:
-        json.dump(data, f)
+import manifest
+
+source_default = 'train.json'
+size_default = 500
+seed_default = 0
+# standard deviations of slack above a fraction when keeping candidate keys
+fraction_slack = 4.
+
+def iter_labels(source):
+    # streams (position in split, label) pairs: straight off the memory mapped label column
+    # when the split lives in the manifest, otherwise from the json file
+    m = manifest.find(source)
+    if m is not None:
+        indices = m.indices(manifest.split_name(source))
+        labels = m.column('subreddit')
+        for position, i in enumerate(indices):
+            yield position, int(labels[i])
+    else:
+        for i, post in enumerate(manifest.load(source, resolve_paths=False)['posts']):
+            yield i, post['subreddit']
+
+def quotas(counts, size):
+    # proportional per-subreddit quotas summing exactly to size (largest remainder)
+    total = float(sum(counts.values()))
+    exact = {label: size * count / total for label, count in counts.items()}
+    result = {label: min(int(q), counts[label]) for label, q in exact.items()}
+    remaining = size - sum(result.values())
+    by_remainder = sorted(exact, key=lambda label: (result[label] - exact[label], label))
+    for label in by_remainder:
+        if remaining <= 0:
+            break
+        if result[label] < counts[label]:
+            result[label] += 1
+            remaining -= 1
+    return result
+
+def fraction_bound(fraction, count):
+    # the round(fraction * count) smallest of count uniform keys lie below this, barring a
+    # 4 sigma fluctuation; it only falls as count grows, so no key it rejected is needed later
+    return fraction + fraction_slack * np.sqrt(fraction * (1 - fraction) / count)
+
+def sample(source, sizes=(), fractions=(), seed=seed_default):
+    # one pass with a per-subreddit bottom-k reservoir over seeded random keys: the subset of
+    # any size is the k smallest keys of each subreddit, so every requested size comes out of
+    # the same pass and smaller subsets are nested inside larger ones
+    return sample_labels(iter_labels(source), sizes, fractions, seed)
+
+def sample_labels(labels, sizes=(), fractions=(), seed=seed_default):
+    # sample() over any (position, label) pairs, e.g. the posts of a split already loaded
+    rng = np.random.RandomState(seed)
+    counts = defaultdict(int)
+    # fractions keep only the keys below the bound of the largest one: the f-subset is the
+    # round(f * count) smallest keys of each subreddit, stratified and nested like the sizes,
+    # in memory proportional to the subsets themselves
+    largest_fraction = max(fractions) if fractions else 0.
+    candidates = defaultdict(list)
+    # heaps hold (-key, index), capped at the largest possible quota of any requested size
+    reservoirs = defaultdict(list)
+    capacity = max(sizes) if sizes else 0
+    for index, label in labels:
+        counts[label] += 1
+        key = rng.random_sample()
+        if fractions and key < fraction_bound(largest_fraction, counts[label]):
+            candidates[label].append((key, index))
+        if capacity:
+            reservoir = reservoirs[label]
+            if len(reservoir) < capacity:
+                heapq.heappush(reservoir, (-key, index))
+            elif -reservoir[0][0] > key:
+                heapq.heapreplace(reservoir, (-key, index))
+
+    subsets = {}
+    for size in sizes:
+        subset = []
+        for label, count in quotas(counts, min(size, sum(counts.values()))).items():
+            smallest = sorted(reservoirs[label], reverse=True)[:count]
+            subset.extend(index for _, index in smallest)
+        subsets['size', size] = sorted(subset)
+    for label in candidates:
+        candidates[label].sort()
+    for f in fractions:
+        subset = []
+        for label, keys in candidates.items():
+            subset.extend(index for _, index in keys[:int(round(f * counts[label]))])
+        subsets['fraction', f] = sorted(subset)
+    return subsets, counts
+
+def subset_name(kind, value, names, default):
+    if len(names) > 0:
+        return names.pop(0)
+    if default is not None:
+        return default
+    return 'small_train_{}'.format(value if kind == 'size' else '{:g}pct'.format(100 * value))
+
+def write_subset(source, name, indices, write_json):
+    m = manifest.find(source)
+    if m is not None:
+        # subsets of a manifest split are index lists into the same manifest
+        split_indices = np.asarray(m.indices(manifest.split_name(source)))[indices]
+        m.write_split(name, split_indices)
+        if not write_json:
+            return
+        posts = [m.post(i) for i in split_indices]
+        key = m.subreddit_indices_map
+    else:
+        data = manifest.load(source, resolve_paths=False)
+        posts = [data['posts'][i] for i in indices]
+        key = data['subreddit_indices_map']
+    with open(name + '.json', 'w') as f:
+        json.dump({'posts': posts, 'subreddit_indices_map': key}, f)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='build stratified, seeded subsets of a split in one streaming pass')
+    parser.add_argument('--source', type=str, default=source_default, help='split to sample from')
+    parser.add_argument('--sizes', type=int, nargs='*', default=[], help='subset sizes')
+    parser.add_argument('--fractions', type=float, nargs='*', default=[], help='subset fractions of the source')
+    parser.add_argument('--names', type=str, nargs='*', default=[], help='split names for the subsets, in order sizes then fractions')
+    parser.add_argument('--seed', type=int, default=seed_default, help='random seed')
+    parser.add_argument('--json', action='store_true', help='also write <name>.json for each subset')
+    args = parser.parse_args()
+
+    if not args.sizes and not args.fractions:
+        args.sizes = [size_default]
+    # a single subset keeps the old small_train name
+    single = len(args.sizes) + len(args.fractions) == 1
+    subsets, counts = sample(args.source, args.sizes, args.fractions, args.seed)
+    print('{} posts in {} subreddits'.format(sum(counts.values()), len(counts)))
+    names = list(args.names)
+    for kind, value in [('size', s) for s in args.sizes] + [('fraction', f) for f in args.fractions]:
+        name = subset_name(kind, value, names, 'small_train' if single else None)
+        indices = subsets[kind, value]
+        write_subset(args.source, name, indices, args.json or manifest.find(args.source) is None)
+        print('{}: {} posts'.format(name, len(indices)))
@@ -0,0 +1,218 @@
+import argparse
+import io
+import json
+import os
+
+import numpy as np
+from PIL import Image
+
+import manifest
+
+# near-duplicate (repost) detection: 64 bit perceptual hashes in a multi-index hash table.
+# the hash is split into threshold + 1 chunks; two hashes within `threshold` bits must agree
+# exactly on at least one chunk (pigeonhole), so lookups only compare against bucket members
+index_path_default = 'datasets.dedup.npz'
+threshold_default = 6
+hash_bits = 64
+popcount8 = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+def dct_matrix(n):
+    k = np.arange(n)
+    m = np.cos(np.pi * (2 * k[None, :] + 1) * k[:, None] / (2. * n)) * np.sqrt(2. / n)
+    m[0] /= np.sqrt(2)
+    return m
+
+dct32 = dct_matrix(32)
+
+def pack_bits(bits):
+    return int(np.packbits(bits.astype(np.uint8).ravel()).view('>u8')[0])
+
+def dhash(img):
+    gray = np.asarray(img.convert('L').resize((9, 8), Image.BILINEAR), dtype=np.int16)
+    return pack_bits(gray[:, 1:] > gray[:, :-1])
+
+def phash(img):
+    gray = np.asarray(img.convert('L').resize((32, 32), Image.BILINEAR), dtype=np.float64)
+    low = dct32.dot(gray).dot(dct32.T)[:8, :8]
+    # median without the dc term, which only carries overall brightness
+    return pack_bits(low > np.median(low.ravel()[1:]))
+
+hash_functions = {'phash': phash, 'dhash': dhash}
+
+def hash_image(img, method='phash'):
+    return hash_functions[method](img)
+
+def hash_bytes(data, method='phash'):
+    return hash_image(Image.open(io.BytesIO(data)), method)
+
+def hamming(a, hashes):
+    xor = np.bitwise_xor(np.asarray(hashes, dtype=np.uint64), np.uint64(a))
+    return popcount8[xor.view(np.uint8)].reshape(-1, 8).sum(axis=1)
+
+class DuplicateIndex(object):
+    def __init__(self, threshold=threshold_default, method='phash'):
+        self.threshold = threshold
+        self.method = method
+        num_chunks = threshold + 1
+        bounds = np.linspace(0, hash_bits, num_chunks + 1).astype(int)
+        self.chunks = [(int(lo), (1 << int(hi - lo)) - 1) for lo, hi in zip(bounds[:-1], bounds[1:])]
+        self.tables = [{} for _ in self.chunks]
+        self.hashes = np.zeros(1024, dtype=np.uint64)
+        self.parents = np.zeros(1024, dtype=np.int64)
+        self.keys = []
+        self.ids_by_key = {}
+
+    def __len__(self):
+        return len(self.keys)
+
+    def chunk_values(self, h):
+        return [(h >> shift) & mask for shift, mask in self.chunks]
+
+    def find(self, i):
+        # union-find root with path halving
+        parents = self.parents
+        while parents[i] != i:
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return int(i)
+
+    def query(self, h, exclude=None):
+        # ids of indexed images within threshold of h, nearest first, leaving out key exclude
+        candidates = []
+        for table, value in zip(self.tables, self.chunk_values(h)):
+            candidates.extend(table.get(value, ()))
+        if exclude in self.ids_by_key:
+            candidates = [i for i in candidates if i != self.ids_by_key[exclude]]
+        if not candidates:
+            return []
+        candidates = np.unique(candidates)
+        distances = hamming(h, self.hashes[candidates])
+        close = distances <= self.threshold
+        order = np.argsort(distances[close], kind='stable')
+        return [(int(i), int(d)) for i, d in zip(candidates[close][order], distances[close][order])]
+
+    def insert(self, h, key, parent=None):
+        i = len(self.keys)
+        if i == len(self.hashes):
+            self.hashes = np.concatenate([self.hashes, np.zeros_like(self.hashes)])
+            self.parents = np.concatenate([self.parents, np.zeros_like(self.parents)])
+        self.hashes[i] = h
+        self.parents[i] = i if parent is None else parent
+        self.keys.append(key)
+        self.ids_by_key[key] = i
+        for table, value in zip(self.tables, self.chunk_values(h)):
+            table.setdefault(value, []).append(i)
+        return i
+
+    def rehash(self, i, h):
+        # moves entry i to the buckets of its new hash; its cluster links stay
+        for table, value in zip(self.tables, self.chunk_values(int(self.hashes[i]))):
+            table[value].remove(i)
+        self.hashes[i] = h
+        for table, value in zip(self.tables, self.chunk_values(h)):
+            table.setdefault(value, []).append(i)
+
+    def add(self, h, key):
+        # returns (cluster id, matches); reposts of any cluster member join that cluster.
+        # a key already indexed (the same post crawled again) is updated, not added twice,
+        # and never matches itself
+        matches = self.query(h, exclude=key)
+        if key in self.ids_by_key:
+            i = self.ids_by_key[key]
+            if int(self.hashes[i]) != h:
+                self.rehash(i, h)
+        else:
+            i = self.insert(h, key)
+        for j, _ in matches:
+            self.parents[self.find(j)] = self.find(i)
+        return self.find(i), matches
+
+    def add_image(self, img, key):
+        return self.add(hash_image(img, self.method), key)
+
+    def contains(self, key):
+        return key in self.ids_by_key
+
+    def cluster_of(self, key):
+        if key not in self.ids_by_key:
+            return None
+        return self.find(self.ids_by_key[key])
+
+    def clusters(self):
+        groups = {}
+        for i, key in enumerate(self.keys):
+            groups.setdefault(self.find(i), []).append(key)
+        return groups
+
+    def save(self, path):
+        n = len(self.keys)
+        tmp_path = path + '.tmp.npz'
+        np.savez(tmp_path,
+            hashes=self.hashes[:n],
+            parents=self.parents[:n],
+            keys=np.array(self.keys, dtype=object).astype('U'),
+            meta=np.array(json.dumps({'threshold': self.threshold, 'method': self.method})))
+        os.rename(tmp_path, path)
+
+def load(path=index_path_default, threshold=threshold_default, method='phash'):
+    if not os.path.exists(path):
+        return DuplicateIndex(threshold, method)
+    data = np.load(path)
+    meta = json.loads(str(data['meta']))
+    index = DuplicateIndex(meta['threshold'], meta['method'])
+    for h, key, parent in zip(data['hashes'].tolist(), data['keys'].tolist(), data['parents'].tolist()):
+        index.insert(h, key, parent)
+    return index
+
+def assign_splits(keys, index, fractions, rng):
+    # shuffle whole duplicate clusters, then cut: every cluster lands in exactly one split
+    clusters = {}
+    for position, key in enumerate(keys):
+        cluster = index.cluster_of(key)
+        # posts missing from the index still group by key, e.g. augmented copies of a post
+        cluster = ('post', key) if cluster is None else ('cluster', cluster)
+        clusters.setdefault(cluster, []).append(position)
+    groups = list(clusters.values())
+    rng.shuffle(groups)
+    bounds = np.cumsum(fractions) * len(keys)
+    splits = [[] for _ in fractions]
+    seen = 0
+    for group in groups:
+        split = min(int(np.searchsorted(bounds, seen, side='right')), len(splits) - 1)
+        splits[split].extend(group)
+        seen += len(group)
+    return splits
+
+def build(json_path, index_path, threshold, method):
+    index = load(index_path, threshold, method)
+    posts = manifest.load(json_path, resolve_paths=False)['posts']
+    duplicates = 0
+    for post in posts:
+        if index.contains(post['id']):
+            continue
+        try:
+            _, matches = index.add_image(Image.open(post['path']), post['id'])
+        except IOError as e:
+            print('could not hash {}: {}'.format(post['path'], e))
+            continue
+        if matches:
+            duplicates += 1
+            print('{} duplicates {}'.format(post['id'], index.keys[matches[0][0]]))
+    index.save(index_path)
+    print('{} images indexed, {} near-duplicates, {} clusters'.format(len(index), duplicates, len(index.clusters())))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='perceptual hash near-duplicate index for crawled images')
+    parser.add_argument('--build', type=str, help='add every image of this post json/split to the index, keyed by post id')
+    parser.add_argument('--query', type=str, help='image to look up')
+    parser.add_argument('--index', type=str, default=index_path_default, help='index file')
+    parser.add_argument('--threshold', type=int, default=threshold_default, help='max hamming distance for a near-duplicate')
+    parser.add_argument('--method', type=str, default='phash', choices=sorted(hash_functions.keys()), help='hash function for a new index')
+    args = parser.parse_args()
+
+    if args.build:
+        build(args.build, args.index, args.threshold, args.method)
+    if args.query:
+        index = load(args.index, args.threshold, args.method)
+        for i, distance in index.query(hash_image(Image.open(args.query), index.method)):
+            print('{} (distance {})'.format(index.keys[i], distance))
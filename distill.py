@@ -0,0 +1,220 @@
+import argparse
+import json
+import os
+
+import numpy as np
+
+import bench_utils
+import classifier
+import manifest
+import memory_profile
+import pyramid
+
+# distills the VGG16 classifier of an experiment (classifier.py) into a small separable-
+# convolution network at a lower resolution for CPU serving. the teacher's predictions on
+# the training split are computed once and cached; the student trains on them softened by
+# a temperature, plus the true labels
+teacher_cache_file = '/teacher-{}.npz'
+student_weights = '/student.h5'
+student_config = '/student.json'
+report_output = '/distill.json'
+memory_output = '/distill-memory.json'
+size_default = 128
+width_default = 1.0
+temperature_default = 4.0
+alpha_default = 0.1
+epochs_default = 30
+learning_rate_default = 1e-3
+batch_size_default = 64
+latency_repeat = 20
+# (filters, stride) of the separable blocks after the stem
+blocks = [(64, 1), (128, 2), (128, 1), (256, 2), (256, 1), (512, 2), (512, 1)]
+
+def load_images(paths, size):
+    return np.array([classifier.load_image(path, (size, size)) for path in paths])
+
+def load_split(json_path, size, ids=None, images=True):
+    # the pyramid level closest above the student's resolution, so the resize stays cheap.
+    # levels may quarantine different posts, so ids limits the split to posts known elsewhere.
+    # returns (post ids, images or None, labels), all in split order
+    above = [r for r in pyramid.levels() if r >= size]
+    columns = manifest.load_columns(json_path, ['id', 'path', 'subreddit'], resolution=min(above) if above else None)
+    positions = range(len(columns['id']))
+    if ids is not None:
+        ids = set(ids)
+        positions = [i for i in positions if columns['id'][i] in ids]
+    paths = [columns['path'][i] for i in positions]
+    return ([columns['id'][i] for i in positions], load_images(paths, size) if images else None,
+        columns['subreddit'][np.asarray(positions, dtype=np.int64)])
+
+def cache_teacher(config, json_path):
+    # (post ids, teacher log probabilities) for every post of the split at the teacher's level
+    path = config.path + teacher_cache_file.format(manifest.split_name(json_path))
+    columns = manifest.load_columns(json_path, ['id', 'path'])
+    paths = columns['path']
+    ids = np.array(columns['id'])
+    if os.path.exists(path):
+        with np.load(path) as cached:
+            if np.array_equal(cached['ids'], ids):
+                print('teacher predictions cached in ' + path)
+                return ids, cached['log_probs']
+    size = classifier.get_image_size(json_path)
+    teacher = classifier.create_model(size[0])
+    teacher.load_weights(config.path + classifier.best_weights)
+    log_probs = np.zeros((len(paths), classifier.NUM_CLASSES), dtype=np.float32)
+    with memory_profile.phase('teacher predictions'):
+        for start in range(0, len(paths), config.batch_size):
+            batch = paths[start:start + config.batch_size]
+            probs = teacher.predict(load_images(batch, size[0]), batch_size=len(batch))
+            log_probs[start:start + len(batch)] = np.log(np.maximum(probs, 1e-12))
+            print('teacher {}/{}'.format(start + len(batch), len(paths)))
+    np.savez(path, ids=ids, log_probs=log_probs)
+    return ids, log_probs
+
+def scale_pixels(x):
+    # the classifiers see raw 0-255 pixels; the student normalizes them itself
+    return x / 127.5 - 1.
+
+@memory_profile.phased('build model')
+def create_student(size, width=width_default):
+    # returns (logits model to train, softmax model to predict with), sharing their layers
+    from keras.layers import Activation, BatchNormalization, Conv2D, Dense, Dropout, GlobalAveragePooling2D, Input, Lambda, SeparableConv2D
+    from keras.models import Model
+    inputs = Input(shape=(size, size, 3))
+    x = Lambda(scale_pixels)(inputs)
+    x = Conv2D(int(32 * width), 3, strides=2, padding='same', use_bias=False)(x)
+    x = Activation('relu')(BatchNormalization()(x))
+    for filters, stride in blocks:
+        x = SeparableConv2D(int(filters * width), 3, strides=stride, padding='same', use_bias=False)(x)
+        x = Activation('relu')(BatchNormalization()(x))
+    x = GlobalAveragePooling2D()(x)
+    x = Dropout(0.25)(x)
+    logits = Dense(classifier.NUM_CLASSES, name='logits')(x)
+    return Model(inputs, logits), Model(inputs, Activation('softmax')(logits))
+
+def distillation_loss(temperature, alpha):
+    # y_true is [one-hot label, teacher log probabilities]; the soft term is scaled by T^2 so
+    # its gradients keep their size whatever the temperature
+    from keras import backend as K
+    def loss(y_true, logits):
+        labels, teacher_log_probs = y_true[:, :classifier.NUM_CLASSES], y_true[:, classifier.NUM_CLASSES:]
+        soft_targets = K.softmax(teacher_log_probs / temperature)
+        soft_log_probs = logits / temperature - K.logsumexp(logits / temperature, axis=1, keepdims=True)
+        log_probs = logits - K.logsumexp(logits, axis=1, keepdims=True)
+        hard = -K.sum(labels * log_probs, axis=1)
+        soft = -K.sum(soft_targets * soft_log_probs, axis=1)
+        return alpha * hard + (1 - alpha) * temperature * temperature * soft
+    return loss
+
+def label_accuracy(y_true, logits):
+    from keras import backend as K
+    return K.cast(K.equal(K.argmax(y_true[:, :classifier.NUM_CLASSES]), K.argmax(logits)), K.floatx())
+
+def one_hot(labels):
+    y = np.zeros((len(labels), classifier.NUM_CLASSES), dtype=np.float32)
+    y[np.arange(len(labels)), labels] = 1
+    return y
+
+def train(config):
+    from keras.callbacks import ModelCheckpoint
+    from keras.optimizers import Adam
+    teacher_ids, teacher_log_probs = cache_teacher(config, config.train_path)
+    ids, X_train, labels = load_split(config.train_path, config.size, ids=teacher_ids)
+    # teacher rows by post id; posts missing from either level are left out
+    rows = {post_id: i for i, post_id in enumerate(teacher_ids)}
+    teacher_log_probs = teacher_log_probs[[rows[post_id] for post_id in ids]]
+    if len(ids) < len(teacher_ids):
+        print('{} of {} posts with teacher predictions are missing at the student resolution'.format(len(teacher_ids) - len(ids), len(teacher_ids)))
+    _, X_val, val_labels = load_split(classifier.validation_path, config.size)
+    # validation accuracy only uses the labels; its soft half is a (uniform) placeholder
+    y_train = np.concatenate([one_hot(labels), teacher_log_probs], axis=1)
+    y_val = np.concatenate([one_hot(val_labels), np.zeros((len(val_labels), classifier.NUM_CLASSES), dtype=np.float32)], axis=1)
+    model, _ = create_student(config.size, config.width)
+    model.summary()
+    model.compile(loss=distillation_loss(config.temperature, config.alpha), optimizer=Adam(lr=config.l), metrics=[label_accuracy])
+    with open(config.path + student_config, 'w') as f:
+        json.dump({'size': config.size, 'width': config.width, 'temperature': config.temperature, 'alpha': config.alpha}, f)
+    best = ModelCheckpoint(config.path + student_weights, monitor='val_label_accuracy', verbose=1, save_best_only=True, mode='max', save_weights_only=True)
+    with memory_profile.phase('fit'):
+        model.fit(X_train, y_train, validation_data=(X_val, y_val), batch_size=config.batch_size, epochs=config.n, callbacks=[best], verbose=1)
+
+def load_student(path):
+    # (softmax model, image size) of the student distilled in an experiment directory
+    with open(path + student_config) as f:
+        info = json.load(f)
+    model, predict_model = create_student(info['size'], info['width'])
+    model.load_weights(path + student_weights)
+    return predict_model, (info['size'], info['size'])
+
+def latency(model, imgs, batch_size):
+    batch = imgs[:batch_size]
+    times = bench_utils.timed(lambda: model.predict(batch, batch_size=len(batch)), repeat=latency_repeat, warmup=2)
+    return bench_utils.summarize(times, len(batch))
+
+def report(config):
+    # accuracy, agreement and CPU latency of the student next to its teacher on validation
+    teacher_size = classifier.get_image_size(classifier.validation_path)[0]
+    teacher = classifier.create_model(teacher_size)
+    teacher.load_weights(config.path + classifier.best_weights)
+    student, student_size = load_student(config.path)
+    # the levels may quarantine different posts: the teacher's posts that the student's level has too
+    student_ids, _, _ = load_split(classifier.validation_path, student_size[0], images=False)
+    ids, X_teacher, labels = load_split(classifier.validation_path, teacher_size, ids=student_ids)
+    _, X_student, _ = load_split(classifier.validation_path, student_size[0], ids=ids)
+    teacher_preds = np.argmax(teacher.predict(X_teacher, batch_size=config.batch_size), axis=1)
+    student_preds = np.argmax(student.predict(X_student, batch_size=config.batch_size), axis=1)
+    results = {}
+    for name, model, size, imgs, preds in [('teacher', teacher, teacher_size, X_teacher, teacher_preds),
+            ('student', student, student_size[0], X_student, student_preds)]:
+        results[name] = {
+            'size': size,
+            'params': model.count_params(),
+            'accuracy': float(np.mean(preds == labels)),
+            'latency_batch1': latency(model, imgs, 1),
+            'latency_batch{}'.format(config.batch_size): latency(model, imgs, config.batch_size),
+        }
+    results['agreement'] = float(np.mean(teacher_preds == student_preds))
+    results['speedup'] = results['teacher']['latency_batch1']['p50_s'] / results['student']['latency_batch1']['p50_s']
+    results['posts'] = len(ids)
+    with open(config.path + report_output, 'w') as f:
+        json.dump(results, f, indent=1)
+    print('{:>8} {:>5} {:>11} {:>9} {:>12} {:>10}'.format('model', 'size', 'params', 'accuracy', 'batch1 ms', 'images/s'))
+    for name in ['teacher', 'student']:
+        r = results[name]
+        throughput = r['latency_batch{}'.format(config.batch_size)]['items_per_sec']
+        print('{:>8} {:>5} {:>11,} {:>9.4f} {:>12.1f} {:>10.1f}'.format(name, r['size'], r['params'], r['accuracy'],
+            1000 * r['latency_batch1']['p50_s'], throughput or 0.))
+    print('agreement {:.4f}, {:.1f}x faster at batch 1'.format(results['agreement'], results['speedup']))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="distill an experiment's VGG16 classifier into a small CPU student")
+    parser.add_argument('-p', type=str, required=True, help='experiment of the teacher (classifier.py -p), the student is saved next to it')
+    parser.add_argument('-s', action='store_true', help='use small training set')
+    parser.add_argument('--steps', type=str, nargs='+', default=['cache', 'train', 'report'], choices=['cache', 'train', 'report'], help='what to run')
+    parser.add_argument('--size', type=int, default=size_default, help='student input resolution')
+    parser.add_argument('--width', type=float, default=width_default, help='student channel multiplier')
+    parser.add_argument('--temperature', type=float, default=temperature_default, help='softening of the teacher predictions')
+    parser.add_argument('--alpha', type=float, default=alpha_default, help='weight of the true labels against the teacher')
+    parser.add_argument('-l', type=float, default=learning_rate_default, help='learning rate')
+    parser.add_argument('-n', type=int, default=epochs_default, help='number of epochs to run')
+    parser.add_argument('--batch_size', type=int, default=batch_size_default, help='batch size')
+    parser.add_argument('-m', action='store_true', help='trace numpy allocations in the memory report')
+    parser.add_argument('-r', type=int, help="teacher image resolution, i.e. pyramid level (default: the pyramid's default level)")
+    config = parser.parse_args()
+
+    pyramid.select(config.r)
+    config.path = classifier.experiments_path + config.p
+    config.train_path = classifier.train_small_path_default if config.s else classifier.train_path_default
+    memory_profile.start(config.path + memory_output, trace=config.m)
+    try:
+        if 'cache' in config.steps:
+            with memory_profile.phase('cache'):
+                cache_teacher(config, config.train_path)
+        if 'train' in config.steps:
+            with memory_profile.phase('train'):
+                train(config)
+        if 'report' in config.steps:
+            with memory_profile.phase('report'):
+                report(config)
+    finally:
+        memory_profile.stop()
@@ -0,0 +1,245 @@
+import argparse
+import importlib
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from multiprocessing.connection import Listener, Client
+
+import numpy as np
+
+# data-parallel training over local worker processes (and hosts): every worker trains a
+# shard of the data and the trainable weights are averaged every few batches through a
+# star allreduce on rank 0. frozen layers are identical everywhere and never sent
+rendezvous_default = '127.0.0.1:29500'
+sync_every_default = 1
+connect_timeout = 120
+scaling_report = 'scaling.json'
+rank_env = 'DIST_RANK'
+world_size_env = 'DIST_WORLD_SIZE'
+rendezvous_env = 'DIST_RENDEZVOUS'
+threads_env = 'DIST_THREADS'
+authkey_env = 'DIST_AUTHKEY'
+authkey_default = 'reddit-net'
+
+def add_arguments(parser):
+    parser.add_argument('--workers', type=int, help='data-parallel worker processes to train with on this host')
+    parser.add_argument('--world_size', type=int, help='workers across all hosts (default: --workers)')
+    parser.add_argument('--rank_offset', type=int, default=0, help="rank of this host's first worker")
+    parser.add_argument('--rendezvous', type=str, default=rendezvous_default, help='host:port of rank 0')
+    parser.add_argument('--sync_every', type=int, default=sync_every_default, help='average weights every k batches')
+
+def parse_address(rendezvous):
+    host, _, port = rendezvous.rpartition(':')
+    return host, int(port)
+
+class Group(object):
+    def __init__(self, rank, world_size, rendezvous, authkey=authkey_default):
+        self.rank = rank
+        self.world_size = world_size
+        self.connections = []
+        self.connection = None
+        address = parse_address(rendezvous)
+        if world_size == 1:
+            return
+        if rank == 0:
+            listener = Listener(address, authkey=authkey.encode('utf-8'))
+            by_rank = {}
+            while len(by_rank) < world_size - 1:
+                connection = listener.accept()
+                by_rank[connection.recv()] = connection
+            listener.close()
+            self.connections = [by_rank[r] for r in sorted(by_rank)]
+        else:
+            deadline = time.time() + connect_timeout
+            while True:
+                try:
+                    self.connection = Client(address, authkey=authkey.encode('utf-8'))
+                    break
+                except (IOError, OSError):
+                    # rank 0 may still be importing keras
+                    if time.time() > deadline:
+                        raise
+                    time.sleep(0.5)
+            self.connection.send(rank)
+
+    def allreduce_mean(self, vector):
+        # vector is one flat float32 array; returns the mean over all ranks
+        if self.world_size == 1:
+            return vector
+        if self.rank == 0:
+            total = np.array(vector, dtype=np.float32)
+            for connection in self.connections:
+                total += np.frombuffer(connection.recv_bytes(), dtype=np.float32)
+            total /= self.world_size
+            for connection in self.connections:
+                connection.send_bytes(total)
+            return total
+        self.connection.send_bytes(np.ascontiguousarray(vector, dtype=np.float32))
+        return np.frombuffer(self.connection.recv_bytes(), dtype=np.float32)
+
+    def broadcast(self, obj):
+        # rank 0's obj, on every rank
+        if self.world_size == 1:
+            return obj
+        if self.rank == 0:
+            for connection in self.connections:
+                connection.send(obj)
+            return obj
+        return self.connection.recv()
+
+    def gather(self, obj):
+        # list of every rank's obj on rank 0, None elsewhere
+        if self.rank == 0:
+            return [obj] + [connection.recv() for connection in self.connections]
+        self.connection.send(obj)
+        return None
+
+    def close(self):
+        for connection in self.connections + [self.connection]:
+            if connection is not None:
+                connection.close()
+
+# this process's group, set up by the worker entry point
+group = None
+
+def current():
+    return group
+
+def is_chief():
+    return group is None or group.rank == 0
+
+def shard(items):
+    # every rank gets the same number of items, so all ranks run the same number of steps
+    if group is None:
+        return items
+    per_rank = len(items) // group.world_size
+    return items[group.rank::group.world_size][:per_rank]
+
+def broadcast(obj):
+    return obj if group is None else group.broadcast(obj)
+
+def callbacks(chief_callbacks, sync_every=sync_every_default, report_dir=None):
+    # weight averaging goes first and syncs on the last batch of every epoch, so validation,
+    # checkpoints and metrics see the averaged weights;
+    # only rank 0 writes checkpoints, timelines and summaries, and decides when to stop
+    if group is None:
+        return chief_callbacks
+    # keras stays out of the launcher and the cli
+    from weight_averaging import StopBroadcast, WeightAveraging
+    averaging = WeightAveraging(group, sync_every, report_dir)
+    return [averaging] + (chief_callbacks if group.rank == 0 else []) + [StopBroadcast(group)]
+
+def flatten(values):
+    return np.concatenate([np.asarray(v, dtype=np.float32).ravel() for v in values])
+
+def unflatten(vector, like):
+    values = []
+    offset = 0
+    for v in like:
+        values.append(vector[offset:offset + v.size].reshape(v.shape).astype(v.dtype))
+        offset += v.size
+    return values
+
+def record_scaling(report_dir, world_size, sync_every, stats):
+    images = sum(s['images'] for s in stats)
+    seconds = max(s['seconds'] for s in stats)
+    entry = {
+        'world_size': world_size,
+        'sync_every': sync_every,
+        'images': images,
+        'seconds': seconds,
+        'images_per_sec': images / seconds if seconds else 0.,
+        'sync_fraction': max(s['sync_seconds'] for s in stats) / seconds if seconds else 0.,
+        'ranks': stats,
+    }
+    path = os.path.join(report_dir, scaling_report)
+    entries = []
+    if os.path.exists(path):
+        with open(path) as f:
+            entries = json.load(f)
+    entries.append(entry)
+    with open(path, 'w') as f:
+        json.dump(entries, f, indent=1)
+    print_scaling(entries)
+
+def print_scaling(entries):
+    # best run per (world size, sync period), speedup relative to the smallest world size
+    best = {}
+    for entry in entries:
+        key = entry['world_size'], entry['sync_every']
+        if key not in best or entry['images_per_sec'] > best[key]['images_per_sec']:
+            best[key] = entry
+    print('{:>7} {:>6} {:>12} {:>8} {:>10} {:>6}'.format('workers', 'sync', 'images/s', 'speedup', 'efficiency', 'sync%'))
+    for sync_every in sorted(set(k[1] for k in best)):
+        rows = sorted((k[0], e) for k, e in best.items() if k[1] == sync_every)
+        base_workers, base = rows[0]
+        for world_size, entry in rows:
+            speedup = entry['images_per_sec'] / base['images_per_sec'] if base['images_per_sec'] else 0.
+            efficiency = speedup * base_workers / world_size
+            print('{:>7} {:>6} {:>12.1f} {:>8.2f} {:>10.2f} {:>6.1f}'.format(world_size, sync_every,
+                entry['images_per_sec'], speedup, efficiency, 100 * entry['sync_fraction']))
+
+def should_launch(config):
+    return getattr(config, 'workers', None) and rank_env not in os.environ
+
+def launch(module, function, config, resolution=None):
+    # runs module.function(config) in config.workers processes on this host and waits for them
+    world_size = config.world_size or config.workers
+    # split this host's cores between its workers
+    threads = max(1, multiprocessing.cpu_count() // config.workers)
+    fd, spec_path = tempfile.mkstemp(suffix='.json', prefix='distributed-')
+    with os.fdopen(fd, 'w') as f:
+        json.dump({'module': module, 'function': function, 'config': vars(config), 'resolution': resolution}, f)
+    processes = []
+    try:
+        for local_rank in range(config.workers):
+            env = dict(os.environ)
+            env[rank_env] = str(config.rank_offset + local_rank)
+            env[world_size_env] = str(world_size)
+            env[rendezvous_env] = config.rendezvous
+            env[threads_env] = str(threads)
+            env['OMP_NUM_THREADS'] = str(threads)
+            processes.append(subprocess.Popen([sys.executable, os.path.abspath(__file__), '--worker', spec_path], env=env))
+        codes = [p.wait() for p in processes]
+    finally:
+        for p in processes:
+            if p.poll() is None:
+                p.terminate()
+        os.remove(spec_path)
+    if any(codes):
+        raise RuntimeError('distributed workers exited with {}'.format(codes))
+
+def run_worker(spec_path):
+    global group
+    with open(spec_path) as f:
+        spec = json.load(f)
+    import pyramid
+    import session_config
+    pyramid.select(spec['resolution'])
+    threads = int(os.environ.get(threads_env, 0))
+    session_config.configure_session(threads, 1 if threads else 0)
+    rank = int(os.environ[rank_env])
+    group = Group(rank, int(os.environ[world_size_env]), os.environ[rendezvous_env],
+        os.environ.get(authkey_env, authkey_default))
+    print('worker {}/{} up'.format(rank, group.world_size))
+    try:
+        module = importlib.import_module(spec['module'])
+        getattr(module, spec['function'])(argparse.Namespace(**spec['config']))
+    finally:
+        group.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='data-parallel worker entry point and scaling report')
+    parser.add_argument('--worker', type=str, help='run one worker from a launch spec (set up by launch())')
+    parser.add_argument('--report', type=str, help='print the scaling report of an experiment directory')
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args.worker)
+    if args.report:
+        with open(os.path.join(args.report, scaling_report)) as f:
+            print_scaling(json.load(f))
@@ -4,17 +4,19 @@
 #CS231N_REDDIT_NET | 2018
 
 #*********************************** SETUP *************************************
-import credentials
 import os
 import sys
 import argparse
-import praw
-import urllib2
 import PIL
 from PIL import Image, ImageOps
-from keras.preprocessing.image import ImageDataGenerator, array_to_img, img_to_array, load_img
 import json
 import random
+import shutil
+import memory_profile
+import manifest
+import dedup
+import pyramid
+# praw and keras are imported by the steps that use them (download, augment)
 
 reddits = ["art", "streetwear",
 		   "womensstreetwear", "OldSchoolCool",
@@ -31,6 +33,9 @@ model_path = "model.json"
 train_path = "train.json"
 validation_path = "validation.json"
 test_path = "test.json"
+manifest_path = manifest.manifest_path_default
+dedup_path = dedup.index_path_default
+memory_path = "datasets_memory.json"
 training_size_default = 50
 augment_size_default = 1
 training_resolution_default = 1000
@@ -42,9 +47,15 @@ def get_index_for_subreddit_name_prefixed(name):
 	return indices_by_prefixed_subreddit[name]
 
 #*********************************** HELPERS ***********************************
-def download(training_size):
+def download(training_size, drop_duplicates=False):
+	import credentials
+	import praw
+	import urllib2
 	print("Downloading training data...")
 	posts = []
+	# every image goes into the repost index under its post id, so crawling a post again
+	# updates its entry; with drop_duplicates near-duplicates are not saved
+	duplicates = dedup.load(dedup_path)
 	reddit = praw.Reddit(client_id=credentials.CLIENT_ID, client_secret=credentials.CLIENT_SECRET, user_agent="CS231N_REDDIT_NET")
 	for subreddit in reddits:
 		print(subreddit + "......................................................")
@@ -68,14 +79,23 @@ def download(training_size):
 					f = urllib2.urlopen(req)
 					urltype = f.geturl().split(".")[-1]
 					if urltype == "jpg" or urltype == "png" or urltype == "JPG" or urltype == "PNG":
+						data = f.read()
+						h = dedup.hash_bytes(data, duplicates.method)
+						matches = duplicates.query(h, exclude=post["id"])
+						if matches:
+							print("near-duplicate of post " + duplicates.keys[matches[0][0]])
+							if drop_duplicates:
+								continue
 						with open(post["path"], "wb") as output:
-						  output.write(f.read())
+						  output.write(data)
+						duplicates.add(h, post["id"])
 						posts.append(post)
 						i += 1
 				except Exception as e:
-				    print("URLError = " + str(e.reason))
+				    print("URLError = " + str(getattr(e, "reason", e)))
 			if i == training_size:
 				break
+	duplicates.save(dedup_path)
 	model = {
 		'posts': posts,
 		'subreddit_indices_map': indices_by_prefixed_subreddit
@@ -83,17 +103,15 @@ def download(training_size):
 	with open(model_path, "w") as outfile:  
 		json.dump(model, outfile)
 
-def preprocess(training_resolution):
+def preprocess(training_resolutions):
 	print("pre-processing training data...")
-	size = training_resolution, training_resolution
-	for pic in os.listdir(dataset_path):
-		path = dataset_path + pic
-		img = Image.open(path).convert('RGB')
-		new = ImageOps.fit(img, size, Image.ANTIALIAS)
-		print(pic + str(new.size))
-		new.save(path)
+	# originals stay untouched in datasets/; every resolution becomes a pyramid level
+	paths = [dataset_path + pic for pic in sorted(os.listdir(dataset_path))]
+	default = training_resolution_default if training_resolution_default in training_resolutions else None
+	pyramid.build(paths, training_resolutions, default=default)
 
 def augment():
+	from keras.preprocessing.image import ImageDataGenerator, img_to_array, load_img
 	print("augmenting training data...")
 	datagen = ImageDataGenerator(
 	        rotation_range=40,
@@ -103,34 +121,30 @@ def augment():
 	        zoom_range=0.2,
 	        horizontal_flip=True,
 	        fill_mode='nearest')
-	with open(train_path) as f:
-		model = json.load(f)
-		posts = model["posts"]
-		key = model["subreddit_indices_map"]
-		for i in range(len(posts)):
-			curr = posts[i]
-			img = load_img(curr["path"])
-			x = img_to_array(img)
-			x = x.reshape((1,) + x.shape)
-			i = 0
-			for new in datagen.flow(x, batch_size=1, save_to_dir='augment', save_prefix=curr["path"].split("/")[-1].split(".")[0], save_format='jpg'):
-				i += 1
-				if i == augment_size_default:
-					break
-			for f in os.listdir('augment'):
-				copy = curr.copy()
-				os.rename(os.path.join('augment', f), os.path.join('datasets', f))
-				copy["path"] = os.path.join('datasets', f)
-				posts.append(copy)
-			print(curr["path"])
-		random.shuffle(posts)
-		print(len(posts))
-		train = {
-			'posts': posts,
-			'subreddit_indices_map': key
-		}
-		with open(train_path, "w") as outfile:  
-			json.dump(train, outfile)
+	model = manifest.load(train_path, resolve_paths=False)
+	posts = model["posts"]
+	augmented = []
+	for i in range(len(posts)):
+		curr = posts[i]
+		img = load_img(curr["path"])
+		x = img_to_array(img)
+		x = x.reshape((1,) + x.shape)
+		i = 0
+		for new in datagen.flow(x, batch_size=1, save_to_dir='augment', save_prefix=curr["path"].split("/")[-1].split(".")[0], save_format='jpg'):
+			i += 1
+			if i == augment_size_default:
+				break
+		for f in os.listdir('augment'):
+			copy = curr.copy()
+			os.rename(os.path.join('augment', f), os.path.join('datasets', f))
+			copy["path"] = os.path.join('datasets', f)
+			augmented.append(copy)
+		print(curr["path"])
+	# augmented copies join the train split; the manifest keeps its own order so no shuffle is needed
+	if not manifest.exists(manifest_path):
+		manifest.from_json(train_path, manifest_path)
+	manifest.append(manifest_path, augmented, manifest.split_name(train_path))
+	print(len(posts) + len(augmented))
 
 def cleanup():
 	print("cleaning up training data...")
@@ -142,38 +156,36 @@ def cleanup():
 		os.remove(validation_path)
 	if os.path.exists(test_path):
 		os.remove(test_path)
+	if os.path.exists(manifest_path):
+		shutil.rmtree(manifest_path)
+	if os.path.exists(dedup_path):
+		os.remove(dedup_path)
+	if os.path.exists(pyramid.pyramid_path):
+		shutil.rmtree(pyramid.pyramid_path)
 	for pic in os.listdir(dataset_path):
 		os.remove(dataset_path + pic)	
 
 def split():
 	print("splitting up training data for validation...")
-	with open(model_path) as f:
-		model = json.load(f)
+	# one manifest of every post, with each split stored as a list of indices into it
+	if os.path.exists(model_path):
+		with open(model_path) as f:
+			model = json.load(f)
 		posts = model["posts"]
 		key = model["subreddit_indices_map"]
-		length = len(posts)
-		random.shuffle(posts)
-		train = {
-			'posts': posts[:int(length * .8)],
-			'subreddit_indices_map': key
-		}
-		print("training size: " + str(len(train["posts"])))
-		validate = {
-			'posts': posts[int(length * .8): int(length * .9)],
-			'subreddit_indices_map': key
-		}
-		print("validation size: " + str(len(validate["posts"])))
-		test = {
-			'posts': posts[int(length * .9):],
-			'subreddit_indices_map': key
-		}
-		print("test size: " + str(len(test["posts"])))
-		with open(train_path, "w") as outfile:
-			json.dump(train, outfile)
-		with open(validation_path, "w") as outfile:
-			json.dump(validate, outfile)
-		with open(test_path, "w") as outfile:
-			json.dump(test, outfile)
+		m = manifest.write(manifest_path, posts, key)
+	else:
+		m = manifest.open_manifest(manifest_path)
+	# near-duplicate clusters stay inside one split so reposts can't leak into validation/test
+	# (by post id, so augmented copies stay with their original too)
+	ids = [m.string(i) for i in m.column('id')]
+	train, validate, test = dedup.assign_splits(ids, dedup.load(dedup_path), [.8, .1, .1], random)
+	print("training size: " + str(len(train)))
+	print("validation size: " + str(len(validate)))
+	print("test size: " + str(len(test)))
+	m.write_split(manifest.split_name(train_path), train)
+	m.write_split(manifest.split_name(validation_path), validate)
+	m.write_split(manifest.split_name(test_path), test)
 
 #************************************ MAIN *************************************
 if __name__ == "__main__":
@@ -181,22 +193,36 @@ if __name__ == "__main__":
 	parser = argparse.ArgumentParser()
 	parser.add_argument("-c", action="store_true", help="cleanup training directory")
 	parser.add_argument("-d", type=int, help="number of training examples per class")
-	parser.add_argument("-p", type=int, help="preprocessing resolution of training example")
-	parser.add_argument("-a", action="store_true", help="augment training examples")
+	parser.add_argument("-p", type=int, nargs='+', help="preprocessing resolutions of training examples, e.g. -p 1000 448 224")
+	parser.add_argument("-a", action="store_true", help="augment training examples (run -p again to add them to the pyramid)")
 	parser.add_argument("-s", action="store_true", help="split training data for validation")
+	parser.add_argument("-m", action="store_true", help="trace numpy allocations in the memory report")
+	parser.add_argument("-r", action="store_true", help="drop near-duplicate reposts while downloading")
 	args = parser.parse_args()
-	if len(sys.argv) <= 1:
-		download(training_size_default)
-		preprocess(training_resolution_default)
-		split()
-	else:
-		if args.c:
-			cleanup()
-		if args.d:
-			download(args.d)
-		if args.p:
-			preprocess(args.p)
-		if args.a:
-			augment()
-		if args.s:
-			split()
\ No newline at end of file
+	memory_profile.start(memory_path, trace=args.m)
+	try:
+		if len(sys.argv) <= 1:
+			with memory_profile.phase('download'):
+				download(training_size_default)
+			with memory_profile.phase('preprocess'):
+				preprocess([training_resolution_default])
+			with memory_profile.phase('split'):
+				split()
+		else:
+			if args.c:
+				with memory_profile.phase('cleanup'):
+					cleanup()
+			if args.d:
+				with memory_profile.phase('download'):
+					download(args.d, args.r)
+			if args.p:
+				with memory_profile.phase('preprocess'):
+					preprocess(args.p)
+			if args.a:
+				with memory_profile.phase('augment'):
+					augment()
+			if args.s:
+				with memory_profile.phase('split'):
+					split()
+	finally:
+		memory_profile.stop()
\ No newline at end of file
@@ -1,5 +1,6 @@
 import argparse
 import os
+import time
 from itertools import product
 
 import json
@@ -7,35 +8,34 @@ import json
 import numpy as np
 from PIL import Image
 
-from keras.applications.vgg16 import VGG16
-from keras.preprocessing import image
-from keras.models import Model, load_model, Sequential
-from keras.layers import Dense, GlobalAveragePooling2D
-from keras import backend as K
-from keras.preprocessing.image import ImageDataGenerator
-from keras.optimizers import Adam
-from keras import metrics
-from keras.callbacks import TensorBoard, ModelCheckpoint, Callback
+import async_eval
+import autotune
+import distributed
+import memory_profile
+import manifest
+import pyramid
+import serving_metrics
 
-import matplotlib.pyplot as plt
-from sklearn.metrics import confusion_matrix
+# keras, matplotlib and sklearn are imported by the modes that use them
 
 NUM_CLASSES=20
 
-def get_data(json_path):
+@memory_profile.phased('load')
+def get_data(json_path, shard=False):
     X_train = []
     y_train = []
-    with open(json_path) as f:
-        data = json.load(f)
-        for post in data['posts']:
-            path = post['path']
-            label = post['subreddit']
-            img = np.array(Image.open(path))
-            X_train.append(img)
-
-            one_hot = np.zeros(NUM_CLASSES)
-            one_hot[label] = 1
-            y_train.append(one_hot)
+    columns = manifest.load_columns(json_path, ['path', 'subreddit'])
+    rows = list(zip(columns['path'], columns['subreddit']))
+    if shard:
+        # this worker's part of the data when training data-parallel
+        rows = distributed.shard(rows)
+    for path, label in rows:
+        img = np.array(Image.open(path))
+        X_train.append(img)
+
+        one_hot = np.zeros(NUM_CLASSES)
+        one_hot[label] = 1
+        y_train.append(one_hot)
 
     X_train = np.array(X_train)
     y_train = np.array(y_train)
@@ -43,20 +43,18 @@ def get_data(json_path):
     return X_train, y_train
 
 def get_subreddit_indices_map(path):
-    with open(path) as f:
-        data = json.load(f)
-        return data['subreddit_indices_map']
+    return manifest.get_subreddit_indices_map(path)
 
 def get_subreddit_for_index(index):
-    subreddit_indices_map = get_subreddit_indices_map('train.json')
-    reverse_map = {}
-    for k, v in subreddit_indices_map.items():
-        reverse_map[v] = k
-    return reverse_map[index]
+    return manifest.get_subreddit_for_index(index, 'train.json')
 
-def create_model():
+@memory_profile.phased('build model')
+def create_model(weights='imagenet'):
+    from keras.applications.vgg16 import VGG16
+    from keras.models import Model
+    from keras.layers import Dense, GlobalAveragePooling2D
     # create the base pre-trained model
-    base_model = VGG16(weights='imagenet', include_top=False)
+    base_model = VGG16(weights=weights, include_top=False)
 
     x = base_model.output
     x = GlobalAveragePooling2D()(x)
@@ -73,20 +71,25 @@ def create_model():
 
     return model
 
-class EpochSaver(Callback):
-    def __init__(self, path):
-        self.path = path
-
-    def on_epoch_end(self, epoch, logs=None):
-        with open(self.path, 'w') as f:
-            json.dump({'epoch': epoch}, f)
-
 def train(config):
-    latest_checkpoint_path = config.experiment_dir + 'latest-checkpoint.h5'
+    from keras.models import load_model
+    from keras.optimizers import Adam
+    from keras.callbacks import TensorBoard, ModelCheckpoint
+    from profiling import StepTimeline
+    import checkpoint
+    latest_checkpoint_path = config.experiment_dir + checkpoint.latest_checkpoint_name
+    # full-model checkpoints written before checkpoint.py
+    legacy_checkpoint_path = config.experiment_dir + 'latest-checkpoint.h5'
     epoch_path = config.experiment_dir + 'last_epoch.json'
     initial_epoch = 0
     if os.path.exists(latest_checkpoint_path):
-        model = load_model(latest_checkpoint_path)
+        # the frozen VGG16 layers come back from the imagenet weights
+        model = create_model()
+        model.compile(optimizer=Adam(lr=config.lr), loss='categorical_crossentropy', metrics=['accuracy'])
+        initial_epoch = checkpoint.restore(model, latest_checkpoint_path)
+        print('Loading model from last checkpoint and resuming training on epoch {}'.format(initial_epoch + 1))
+    elif os.path.exists(legacy_checkpoint_path):
+        model = load_model(legacy_checkpoint_path)
         with open(epoch_path) as f:
             initial_epoch = json.load(f)['epoch'] + 1
             print('Loading model from last checkpoint and resuming training on epoch {}'.format(initial_epoch + 1))
@@ -99,20 +102,28 @@ def train(config):
     with open(config.experiment_dir + 'config.json', 'w') as f:
         json.dump(vars(config), f)
 
-    X_train, y_train = get_data('train.json')
-    X_val, y_val = get_data('validation.json')
+    initial_epoch = distributed.broadcast(initial_epoch)
+    X_train, y_train = get_data('train.json', shard=True)
+    # only the chief validates, checkpoints and writes logs; with --async_eval a separate
+    # evaluator does the validating
+    validation_data = get_data('validation.json') if distributed.is_chief() and not config.async_eval else None
     # train the model on the new data for a few epochs
     best_checkpoint_file_path = config.experiment_dir + 'best-checkpoint.hdf5'
     best_checkpoint = ModelCheckpoint(best_checkpoint_file_path, monitor='val_acc', verbose=1, save_best_only=True, mode='max', save_weights_only=True)
-    latest_checkpoint = ModelCheckpoint(latest_checkpoint_path, verbose=1, save_best_only=False, mode='max')
-    epoch_saver = EpochSaver(epoch_path)
+    latest_checkpoint = checkpoint.AsyncCheckpoint(latest_checkpoint_path, meta={'backbone': 'vgg16/imagenet'})
     tensorboard = TensorBoard(log_dir=config.experiment_dir, histogram_freq=0, write_graph=False, write_images=True)
-    model.fit(X_train, y_train,
-        validation_data=(X_val, y_val),
-        batch_size=config.batch_size,
-        epochs=config.epochs,
-        initial_epoch=initial_epoch,
-        callbacks=[best_checkpoint, latest_checkpoint, epoch_saver, tensorboard])
+    timeline = StepTimeline(config.experiment_dir, log_dir=config.experiment_dir)
+    if config.async_eval:
+        from async_validation import AsyncValidation
+        best_checkpoint = AsyncValidation(config.experiment_dir, async_eval.spec(config, 'main', 'validation.json', best_checkpoint_file_path,
+            'val_acc', 'max', config.batch_size, pyramid.selected_resolution), config.eval_patience)
+    with memory_profile.phase('fit'):
+        model.fit(X_train, y_train,
+            validation_data=validation_data,
+            batch_size=config.batch_size,
+            epochs=config.epochs,
+            initial_epoch=initial_epoch,
+            callbacks=distributed.callbacks([best_checkpoint, latest_checkpoint, tensorboard, timeline], config.sync_every, config.experiment_dir))
 
 def evaluate(config):
     model = create_model()
@@ -123,11 +134,14 @@ def evaluate(config):
     model.compile(optimizer='adam', loss='categorical_crossentropy', metrics=['accuracy'])
 
     X_val, y_val = get_data('validation.json')
-    _, acc = model.evaluate(X_val, y_val)
+    with memory_profile.phase('evaluate'):
+        _, acc = model.evaluate(X_val, y_val)
 
     print('Validation accuracy: {}'.format(acc))
 
 def plot_confusion_matrix(config):
+    import matplotlib.pyplot as plt
+    from sklearn.metrics import confusion_matrix
     model = create_model()
     checkpoint_file_path = config.experiment_dir + 'best-checkpoint.hdf5'
     model.load_weights(checkpoint_file_path)
@@ -135,7 +149,8 @@ def plot_confusion_matrix(config):
     X_train, y_train = get_data('train.json')
     X_train = X_train
     y_train = np.argmax(y_train, axis=1)
-    preds = np.argmax(model.predict(X_train), axis=1)
+    with memory_profile.phase('predict'):
+        preds = np.argmax(model.predict(X_train), axis=1)
 
     indices_map = get_subreddit_indices_map('train.json')
     classes = sorted(indices_map.keys(), key=lambda k: indices_map[k])
@@ -164,14 +179,25 @@ def plot_confusion_matrix(config):
     plt.show()
 
 def predict(config):
-    model = create_model()
-    checkpoint_file_path = config.experiment_dir + 'best-checkpoint.hdf5'
-    model.load_weights(checkpoint_file_path)
+    exported = None
+    if config.artifact:
+        # everything from one exported file (artifact.py): no imagenet weights, no train.json
+        import artifact
+        exported = artifact.load(config.artifact, kinds=artifact.classifier_kinds)
+        model = exported.model
+    else:
+        model = create_model()
+        checkpoint_file_path = config.experiment_dir + 'best-checkpoint.hdf5'
+        model.load_weights(checkpoint_file_path)
 
+    start = time.time()
     img_path = config.img_path
-    img = np.array(Image.open(img_path))
+    img = exported.load_image(img_path) if exported else np.array(Image.open(img_path))
+    serving_metrics.observe('batch_size', 1, model='main')
     label_i = np.argmax(model.predict(np.array([img])), axis=0)[0]
-    label = get_subreddit_for_index(label_i)
+    serving_metrics.inc('predict_requests_total', model='main')
+    serving_metrics.observe('predict_seconds', time.time() - start, model='main')
+    label = exported.labels[label_i] if exported else get_subreddit_for_index(label_i)
 
     print('Predicting {}'.format(label))
 
@@ -183,26 +209,46 @@ if __name__ == '__main__':
     parser.add_argument('--batch_size', type=int, help='batch size')
     parser.add_argument('--epochs', type=int, help='number of epochs to train for')
     parser.add_argument('--img_path', type=str, help='path of img to predict')
+    parser.add_argument('--artifact', type=str, help='predict with an exported model artifact (see artifact.py)')
+    parser.add_argument('--trace_memory', action='store_true', help='trace numpy allocations in the memory report')
+    parser.add_argument('--resolution', type=int, help="image resolution, i.e. pyramid level to load (default: the pyramid's default level)")
+    distributed.add_arguments(parser)
+    serving_metrics.add_arguments(parser)
+    autotune.add_arguments(parser)
+    async_eval.add_arguments(parser)
 
     config = parser.parse_args()
+    pyramid.select(config.resolution)
 
     experiment_dir = 'experiments/{}/'.format(config.experiment)
     config.experiment_dir = experiment_dir
     if not os.path.isdir(experiment_dir):
         os.makedirs(experiment_dir)
 
-    if config.mode == 'train':
-        print('Training...')
-        train(config)
-    elif config.mode == 'evaluate':
-        print('Evaluating...')
-        evaluate(config)
-    elif config.mode == 'plot_cm':
-        print('Plotting confusion matrix')
-        plot_confusion_matrix(config)
-    elif config.mode == 'predict':
-        print('Making predicting for image')
-        predict(config)
-    else:
-        print('Invalid mode! Aborting...')
+    if not (config.mode == 'train' and distributed.should_launch(config)):
+        autotune.apply('fit' if config.mode == 'train' else 'predict', config)
+    memory_profile.start(experiment_dir + 'memory.json', trace=config.trace_memory)
+    serving_metrics.start_from_config(config)
+    try:
+        with memory_profile.phase(str(config.mode)):
+            if config.mode == 'train':
+                print('Training...')
+                if distributed.should_launch(config):
+                    distributed.launch('main', 'train', config, pyramid.selected_resolution)
+                else:
+                    train(config)
+            elif config.mode == 'evaluate':
+                print('Evaluating...')
+                evaluate(config)
+            elif config.mode == 'plot_cm':
+                print('Plotting confusion matrix')
+                plot_confusion_matrix(config)
+            elif config.mode == 'predict':
+                print('Making predicting for image')
+                predict(config)
+            else:
+                print('Invalid mode! Aborting...')
+    finally:
+        serving_metrics.stop()
+        memory_profile.stop()
 
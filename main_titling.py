@@ -1,13 +1,18 @@
 import argparse
+import json
 import os
 
-from keras.callbacks import TensorBoard, ModelCheckpoint, Callback
 import numpy as np
-from keras.optimizers import Adam
 
-from titling_model import *
-from titling_data import *
-from vocab import *
+import async_eval
+import autotune
+import distributed
+import memory_profile
+import manifest
+import pyramid
+import serving_metrics
+# keras and everything built on it (the model, data generators, vocab) is imported by the
+# modes that need it, so the cli starts without loading tensorflow
 
 NUM_SUBREDDITS = 20
 START_TOKEN = '<START>'
@@ -15,15 +20,15 @@ PAD_TOKEN = '<PAD>'
 UNKNOWN_TOKEN = '<UNK>'
 END_TOKEN = '<END>'
 
-class EpochSaver(Callback):
-    def __init__(self, path):
-        self.path = path
-
-    def on_epoch_end(self, epoch, logs=None):
-        with open(self.path, 'w') as f:
-            json.dump({'epoch': epoch}, f)
-
 def train(config):
+    from keras.callbacks import TensorBoard, ModelCheckpoint
+    from keras.optimizers import Adam
+    from profiling import PipelineStats, StepTimeline, TimedSequence
+    from titling_model import ImageTitlingModel
+    from titling_data import ImageTitlingDataGenerator
+    from sampled_softmax import sampled_softmax_loss
+    import checkpoint
+    import vocab
     # record what params we trained with
     with open(config.experiment_dir + 'config.json', 'w') as f:
         json.dump(vars(config), f)
@@ -31,103 +36,200 @@ def train(config):
     max_len = config.max_len
     #embedding_matrix, words_by_id, id_by_words = vocab.load_embedding_matrix()
     #embedding_matrix, words_by_id, id_by_words = vocab.load_limited_embedding_matrix(config.train_json, config.embed_size)
-    words_by_id, id_by_words = vocab.load_vocab(config.train_json)
+    if config.vocab:
+        # a vocabulary built by vocab.py, kept with the experiment for every later mode
+        words_by_id, id_by_words, word_counts = vocab.read_vocab(config.vocab, return_counts=True)
+        vocab.save_for_experiment(config.vocab, config.experiment_dir)
+    else:
+        words_by_id, id_by_words, word_counts = vocab.load_for_experiment(config.experiment_dir, config.train_json, return_counts=True)
+    if config.softmax == 'sampled':
+        # the output is the (sampled) loss itself, so there is no accuracy; validation runs
+        # the exact full softmax, so val_loss is the true cross entropy
+        loss, metrics, monitor, monitor_mode = sampled_softmax_loss, [], 'val_loss', 'min'
+    else:
+        loss, metrics, monitor, monitor_mode = 'categorical_crossentropy', ['accuracy'], 'val_acc', 'max'
 
-    latest_checkpoint_path = config.experiment_dir + 'latest-checkpoint.h5'
+    latest_checkpoint_path = config.experiment_dir + checkpoint.latest_checkpoint_name
+    # full-model checkpoints written before checkpoint.py
+    legacy_checkpoint_path = config.experiment_dir + 'latest-checkpoint.h5'
     epoch_path = config.experiment_dir + 'last_epoch.json'
     initial_epoch = 0
-    model = ImageTitlingModel(words_by_id, id_by_words, num_subreddits=NUM_SUBREDDITS, max_len=max_len)
+    model = ImageTitlingModel(words_by_id, id_by_words, num_subreddits=NUM_SUBREDDITS, max_len=max_len,
+        softmax=config.softmax, num_sampled=config.num_sampled, word_counts=word_counts)
     if os.path.exists(latest_checkpoint_path):
-        model.load_checkpoint(latest_checkpoint_path)
+        model.train_model.compile(optimizer=Adam(lr=config.lr), loss=loss, metrics=metrics)
+        initial_epoch = model.restore_checkpoint(latest_checkpoint_path)
+        print('Loading model from last checkpoint and resuming training on epoch {}'.format(initial_epoch))
+    elif os.path.exists(legacy_checkpoint_path):
+        model.load_checkpoint(legacy_checkpoint_path)
         with open(epoch_path) as f:
             initial_epoch = json.load(f)['epoch'] + 1
             print('Loading model from last checkpoint and resuming training on epoch {}'.format(initial_epoch))
     else:
         print('Starting new training run')
-        model.train_model.compile(optimizer=Adam(lr=config.lr), loss='categorical_crossentropy', metrics=['accuracy'])
+        model.train_model.compile(optimizer=Adam(lr=config.lr), loss=loss, metrics=metrics)
+    initial_epoch = distributed.broadcast(initial_epoch)
 
     train_data_generator = ImageTitlingDataGenerator(config.train_json,
         id_by_words,
         max_len=max_len,
         num_subreddits=NUM_SUBREDDITS,
-        batch_size=config.batch_size)
-    validation_data_generator = ImageTitlingDataGenerator(config.validation_json,
-        id_by_words,
-        max_len=max_len,
-        num_subreddits=NUM_SUBREDDITS,
-        batch_size=config.batch_size)
+        batch_size=config.batch_size,
+        shard=True,
+        sparse_targets=config.softmax == 'sampled')
+    # only the chief validates, checkpoints and writes logs; with --async_eval a separate
+    # evaluator does the validating
+    validation_data_generator = None
+    if distributed.is_chief() and not config.async_eval:
+        validation_data_generator = ImageTitlingDataGenerator(config.validation_json,
+            id_by_words,
+            max_len=max_len,
+            num_subreddits=NUM_SUBREDDITS,
+            batch_size=config.batch_size,
+            sparse_targets=config.softmax == 'sampled')
 
     # train the model on the new data for a few epochs
     best_checkpoint_file_path = config.experiment_dir + 'best-checkpoint.hdf5'
-    best_checkpoint = ModelCheckpoint(best_checkpoint_file_path, monitor='val_acc', verbose=1, save_best_only=True, mode='max', save_weights_only=True)
-    latest_checkpoint = ModelCheckpoint(latest_checkpoint_path, verbose=1, save_best_only=False, mode='max')
-    epoch_saver = EpochSaver(epoch_path)
+    best_checkpoint = ModelCheckpoint(best_checkpoint_file_path, monitor=monitor, verbose=1, save_best_only=True, mode=monitor_mode, save_weights_only=True)
+    latest_checkpoint = checkpoint.AsyncCheckpoint(latest_checkpoint_path, meta={'backbone': 'vgg16/imagenet', 'max_len': max_len, 'softmax': config.softmax})
     tensorboard = TensorBoard(log_dir=config.experiment_dir, histogram_freq=0, write_graph=False, write_images=True)
-    model.train_model.fit_generator(train_data_generator,
-        validation_data=validation_data_generator,
-        max_queue_size=1,
-        epochs=config.epochs,
-        initial_epoch=initial_epoch,
-        callbacks=[best_checkpoint, latest_checkpoint, epoch_saver, tensorboard])
+    # batch loading threads, tuned per host by autotune.py
+    loader_workers = getattr(config, 'loader_workers', None) or 1
+    pipeline_stats = PipelineStats()
+    timeline = StepTimeline(config.experiment_dir, log_dir=config.experiment_dir, stats=pipeline_stats)
+    if config.async_eval:
+        from async_validation import AsyncValidation
+        best_checkpoint = AsyncValidation(config.experiment_dir, async_eval.spec(config, 'titling', config.validation_json, best_checkpoint_file_path,
+            monitor, monitor_mode, config.batch_size, pyramid.selected_resolution, train_json=config.train_json, max_len=max_len,
+            num_subreddits=NUM_SUBREDDITS, experiment_dir=config.experiment_dir), config.eval_patience)
+    with memory_profile.phase('fit'):
+        model.train_model.fit_generator(TimedSequence(train_data_generator, pipeline_stats),
+            validation_data=validation_data_generator,
+            max_queue_size=max(1, loader_workers),
+            workers=loader_workers,
+            epochs=config.epochs,
+            initial_epoch=initial_epoch,
+            callbacks=distributed.callbacks([best_checkpoint, latest_checkpoint, tensorboard, timeline], config.sync_every, config.experiment_dir))
 
 def sample_inference(config):
-    embedding_matrix, words_by_id, id_by_words = vocab.load_limited_embedding_matrix('small_train.json')
+    from titling_model import ImageTitlingModel
+    from titling_data import model_input_output_from_post
+    import vocab
+    # the vocab the model was trained with
+    words_by_id, id_by_words = vocab.load_for_experiment(config.experiment_dir, config.train_json)
     max_len = config.max_len
-    model = ImageTitlingModel(embedding_matrix, words_by_id, id_by_words, num_subreddits=NUM_SUBREDDITS, max_len=max_len)
+    model = ImageTitlingModel(words_by_id, id_by_words, num_subreddits=NUM_SUBREDDITS, max_len=max_len)
     checkpoint_file_path = config.experiment_dir + 'best-checkpoint.hdf5'
     model.load_weights(checkpoint_file_path)
 
-    with open('validation.json') as f:
-        data = json.load(f)
-        NUM_SAMPLES = 10
-        posts = data['posts']
-        indices = np.random.choice(len(posts), NUM_SAMPLES)
-        for i in indices:
-            post = posts[i]
-            img, subreddit_one_hot, title_indices, y = model_input_output_from_post(post, id_by_words, max_len)
-            subreddit = post['subreddit']
-            actual_title = post['title']
-
-            predicted_title_greedy = model.generate_title_beam_search(img, subreddit, 1)
-            predicted_title_beam = model.generate_title_beam_search(img, subreddit, 5)
-            if predicted_title_greedy == predicted_title_beam:
-                print('not interesting!')
-                continue
-
-            gt_title = []
-            for i in range(len(y)):
-                word_id = np.argmax(y[i])
-                word = words_by_id[word_id]
-                gt_title.append(word)
-            gt_title = ' '.join(gt_title)
-            print('image: ', post['path'])
-            print('orig title:', actual_title)
-            print('Ground truth: ', gt_title)
-            print('Predicted greedy: ', predicted_title_greedy)
-            print('Predicted beam: ', predicted_title_beam)
-            print()
+    data = manifest.load('validation.json')
+    NUM_SAMPLES = 10
+    posts = data['posts']
+    indices = np.random.choice(len(posts), NUM_SAMPLES)
+    for i in indices:
+        post = posts[i]
+        img, subreddit_one_hot, title_indices, y = model_input_output_from_post(post, id_by_words, max_len)
+        subreddit = post['subreddit']
+        actual_title = post['title']
+
+        predicted_title_greedy = model.generate_title_beam_search(img, subreddit, 1)
+        predicted_title_beam = model.generate_title_beam_search(img, subreddit, 5)
+        if predicted_title_greedy == predicted_title_beam:
+            print('not interesting!')
+            continue
+
+        gt_title = []
+        for i in range(len(y)):
+            word_id = np.argmax(y[i])
+            word = words_by_id[word_id]
+            gt_title.append(word)
+        gt_title = ' '.join(gt_title)
+        print('image: ', post['path'])
+        print('orig title:', actual_title)
+        print('Ground truth: ', gt_title)
+        print('Predicted greedy: ', predicted_title_greedy)
+        print('Predicted beam: ', predicted_title_beam)
+        print()
 
 def evaluate(config):
+    from keras.optimizers import Adam
+    from titling_model import ImageTitlingModel
+    from titling_data import ImageTitlingDataGenerator
+    import checkpoint
+    import vocab
     max_len = config.max_len
-    embedding_matrix, words_by_id, id_by_words = vocab.load_limited_embedding_matrix('small_train.json')
-    model = ImageTitlingModel(embedding_matrix, words_by_id, id_by_words, num_subreddits=NUM_SUBREDDITS, max_len=max_len)
-    checkpoint_file_path = config.experiment_dir + 'latest-checkpoint.h5'
-    model.load_weights(checkpoint_file_path)
+    words_by_id, id_by_words = vocab.load_for_experiment(config.experiment_dir, config.train_json)
+    model = ImageTitlingModel(words_by_id, id_by_words, num_subreddits=NUM_SUBREDDITS, max_len=max_len)
+    model.train_model.compile(optimizer=Adam(lr=config.lr), loss='categorical_crossentropy', metrics=['accuracy'])
+    checkpoint_file_path = config.experiment_dir + checkpoint.latest_checkpoint_name
+    if os.path.exists(checkpoint_file_path):
+        model.restore_checkpoint(checkpoint_file_path)
+    else:
+        model.load_weights(config.experiment_dir + 'latest-checkpoint.h5')
 
     train_data_generator = ImageTitlingDataGenerator('small_train.json',
         id_by_words,
         max_len=max_len,
         num_subreddits=NUM_SUBREDDITS,
         batch_size=8)
-    model.train_model.compile(optimizer=Adam(lr=config.lr), loss='categorical_crossentropy', metrics=['accuracy'])
-    results = model.train_model.evaluate_generator(train_data_generator, max_queue_size=1)
+    with memory_profile.phase('evaluate'):
+        results = model.train_model.evaluate_generator(train_data_generator, max_queue_size=1)
     print(results)
 
+def load_checkpoint(model, checkpoint_file_path):
+    # npz checkpoints (checkpoint.py) restore into a compiled train model, the rest are keras weights
+    from keras.optimizers import Adam
+    if checkpoint_file_path.endswith('.npz'):
+        model.train_model.compile(optimizer=Adam(), loss='categorical_crossentropy')
+        model.restore_checkpoint(checkpoint_file_path)
+    else:
+        model.load_weights(checkpoint_file_path)
+
+def evaluate_split(config):
+    # decodes a whole split in batches: corpus metrics, perplexity, throughput and a jsonl of predictions
+    from titling_model import ImageTitlingModel
+    import titling_eval
+    import vocab
+    words_by_id, id_by_words = vocab.load_for_experiment(config.experiment_dir, config.train_json)
+    model = ImageTitlingModel(words_by_id, id_by_words, num_subreddits=NUM_SUBREDDITS, max_len=config.max_len)
+    load_checkpoint(model, config.experiment_dir + config.checkpoint)
+
+    name = '{}-{}-beam{}'.format(manifest.split_name(config.split), os.path.splitext(config.checkpoint)[0], config.beam_width)
+    results = titling_eval.evaluate_split(model, config.split, config.experiment_dir + 'predictions-' + name + '.jsonl',
+        beam_width=config.beam_width, batch_size=config.decode_batch_size or titling_eval.decode_batch_size_default)
+    results['checkpoint'] = config.checkpoint
+    with open(config.experiment_dir + 'eval-' + name + '.json', 'w') as f:
+        json.dump(results, f, indent=1)
+    for key in ['bleu', 'meteor', 'perplexity', 'images_per_sec', 'tokens_per_sec']:
+        if key in results:
+            print('{}: {:.4f}'.format(key, results[key]))
+
+def titles_for_all_subreddits(config):
+    # "where should I post this": a title for every subreddit from one encoder pass, ranked
+    if config.artifact:
+        # everything from one exported file (artifact.py): no imagenet weights, vocabulary or train.json
+        import artifact
+        exported = artifact.load(config.artifact, kinds=['titling'])
+        model = exported.model
+        img = exported.load_image(config.img_path)
+        subreddit_name = lambda subreddit: exported.labels[subreddit]
+    else:
+        from titling_model import ImageTitlingModel
+        from titling_data import load_image
+        import vocab
+        words_by_id, id_by_words = vocab.load_for_experiment(config.experiment_dir, config.train_json)
+        model = ImageTitlingModel(words_by_id, id_by_words, num_subreddits=NUM_SUBREDDITS, max_len=config.max_len)
+        load_checkpoint(model, config.experiment_dir + config.checkpoint)
+        img = load_image(config.img_path)
+        subreddit_name = lambda subreddit: manifest.get_subreddit_for_index(subreddit, config.train_json)
+    for subreddit, title, log_likelihood in model.generate_titles_for_all_subreddits(img, config.beam_width):
+        print('{:>24} {:9.3f}  {}'.format(subreddit_name(subreddit), log_likelihood, title))
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--experiment', type=str, help='unique experiment name')
     parser.add_argument('--lr', type=float, help='learning rate')
-    parser.add_argument('--mode', type=str, help='train, evaluate')
+    parser.add_argument('--mode', type=str, help='train, evaluate, evaluate_split, sample_inference, all_subreddits')
     parser.add_argument('--batch_size', type=int, help='batch size')
     parser.add_argument('--epochs', type=int, help='number of epochs to train for')
     parser.add_argument('--img_path', type=str, help='path of img to predict')
@@ -135,23 +237,56 @@ if __name__ == '__main__':
     parser.add_argument('--max_len', type=int, default=30, help='max len of titles')
     parser.add_argument('--train_json', type=str, default='train.json', help='json file containing train data')
     parser.add_argument('--validation_json', type=str, default='validation.json', help='json file containing validation data')
+    parser.add_argument('--trace_memory', action='store_true', help='trace numpy allocations in the memory report')
+    parser.add_argument('--resolution', type=int, help="image resolution, i.e. pyramid level to load (default: the pyramid's default level)")
+    distributed.add_arguments(parser)
+    serving_metrics.add_arguments(parser)
+    autotune.add_arguments(parser)
+    async_eval.add_arguments(parser)
+    parser.add_argument('--split', type=str, default='validation.json', help='split to decode in evaluate_split mode')
+    parser.add_argument('--checkpoint', type=str, default='best-checkpoint.hdf5', help='checkpoint in the experiment directory to evaluate (.hdf5 or .npz)')
+    parser.add_argument('--beam_width', type=int, default=1, help='beam width for evaluate_split, 1 is greedy')
+    parser.add_argument('--softmax', type=str, default='full', choices=['full', 'sampled'], help='output layer to train with; inference always uses the full softmax')
+    parser.add_argument('--num_sampled', type=int, default=1024, help='candidate words per batch with --softmax sampled')
+    parser.add_argument('--artifact', type=str, help='generate titles with an exported model artifact in all_subreddits mode (see artifact.py)')
+    parser.add_argument('--vocab', type=str, help='vocabulary built by vocab.py to train with (default: count the words of --train_json)')
+    parser.add_argument('--decode_batch_size', type=int, help='images decoded per batch in evaluate_split (default: 64)')
 
     config = parser.parse_args()
+    pyramid.select(config.resolution)
 
     experiment_dir = 'experiments/titling/{}/'.format(config.experiment)
     config.experiment_dir = experiment_dir
     if not os.path.isdir(experiment_dir):
         os.makedirs(experiment_dir)
 
+    def train_or_launch(config):
+        if distributed.should_launch(config):
+            distributed.launch('main_titling', 'train', config, pyramid.selected_resolution)
+        else:
+            train(config)
+
     mode_handlers = {
-        'train': train,
+        'train': train_or_launch,
         'sample_inference': sample_inference,
-        'evaluate': evaluate
+        'evaluate': evaluate,
+        'evaluate_split': evaluate_split,
+        'all_subreddits': titles_for_all_subreddits
     }
 
     mode = config.mode
     if mode in mode_handlers:
         handler = mode_handlers[mode]
-        handler(config)
+        config.loader_workers = None
+        if not (mode == 'train' and distributed.should_launch(config)):
+            config.loader_workers = autotune.apply('fit' if mode == 'train' else 'generate', config).get('workers')
+        memory_profile.start(experiment_dir + 'memory.json', trace=config.trace_memory)
+        serving_metrics.start_from_config(config)
+        try:
+            with memory_profile.phase(mode):
+                handler(config)
+        finally:
+            serving_metrics.stop()
+            memory_profile.stop()
     else:
         print('Invalid mode! Aborting...')
@@ -0,0 +1,335 @@
+import json
+import os
+import shutil
+
+import numpy as np
+
+import pyramid
+
+# columnar on-disk post store: one .npy per typed column (memory mapped on open), string
+# columns as indices into one interned utf-8 string table, and splits as index lists
+manifest_path_default = 'model.manifest'
+train_path_default = 'train.json'
+# written by verify.py; posts whose image is listed here are skipped by every loader
+quarantine_path_default = 'quarantine.json'
+meta_file = 'meta.json'
+strings_file = 'strings.npy'
+string_offsets_file = 'string_offsets.npy'
+split_prefix = 'split_'
+version = 1
+
+string_columns = ['id', 'title', 'url', 'path']
+typed_columns = {
+    'subreddit': np.int16,
+    'score': np.int64,
+    'created': np.float64,
+}
+
+class Manifest(object):
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, meta_file)) as f:
+            self.meta = json.load(f)
+        self.subreddit_indices_map = self.meta['subreddit_indices_map']
+        self.columns = {}
+        self.splits = {}
+        self.reverse_map = None
+        self.blob = None
+
+    def __len__(self):
+        return self.meta['num_posts']
+
+    def column(self, name):
+        if name not in self.columns:
+            self.columns[name] = np.load(os.path.join(self.path, name + '.npy'), mmap_mode='r')
+        return self.columns[name]
+
+    def string(self, i):
+        offsets = self.column('string_offsets')
+        return self.column('strings')[offsets[i]:offsets[i + 1]].tobytes().decode('utf-8')
+
+    def strings(self, ids):
+        # many strings at once: slices of the string table read into memory once
+        if self.blob is None:
+            self.blob = self.column('strings').tobytes()
+        ids = np.asarray(ids, dtype=np.int64)
+        offsets = self.column('string_offsets')
+        blob = self.blob
+        return [blob[start:stop].decode('utf-8') for start, stop in zip(offsets[ids].tolist(), offsets[ids + 1].tolist())]
+
+    def values(self, name, indices):
+        # a column for the posts at indices: a list of str for string columns, an array otherwise
+        column = np.asarray(self.column(name))[np.asarray(indices, dtype=np.int64)]
+        if name in string_columns:
+            return self.strings(column)
+        return column
+
+    def has_split(self, name):
+        return name in self.meta['splits']
+
+    def indices(self, split=None):
+        if split is None:
+            return np.arange(len(self))
+        if split not in self.splits:
+            self.splits[split] = np.load(os.path.join(self.path, split_prefix + split + '.npy'), mmap_mode='r')
+        return self.splits[split]
+
+    def labels(self, split=None):
+        return np.asarray(self.column('subreddit'))[self.indices(split)]
+
+    def post(self, i):
+        # same schema as the posts in model.json, including the string score
+        post = {}
+        for name in string_columns:
+            post[name] = self.string(self.column(name)[i])
+        post['subreddit'] = int(self.column('subreddit')[i])
+        post['score'] = str(self.column('score')[i])
+        post['created'] = float(self.column('created')[i])
+        return post
+
+    def iter_posts(self, split=None):
+        for i in self.indices(split):
+            yield self.post(i)
+
+    def posts(self, split=None, indices=None):
+        indices = self.indices(split) if indices is None else indices
+        return posts_from_columns({name: self.values(name, indices) for name in string_columns + list(typed_columns)})
+
+    def subreddit_for_index(self, index):
+        if self.reverse_map is None:
+            self.reverse_map = {v: k for k, v in self.subreddit_indices_map.items()}
+        return self.reverse_map[index]
+
+    def write_split(self, name, indices):
+        indices = np.asarray(indices, dtype=np.int32)
+        np.save(os.path.join(self.path, split_prefix + name + '.npy'), indices)
+        self.splits.pop(name, None)
+        if name not in self.meta['splits']:
+            self.meta['splits'].append(name)
+        write_meta(self.path, self.meta)
+
+def posts_from_columns(columns):
+    # post dicts with the schema of model.json, score as a string included
+    names = string_columns + ['subreddit', 'score', 'created']
+    values = [columns[name] for name in string_columns] + [columns['subreddit'].tolist(),
+        [str(score) for score in columns['score'].tolist()], columns['created'].tolist()]
+    return [dict(zip(names, row)) for row in zip(*values)]
+
+def write_meta(path, meta):
+    tmp_path = os.path.join(path, meta_file + '.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(meta, f)
+    os.rename(tmp_path, os.path.join(path, meta_file))
+
+def write(path, posts, subreddit_indices_map, splits=None):
+    # build in a temporary directory and swap it in, so readers never see half a manifest
+    tmp_path = path + '.tmp'
+    if os.path.isdir(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+
+    string_ids = {}
+    strings = []
+    def intern(s):
+        if s not in string_ids:
+            string_ids[s] = len(strings)
+            strings.append(s.encode('utf-8'))
+        return string_ids[s]
+
+    for name in string_columns:
+        column = np.array([intern(u'{}'.format(post.get(name, ''))) for post in posts], dtype=np.int32)
+        np.save(os.path.join(tmp_path, name + '.npy'), column)
+    for name, dtype in typed_columns.items():
+        column = np.array([post.get(name, 0) for post in posts]).astype(dtype)
+        np.save(os.path.join(tmp_path, name + '.npy'), column)
+    offsets = np.zeros(len(strings) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(s) for s in strings])
+    np.save(os.path.join(tmp_path, string_offsets_file), offsets)
+    np.save(os.path.join(tmp_path, strings_file), np.frombuffer(b''.join(strings), dtype=np.uint8))
+
+    splits = splits or {}
+    for name, indices in splits.items():
+        np.save(os.path.join(tmp_path, split_prefix + name + '.npy'), np.asarray(indices, dtype=np.int32))
+    write_meta(tmp_path, {
+        'version': version,
+        'num_posts': len(posts),
+        'subreddit_indices_map': subreddit_indices_map,
+        'splits': sorted(splits.keys()),
+    })
+
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.rename(tmp_path, path)
+    manifests.pop(path, None)
+    return open_manifest(path)
+
+def append(path, new_posts, split):
+    # manifests are immutable columns, so appending rewrites them; splits keep their indices
+    m = open_manifest(path)
+    posts = m.posts()
+    splits = {name: list(m.indices(name)) for name in m.meta['splits']}
+    splits.setdefault(split, [])
+    splits[split] += range(len(posts), len(posts) + len(new_posts))
+    return write(path, posts + list(new_posts), m.subreddit_indices_map, splits)
+
+# opened manifests, so repeated lookups (e.g. one per validation sample) don't touch disk again
+manifests = {}
+
+def open_manifest(path=manifest_path_default):
+    if path not in manifests:
+        manifests[path] = Manifest(path)
+    return manifests[path]
+
+def exists(path=manifest_path_default):
+    return os.path.exists(os.path.join(path, meta_file))
+
+def split_name(json_path):
+    # train.json -> train, small_train.json -> small_train
+    return os.path.splitext(os.path.basename(json_path))[0]
+
+def find(json_path, manifest_path=manifest_path_default):
+    if exists(manifest_path):
+        m = open_manifest(manifest_path)
+        if m.has_split(split_name(json_path)):
+            return m
+    return None
+
+# parsed json fallbacks, keyed by path
+json_cache = {}
+# (mtime, set of paths) per quarantine file
+quarantines = {}
+
+def load_quarantine(path=quarantine_path_default):
+    if not os.path.exists(path):
+        return set()
+    mtime = os.path.getmtime(path)
+    if path not in quarantines or quarantines[path][0] != mtime:
+        with open(path) as f:
+            quarantines[path] = (mtime, set(entry['path'] for entry in json.load(f)))
+    return quarantines[path][1]
+
+def write_quarantine(entries, path=quarantine_path_default):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(entries, f, indent=1)
+    os.rename(tmp_path, path)
+
+def quarantine_mask(paths, resolution, json_path=None):
+    # which of paths to keep, or None when nothing is quarantined; verify.py may have
+    # checked either the original or a pyramid level. reports the skipped posts of json_path
+    quarantined = load_quarantine()
+    if not quarantined:
+        return None
+    keep = np.array([path not in quarantined and not (resolution and pyramid.level_path(path, resolution) in quarantined)
+        for path in paths], dtype=bool)
+    if json_path is not None and not keep.all():
+        print('skipping {} quarantined posts in {}'.format(len(keep) - int(keep.sum()), json_path))
+    return keep
+
+def resolve_all(paths, resolution):
+    # the level is looked up once per split, not once per post
+    if not resolution:
+        return list(paths)
+    return [pyramid.level_path(path, resolution) for path in paths]
+
+def load_columns(json_path, names, manifest_path=manifest_path_default, honour_quarantine=True, resolution=None, resolve_paths=True):
+    # the columns `names` of a split, filtered and resolved like load() but without a dict per
+    # post: string columns as lists, the others as arrays
+    m = find(json_path, manifest_path)
+    if m is None:
+        posts = load(json_path, manifest_path, honour_quarantine, resolution, resolve_paths)['posts']
+        return {name: [post[name] for post in posts] if name in string_columns
+            else np.array([post[name] for post in posts]).astype(typed_columns[name]) for name in names}
+    resolution = resolution or pyramid.resolution_for_loading()
+    indices = np.asarray(m.indices(split_name(json_path)))
+    paths = None
+    if honour_quarantine and load_quarantine():
+        paths = m.values('path', indices)
+        keep = quarantine_mask(paths, resolution, json_path)
+        indices = indices[keep]
+        paths = [path for path, kept in zip(paths, keep) if kept]
+    columns = {}
+    for name in names:
+        if name == 'path':
+            paths = m.values('path', indices) if paths is None else paths
+            columns[name] = resolve_all(paths, resolution) if resolve_paths else paths
+        else:
+            columns[name] = m.values(name, indices)
+    return columns
+
+def load(json_path, manifest_path=manifest_path_default, honour_quarantine=True, resolution=None, resolve_paths=True):
+    # drop-in for json.load(open(json_path)): serves the split from the manifest when it
+    # has one, and falls back to the json file written by older versions of get_datasets.
+    # image paths point into the selected pyramid level (see pyramid.py) unless
+    # resolve_paths is off, which is what anything rewriting posts or splits needs.
+    # bulk readers that only need a few fields are faster with load_columns
+    m = find(json_path, manifest_path)
+    if m is not None:
+        columns = load_columns(json_path, string_columns + list(typed_columns), manifest_path,
+            honour_quarantine, resolution, resolve_paths)
+        return {'posts': posts_from_columns(columns), 'subreddit_indices_map': m.subreddit_indices_map}
+    resolution = resolution or pyramid.resolution_for_loading()
+    with open(json_path) as f:
+        data = json.load(f)
+    keep = quarantine_mask([post['path'] for post in data['posts']], resolution, json_path) if honour_quarantine else None
+    if keep is not None:
+        data['posts'] = [post for post, kept in zip(data['posts'], keep) if kept]
+    if resolve_paths:
+        for post, path in zip(data['posts'], resolve_all([post['path'] for post in data['posts']], resolution)):
+            post['path'] = path
+    return data
+
+def get_subreddit_indices_map(json_path=train_path_default, manifest_path=manifest_path_default):
+    if exists(manifest_path):
+        return open_manifest(manifest_path).subreddit_indices_map
+    if json_path not in json_cache:
+        with open(json_path) as f:
+            json_cache[json_path] = json.load(f)['subreddit_indices_map']
+    return json_cache[json_path]
+
+reverse_maps = {}
+
+def get_subreddit_for_index(index, json_path=train_path_default, manifest_path=manifest_path_default):
+    if exists(manifest_path):
+        return open_manifest(manifest_path).subreddit_for_index(index)
+    if json_path not in reverse_maps:
+        reverse_maps[json_path] = {v: k for k, v in get_subreddit_indices_map(json_path, manifest_path).items()}
+    return reverse_maps[json_path][index]
+
+def from_json(json_path, manifest_path=manifest_path_default, split=None):
+    # a new manifest, or the split added next to those of the existing one: posts it already
+    # has (same id and path, augmented copies share the id) are reused, the others appended
+    with open(json_path) as f:
+        data = json.load(f)
+    split = split or split_name(json_path)
+    if not exists(manifest_path):
+        return write(manifest_path, data['posts'], data['subreddit_indices_map'], {split: range(len(data['posts']))})
+    m = open_manifest(manifest_path)
+    if data['subreddit_indices_map'] != m.subreddit_indices_map:
+        raise ValueError('{} labels subreddits differently from {}'.format(json_path, manifest_path))
+    everything = m.indices()
+    positions = {key: i for i, key in enumerate(zip(m.values('id', everything), m.values('path', everything)))}
+    new_posts = []
+    indices = []
+    for post in data['posts']:
+        key = (u'{}'.format(post['id']), u'{}'.format(post['path']))
+        if key not in positions:
+            positions[key] = len(m) + len(new_posts)
+            new_posts.append(post)
+        indices.append(positions[key])
+    if not new_posts:
+        m.write_split(split, indices)
+        return m
+    splits = {name: np.array(m.indices(name)) for name in m.meta['splits']}
+    splits[split] = indices
+    return write(manifest_path, m.posts() + new_posts, m.subreddit_indices_map, splits)
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='convert post json into a columnar manifest, or add it to an existing one as a split')
+    parser.add_argument('json_path', type=str, help='json file of posts, e.g. train.json')
+    parser.add_argument('--manifest', type=str, default=manifest_path_default, help='manifest directory to write')
+    parser.add_argument('--split', type=str, help='split name for the posts (default: json file name)')
+    args = parser.parse_args()
+    m = from_json(args.json_path, args.manifest, args.split)
+    print('wrote {} posts to {}'.format(len(m), args.manifest))
@@ -0,0 +1,213 @@
+import contextlib
+import functools
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import numpy as np
+
+sample_interval_default = 0.05
+top_allocations_default = 10
+# frames kept per allocation, enough to get out of numpy and keras to the line that asked
+trace_frames_default = 16
+library_dirs = (os.path.dirname(np.__file__), 'site-packages', 'dist-packages')
+# re-snapshot numpy allocations when traced memory grows this much past the last snapshot
+snapshot_growth = 1.1
+snapshot_min_interval = 1.0
+
+def rss_mb():
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') / (1024. * 1024.)
+    except (IOError, OSError, ValueError):
+        return max_rss_mb()
+
+def max_rss_mb():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return rss / (1024. * 1024.)
+    return rss / 1024.
+
+def caller_frame(traceback):
+    # the most recent frame outside numpy and installed packages, else the oldest one traced
+    for frame in reversed(traceback):
+        if not any(d in frame.filename for d in library_dirs):
+            return frame
+    return traceback[0]
+
+def numpy_allocations(snapshot, top):
+    # numpy registers array buffers under its own tracemalloc domain
+    snapshot = snapshot.filter_traces([tracemalloc.DomainFilter(True, np.lib.tracemalloc_domain)])
+    by_location = {}
+    for stat in snapshot.statistics('traceback'):
+        frame = caller_frame(stat.traceback)
+        location = '{}:{}'.format(frame.filename, frame.lineno)
+        size, count = by_location.get(location, (0, 0))
+        by_location[location] = (size + stat.size, count + stat.count)
+    allocations = []
+    for location, (size, count) in sorted(by_location.items(), key=lambda item: -item[1][0])[:top]:
+        allocations.append({
+            'location': location,
+            'size_mb': size / (1024. * 1024.),
+            'count': count,
+        })
+    return allocations
+
+class MemoryTracker(object):
+    def __init__(self, output_path, trace=False, interval=sample_interval_default, top=top_allocations_default):
+        self.output_path = output_path
+        self.trace = trace
+        self.interval = interval
+        self.top = top
+        self.phases = []
+        self.stack = []
+        self.lock = threading.Lock()
+        self.running = False
+
+    def start(self):
+        if self.trace and not tracemalloc.is_tracing():
+            tracemalloc.start(trace_frames_default)
+        self.start_time = time.time()
+        self.running = True
+        self.sampler = threading.Thread(target=self.sample_loop)
+        self.sampler.daemon = True
+        self.sampler.start()
+
+    def stop(self):
+        self.running = False
+        self.sampler.join()
+        self.save()
+        if self.trace:
+            tracemalloc.stop()
+
+    def sample_loop(self):
+        while self.running:
+            rss = rss_mb()
+            with self.lock:
+                for phase in self.stack:
+                    phase['rss_peak_mb'] = max(phase['rss_peak_mb'], rss)
+                    phase['samples'] += 1
+                if self.trace and self.stack:
+                    self.maybe_snapshot(self.stack[-1])
+            time.sleep(self.interval)
+
+    def maybe_snapshot(self, phase):
+        current, _ = tracemalloc.get_traced_memory()
+        now = time.time()
+        if current < phase['snapshot_traced'] * snapshot_growth or now - phase['snapshot_time'] < snapshot_min_interval:
+            return
+        phase['snapshot_traced'] = current
+        phase['snapshot_time'] = now
+        phase['largest_numpy_allocations'] = numpy_allocations(tracemalloc.take_snapshot(), self.top)
+
+    def traced_peak_mb(self):
+        # peak since the last call, so each phase measures only its own span
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.reset_peak()
+        return peak / (1024. * 1024.)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        rss = rss_mb()
+        with self.lock:
+            path = '/'.join([p['name'] for p in self.stack] + [name])
+            phase = {
+                'name': path,
+                'start_s': time.time() - self.start_time,
+                'rss_start_mb': rss,
+                'rss_peak_mb': rss,
+                'samples': 0,
+                'snapshot_traced': 0,
+                'snapshot_time': 0.,
+            }
+            if self.trace:
+                # the peak so far belongs to the enclosing phases, not to this one
+                before = self.traced_peak_mb()
+                for parent in self.stack:
+                    parent['traced_peak_mb'] = max(parent['traced_peak_mb'], before)
+                phase['traced_peak_mb'] = 0.
+            self.stack.append(phase)
+        # record the phase we are entering, so an OOM kill still shows where it happened
+        self.save()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.stack.remove(phase)
+                phase['end_s'] = time.time() - self.start_time
+                phase['rss_end_mb'] = rss_mb()
+                phase['rss_peak_mb'] = max(phase['rss_peak_mb'], phase['rss_end_mb'])
+                phase['max_rss_mb'] = max_rss_mb()
+                if self.trace:
+                    peak = max(phase['traced_peak_mb'], self.traced_peak_mb())
+                    phase['traced_peak_mb'] = peak
+                    # enclosing phases saw this peak too
+                    for parent in self.stack:
+                        parent['traced_peak_mb'] = max(parent['traced_peak_mb'], peak)
+                    if tracemalloc.get_traced_memory()[0] > phase['snapshot_traced']:
+                        phase['largest_numpy_allocations'] = numpy_allocations(tracemalloc.take_snapshot(), self.top)
+                for key in ['snapshot_traced', 'snapshot_time']:
+                    del phase[key]
+                self.phases.append(phase)
+            self.save()
+
+    def save(self):
+        with self.lock:
+            report = {
+                'pid': os.getpid(),
+                'argv': sys.argv,
+                'trace_numpy': self.trace,
+                'in_progress': [p['name'] for p in self.stack],
+                'max_rss_mb': max_rss_mb(),
+                'phases': [dict((k, v) for k, v in p.items() if k not in ['snapshot_traced', 'snapshot_time']) for p in self.phases],
+            }
+        directory = os.path.dirname(self.output_path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(self.output_path, 'w') as f:
+            json.dump(report, f, indent=2)
+
+# module level tracker so library functions can mark phases without threading a tracker through
+tracker = None
+
+def start(output_path, trace=False):
+    global tracker
+    tracker = MemoryTracker(output_path, trace=trace)
+    tracker.start()
+    return tracker
+
+def stop():
+    global tracker
+    if tracker is not None:
+        tracker.stop()
+        print('memory report written to ' + tracker.output_path)
+        tracker = None
+
+@contextlib.contextmanager
+def phase(name):
+    if tracker is None:
+        yield
+    else:
+        with tracker.phase(name):
+            yield
+
+def phased(name):
+    # decorator form of phase() for loaders and model builders
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with phase(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
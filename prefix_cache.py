@@ -0,0 +1,70 @@
+import hashlib
+from collections import OrderedDict
+
+import serving_metrics
+
+# decoder outputs (next-word probabilities, h, c) after a title prefix, keyed by the
+# title's initial decoder state and the prefix's word ids. beams of one search, the
+# same image asked for again, or a beam search after a greedy one all start from the same
+# prefixes, so their decoder steps are looked up instead of recomputed
+max_mb_default = 64
+
+def state_key(h, c):
+    # the initial states are a function of the encoder output, so they identify it
+    return hashlib.sha1(h.tobytes() + c.tobytes()).hexdigest()
+
+class PrefixStateCache(object):
+    # LRU bounded by the bytes of the arrays it holds
+    def __init__(self, max_mb=max_mb_default, name='prefix_state'):
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.name = name
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            serving_metrics.inc('cache_lookups_total', cache=self.name, result='miss')
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        serving_metrics.inc('cache_lookups_total', cache=self.name, result='hit')
+        return entry
+
+    def put(self, key, entry):
+        if key in self.entries:
+            return
+        size = sum(array.nbytes for array in entry)
+        if size > self.max_bytes:
+            return
+        self.entries[key] = entry
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.bytes -= sum(array.nbytes for array in evicted)
+            self.evictions += 1
+        serving_metrics.set_gauge('cache_bytes', self.bytes, cache=self.name)
+
+    def clear(self):
+        self.entries.clear()
+        self.bytes = 0
+        serving_metrics.set_gauge('cache_bytes', 0, cache=self.name)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self.entries),
+            'mb': self.bytes / (1024. * 1024.),
+            'max_mb': self.max_bytes / (1024. * 1024.),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / float(lookups) if lookups else 0.,
+            'evictions': self.evictions,
+        }
@@ -0,0 +1,159 @@
+import csv
+import json
+import os
+import threading
+import time
+
+import keras
+from keras import backend as K
+from keras.callbacks import Callback
+
+timeline_json = 'timeline.json'
+timeline_csv = 'timeline.csv'
+timeline_fields = ['epoch', 'batch', 'size', 'data_wait_s', 'fetch_s', 'step_s', 'queue_depth', 'images_per_sec', 'loss']
+# fraction of wall time spent waiting on data above which an epoch is reported as input bound
+input_bound_threshold = 0.5
+
+class PipelineStats(object):
+    # shared between a TimedSequence (producer threads) and a StepTimeline (consumer)
+    # counts only propagate with thread workers, not with use_multiprocessing=True
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.fetched = 0
+        self.consumed = 0
+        self.fetch_times = []
+
+    def record_fetch(self, seconds):
+        with self.lock:
+            self.fetched += 1
+            self.fetch_times.append(seconds)
+
+    def record_consume(self):
+        with self.lock:
+            self.consumed += 1
+            depth = self.fetched - self.consumed
+            return max(depth, 0)
+
+    def pop_fetch_times(self):
+        with self.lock:
+            fetch_times = self.fetch_times
+            self.fetch_times = []
+            return fetch_times
+
+class TimedSequence(keras.utils.Sequence):
+    # wraps any Sequence and times each batch fetch (image decoding, preprocessing, ...)
+    def __init__(self, sequence, stats):
+        self.sequence = sequence
+        self.stats = stats
+
+    def __len__(self):
+        return len(self.sequence)
+
+    def __getitem__(self, index):
+        start = time.time()
+        batch = self.sequence[index]
+        self.stats.record_fetch(time.time() - start)
+        return batch
+
+    def on_epoch_end(self):
+        self.sequence.on_epoch_end()
+
+class StepTimeline(Callback):
+    def __init__(self, output_dir, log_dir=None, stats=None):
+        super(StepTimeline, self).__init__()
+        self.output_dir = output_dir
+        self.log_dir = log_dir
+        self.stats = stats
+        self.rows = []
+        self.epochs = []
+        self.writer = None
+
+    def on_train_begin(self, logs=None):
+        if self.log_dir and K.backend() == 'tensorflow':
+            import tensorflow as tf
+            self.writer = tf.summary.FileWriter(os.path.join(self.log_dir, 'profile'))
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch = epoch
+        self.epoch_start = time.time()
+        self.last_batch_end = self.epoch_start
+        self.epoch_rows = []
+
+    def on_batch_begin(self, batch, logs=None):
+        self.batch_start = time.time()
+        self.data_wait = self.batch_start - self.last_batch_end
+        self.queue_depth = self.stats.record_consume() if self.stats else None
+
+    def on_batch_end(self, batch, logs=None):
+        logs = logs or {}
+        now = time.time()
+        step = now - self.batch_start
+        size = logs.get('size', 0)
+        fetch_times = self.stats.pop_fetch_times() if self.stats else []
+        row = {
+            'epoch': self.epoch,
+            'batch': batch,
+            'size': int(size),
+            'data_wait_s': self.data_wait,
+            'fetch_s': sum(fetch_times) / len(fetch_times) if fetch_times else None,
+            'step_s': step,
+            'queue_depth': self.queue_depth,
+            'images_per_sec': size / (now - self.last_batch_end) if now > self.last_batch_end else None,
+            'loss': float(logs['loss']) if 'loss' in logs else None,
+        }
+        self.epoch_rows.append(row)
+        self.last_batch_end = now
+
+    def on_epoch_end(self, epoch, logs=None):
+        rows = self.epoch_rows
+        self.rows.extend(rows)
+        if not rows:
+            return
+        data_wait = sum(r['data_wait_s'] for r in rows)
+        step = sum(r['step_s'] for r in rows)
+        images = sum(r['size'] for r in rows)
+        fetches = [r['fetch_s'] for r in rows if r['fetch_s'] is not None]
+        depths = [r['queue_depth'] for r in rows if r['queue_depth'] is not None]
+        summary = {
+            'epoch': epoch,
+            'batches': len(rows),
+            'data_wait_s': data_wait,
+            'step_s': step,
+            'data_wait_fraction': data_wait / (data_wait + step) if data_wait + step > 0 else 0.,
+            'mean_fetch_s': sum(fetches) / len(fetches) if fetches else None,
+            'mean_queue_depth': float(sum(depths)) / len(depths) if depths else None,
+            'images_per_sec': images / (data_wait + step) if data_wait + step > 0 else None,
+            # includes validation and the other callbacks
+            'epoch_s': time.time() - self.epoch_start,
+        }
+        summary['bound'] = 'input' if summary['data_wait_fraction'] > input_bound_threshold else 'compute'
+        self.epochs.append(summary)
+        print('epoch {}: {:.1f} images/sec, {:.0f}% waiting on data ({} bound)'.format(epoch,
+            summary['images_per_sec'] or 0., 100 * summary['data_wait_fraction'], summary['bound']))
+        self.write_summaries(summary)
+        self.save()
+
+    def on_train_end(self, logs=None):
+        self.save()
+        if self.writer is not None:
+            self.writer.close()
+
+    def write_summaries(self, summary):
+        if self.writer is None:
+            return
+        import tensorflow as tf
+        values = []
+        for key in ['data_wait_s', 'step_s', 'data_wait_fraction', 'mean_fetch_s', 'mean_queue_depth', 'images_per_sec']:
+            if summary[key] is not None:
+                values.append(tf.Summary.Value(tag='profile/' + key, simple_value=summary[key]))
+        self.writer.add_summary(tf.Summary(value=values), summary['epoch'])
+        self.writer.flush()
+
+    def save(self):
+        # rewritten every epoch so a killed run still leaves a timeline behind
+        with open(os.path.join(self.output_dir, timeline_json), 'w') as f:
+            json.dump({'epochs': self.epochs, 'batches': self.rows}, f)
+        with open(os.path.join(self.output_dir, timeline_csv), 'w') as f:
+            writer = csv.DictWriter(f, fieldnames=timeline_fields)
+            writer.writeheader()
+            writer.writerows(self.rows)
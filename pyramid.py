@@ -0,0 +1,90 @@
+import json
+import multiprocessing
+import os
+
+from PIL import Image, ImageOps
+
+# preprocessed copies of every image at several square resolutions, side by side with the
+# untouched originals: pyramid/<resolution>/<original file name>
+pyramid_path = 'pyramid/'
+levels_file = 'levels.json'
+
+def level_dir(resolution, root=pyramid_path):
+    return os.path.join(root, str(resolution))
+
+def level_path(path, resolution, root=pyramid_path):
+    return os.path.join(level_dir(resolution, root), os.path.basename(path))
+
+def build_image(task):
+    path, resolutions, root = task
+    targets = [(r, level_path(path, r, root)) for r in sorted(resolutions, reverse=True)]
+    mtime = os.path.getmtime(path)
+    todo = [(r, target) for r, target in targets if not os.path.exists(target) or os.path.getmtime(target) < mtime]
+    if not todo:
+        return path, 0
+    img = Image.open(path)
+    # let the jpeg decoder downscale by a power of two while staying above the largest level
+    largest = todo[0][0]
+    img.draft('RGB', (largest, largest))
+    img = img.convert('RGB')
+    for r, target in todo:
+        # each level is cut from the previous (already square) one, not the full original
+        img = ImageOps.fit(img, (r, r), Image.LANCZOS)
+        img.save(target)
+    return path, len(todo)
+
+def build(paths, resolutions, root=pyramid_path, default=None, workers=None):
+    for r in resolutions:
+        if not os.path.isdir(level_dir(r, root)):
+            os.makedirs(level_dir(r, root))
+    tasks = [(path, resolutions, root) for path in paths]
+    pool = multiprocessing.Pool(workers)
+    written = 0
+    try:
+        for path, count in pool.imap_unordered(build_image, tasks, 8):
+            written += count
+            if count:
+                print(path + ' ' + str(count) + ' levels')
+    finally:
+        pool.close()
+        pool.join()
+    info = read_levels(root) or {'levels': [], 'default': None}
+    all_levels = sorted(set(resolutions) | set(info['levels']))
+    # the level loaders use when no resolution is selected; the first build picks it
+    default = default or info['default'] or max(resolutions)
+    with open(os.path.join(root, levels_file), 'w') as f:
+        json.dump({'levels': all_levels, 'default': default}, f)
+    print('wrote {} images across levels {}, default {}'.format(written, all_levels, default))
+
+def read_levels(root=pyramid_path):
+    path = os.path.join(root, levels_file)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+def levels(root=pyramid_path):
+    info = read_levels(root)
+    return info['levels'] if info else []
+
+# level the loaders read; set from each entry point's resolution flag
+selected_resolution = None
+
+def select(resolution):
+    global selected_resolution
+    if resolution and resolution not in levels():
+        raise ValueError('no pyramid level {} (have {}), run get_datasets.py -p {}'.format(resolution, levels(), resolution))
+    selected_resolution = resolution
+
+def resolution_for_loading(root=pyramid_path):
+    # the selected level, else the pyramid's default level, else None for the original paths
+    if selected_resolution:
+        return selected_resolution
+    info = read_levels(root)
+    return info['default'] if info else None
+
+def resolve(path, resolution=None, root=pyramid_path):
+    resolution = resolution or resolution_for_loading(root)
+    if not resolution:
+        return path
+    return level_path(path, resolution, root)
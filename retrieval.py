@@ -0,0 +1,268 @@
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+from PIL import Image, ImageOps
+
+import manifest
+import pyramid
+
+# similar-post search over VGG16 GlobalAveragePooling features. embeddings are L2
+# normalized and kept in a float16 memmap next to their inverted-file assignment, so the
+# index opens without reading the matrix and grows by appending. queries score the
+# k-means centroids, then only the rows of the nprobe closest lists
+index_path_default = 'datasets.retrieval'
+meta_file = 'meta.json'
+posts_file = 'posts.jsonl'
+embeddings_file = 'embeddings.f16'
+assignments_file = 'assignments.i32'
+centroids_file = 'centroids.npy'
+dim = 512
+image_size_default = 224
+k_default = 10
+nprobe_default = 8
+batch_size_default = 32
+# lists are (re)trained once there are this many rows per list, and again when the index
+# has grown to retrain_growth times the size it was trained on
+rows_per_list = 39
+retrain_growth = 4
+kmeans_iterations = 10
+chunk_rows = 65536
+
+def num_lists_for(n):
+    return max(1, int(4 * np.sqrt(n)))
+
+def normalize(x):
+    x = np.asarray(x, dtype=np.float32)
+    return x / np.maximum(np.linalg.norm(x, axis=1, keepdims=True), 1e-12)
+
+def nearest_centroid(x, centroids):
+    # in chunks, so assigning a few hundred thousand rows never materializes all the scores
+    assignments = np.empty(len(x), dtype=np.int32)
+    for start in range(0, len(x), chunk_rows):
+        chunk = np.asarray(x[start:start + chunk_rows], dtype=np.float32)
+        assignments[start:start + len(chunk)] = np.argmax(chunk.dot(centroids.T), axis=1)
+    return assignments
+
+def kmeans(x, num_lists, rng, iterations=kmeans_iterations):
+    # spherical k-means: centroids are renormalized means, similarity is the dot product
+    centroids = normalize(x[rng.choice(len(x), num_lists, replace=False)])
+    for _ in range(iterations):
+        assignments = nearest_centroid(x, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, x)
+        counts = np.bincount(assignments, minlength=num_lists)
+        # an empty list restarts from a random row
+        empty = counts == 0
+        sums[empty] = x[rng.choice(len(x), int(empty.sum()))]
+        centroids = normalize(sums)
+    return centroids
+
+class RetrievalIndex(object):
+    def __init__(self, path=index_path_default):
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.meta = {'dim': dim, 'count': 0, 'capacity': 0, 'trained_on': 0}
+        if os.path.exists(os.path.join(path, meta_file)):
+            with open(os.path.join(path, meta_file)) as f:
+                self.meta = json.load(f)
+        self.posts = []
+        if os.path.exists(os.path.join(path, posts_file)):
+            with open(os.path.join(path, posts_file)) as f:
+                self.posts = [json.loads(line) for line in f]
+            if len(self.posts) > self.meta['count']:
+                # rows written after the last flush were lost with their embeddings
+                self.posts = self.posts[:self.meta['count']]
+                with open(os.path.join(path, posts_file), 'w') as f:
+                    for post in self.posts:
+                        f.write(json.dumps(post) + '\n')
+        self.keys = set(post['path'] for post in self.posts)
+        self.centroids = None
+        if os.path.exists(os.path.join(path, centroids_file)):
+            self.centroids = np.load(os.path.join(path, centroids_file))
+        self.embeddings = None
+        self.assignments = None
+        self.open_arrays(self.meta['capacity'])
+        self.lists = None
+
+    def __len__(self):
+        return self.meta['count']
+
+    def open_arrays(self, capacity):
+        self.embeddings = None
+        self.assignments = None
+        for name, dtype, width in [(embeddings_file, np.float16, self.meta['dim']), (assignments_file, np.int32, 1)]:
+            with open(os.path.join(self.path, name), 'ab') as f:
+                f.truncate(capacity * width * np.dtype(dtype).itemsize)
+        self.meta['capacity'] = capacity
+        if capacity:
+            self.embeddings = np.memmap(os.path.join(self.path, embeddings_file), dtype=np.float16, mode='r+', shape=(capacity, self.meta['dim']))
+            self.assignments = np.memmap(os.path.join(self.path, assignments_file), dtype=np.int32, mode='r+', shape=(capacity,))
+
+    def contains(self, key):
+        return key in self.keys
+
+    def insert(self, vectors, posts):
+        # appends normalized embeddings; they join their nearest list right away and the
+        # lists are retrained only when the index has outgrown them
+        vectors = normalize(vectors)
+        n, count = len(vectors), self.meta['count']
+        if count + n > self.meta['capacity']:
+            self.flush()
+            self.open_arrays(max(2 * self.meta['capacity'], count + n, 1024))
+        self.embeddings[count:count + n] = vectors
+        self.assignments[count:count + n] = nearest_centroid(vectors, self.centroids) if self.centroids is not None else 0
+        self.meta['count'] = count + n
+        with open(os.path.join(self.path, posts_file), 'a') as f:
+            for post in posts:
+                f.write(json.dumps(post) + '\n')
+        self.posts.extend(posts)
+        self.keys.update(post['path'] for post in posts)
+        self.lists = None
+        trained_on = self.meta['trained_on']
+        if len(self) >= rows_per_list * num_lists_for(len(self)) and (not trained_on or len(self) >= retrain_growth * trained_on):
+            self.train()
+
+    def train(self, num_lists=None, seed=0):
+        n = len(self)
+        num_lists = min(num_lists or num_lists_for(n), n)
+        rng = np.random.RandomState(seed)
+        sample = rng.choice(n, min(n, 256 * num_lists), replace=False)
+        start = time.time()
+        self.centroids = kmeans(np.asarray(self.embeddings[np.sort(sample)], dtype=np.float32), num_lists, rng)
+        self.assignments[:n] = nearest_centroid(self.embeddings[:n], self.centroids)
+        self.meta['trained_on'] = n
+        self.meta['num_lists'] = num_lists
+        self.lists = None
+        np.save(os.path.join(self.path, centroids_file), self.centroids)
+        print('trained {} lists on {} rows in {:.1f}s'.format(num_lists, n, time.time() - start))
+
+    def build_lists(self):
+        # rows grouped by list: lists[0][offsets[l]:offsets[l + 1]] are the rows of list l
+        assignments = np.asarray(self.assignments[:len(self)])
+        order = np.argsort(assignments, kind='stable').astype(np.int64)
+        offsets = np.zeros(len(self.centroids) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(assignments, minlength=len(self.centroids)))
+        self.lists = order, offsets
+
+    def candidates(self, query, nprobe):
+        if self.centroids is None:
+            return np.arange(len(self))
+        if self.lists is None:
+            self.build_lists()
+        order, offsets = self.lists
+        # the nprobe nearest lists that have rows, so a query never comes back empty
+        # because its nearest centroids lost all their rows
+        nonempty = np.flatnonzero(np.diff(offsets))
+        nprobe = min(nprobe, len(nonempty))
+        if not nprobe:
+            return np.zeros(0, dtype=np.int64)
+        probes = nonempty[np.argpartition(-self.centroids[nonempty].dot(query), nprobe - 1)[:nprobe]]
+        return np.sort(np.concatenate([order[offsets[l]:offsets[l + 1]] for l in probes]))
+
+    def query(self, vector, k=k_default, nprobe=nprobe_default):
+        # (row, cosine similarity) of the k nearest indexed posts, nearest first
+        if not len(self):
+            return []
+        query = normalize(np.asarray(vector).reshape(1, -1))[0]
+        rows = self.candidates(query, nprobe)
+        if not len(rows):
+            return []
+        similarities = np.asarray(self.embeddings[rows], dtype=np.float32).dot(query)
+        k = min(k, len(rows))
+        top = np.argpartition(-similarities, k - 1)[:k]
+        top = top[np.argsort(-similarities[top], kind='stable')]
+        return [(int(rows[i]), float(similarities[i])) for i in top]
+
+    def results(self, vector, k=k_default, nprobe=nprobe_default):
+        results = []
+        for row, similarity in self.query(vector, k, nprobe):
+            post = dict(self.posts[row])
+            post['similarity'] = similarity
+            results.append(post)
+        return results
+
+    def flush(self):
+        for array in [self.embeddings, self.assignments]:
+            if array is not None:
+                array.flush()
+        tmp_path = os.path.join(self.path, meta_file + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(self.meta, f)
+        os.rename(tmp_path, os.path.join(self.path, meta_file))
+
+def load_image(path, size=image_size_default):
+    from keras.applications.vgg16 import preprocess_input
+    img = Image.open(path).convert('RGB')
+    if img.size != (size, size):
+        img = ImageOps.fit(img, (size, size), Image.LANCZOS)
+    return preprocess_input(np.array(img, dtype=np.float64))
+
+def create_embedding_model():
+    # the features the classifiers and the titling model put their heads on
+    from keras.applications.vgg16 import VGG16
+    from keras.layers import GlobalAveragePooling2D
+    from keras.models import Model
+    base_model = VGG16(weights='imagenet', include_top=False)
+    return Model(inputs=base_model.input, outputs=GlobalAveragePooling2D()(base_model.output))
+
+def build(json_path, index_path, batch_size=batch_size_default, size=image_size_default):
+    index = RetrievalIndex(index_path)
+    data = manifest.load(json_path, resolve_paths=False)
+    subreddits = {v: k for k, v in data['subreddit_indices_map'].items()}
+    # posts are keyed by their original path and embedded from the selected pyramid level
+    posts = [post for post in data['posts'] if not index.contains(post['path'])]
+    print('{} posts to embed, {} already indexed'.format(len(posts), len(index)))
+    model = create_embedding_model()
+    start = time.time()
+    for i in range(0, len(posts), batch_size):
+        batch, imgs = [], []
+        for post in posts[i:i + batch_size]:
+            try:
+                imgs.append(load_image(pyramid.resolve(post['path']), size))
+            except IOError as e:
+                print('could not load {}: {}'.format(post['path'], e))
+                continue
+            batch.append({'id': post['id'], 'path': post['path'], 'title': post['title'],
+                'subreddit': subreddits[post['subreddit']], 'score': int(post['score'])})
+        if batch:
+            index.insert(model.predict(np.array(imgs), batch_size=len(imgs)), batch)
+        print('embedded {}/{} ({:.1f} images/s)'.format(min(i + batch_size, len(posts)), len(posts),
+            min(i + batch_size, len(posts)) / max(time.time() - start, 1e-9)))
+    index.flush()
+    print('{} posts indexed in {} lists'.format(len(index), index.meta.get('num_lists', 0)))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='nearest historical posts by VGG16 image embedding')
+    parser.add_argument('--build', type=str, help='embed and add every post of this post json/split to the index')
+    parser.add_argument('--query', type=str, help='image to look up')
+    parser.add_argument('--index', type=str, default=index_path_default, help='index directory')
+    parser.add_argument('-k', type=int, default=k_default, help='posts to return')
+    parser.add_argument('--nprobe', type=int, default=nprobe_default, help='inverted lists to search per query')
+    parser.add_argument('--by_score', action='store_true', help='order the k nearest posts by reddit score')
+    parser.add_argument('--retrain', type=int, help='retrain the index with this many lists')
+    parser.add_argument('--batch_size', type=int, default=batch_size_default, help='images per embedding batch')
+    parser.add_argument('-r', type=int, help='image resolution, i.e. pyramid level to embed (default: the pyramid\'s default level)')
+    args = parser.parse_args()
+
+    pyramid.select(args.r)
+    size = args.r or pyramid.resolution_for_loading() or image_size_default
+    if args.build:
+        build(args.build, args.index, args.batch_size, size)
+    if args.retrain:
+        index = RetrievalIndex(args.index)
+        index.train(args.retrain)
+        index.flush()
+    if args.query:
+        index = RetrievalIndex(args.index)
+        vector = create_embedding_model().predict(np.array([load_image(args.query, size)]))[0]
+        start = time.time()
+        results = index.results(vector, args.k, args.nprobe)
+        print('{} nearest of {} posts in {:.1f} ms'.format(len(results), len(index), 1000 * (time.time() - start)))
+        if args.by_score:
+            results.sort(key=lambda post: post['score'], reverse=True)
+        for post in results:
+            print('{:.3f} [{}] r/{} {} ({})'.format(post['similarity'], post['score'], post['subreddit'], post['title'], post['path']))
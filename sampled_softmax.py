@@ -0,0 +1,81 @@
+import numpy as np
+from keras import backend as K
+from keras.engine.topology import Layer
+
+# a drop-in for TimeDistributed(Dense(vocab_size)) + softmax that only trains against the
+# true word and num_sampled words drawn by training frequency, so the output layer's cost
+# per token no longer grows with the vocabulary. its weights are a Dense layer's
+# [kernel, bias], so inference copies them into the usual full softmax and stays exact
+num_sampled_default = 1024
+# flattens the unigram distribution like word2vec's negative sampling
+distortion = 0.75
+
+class SampledSoftmax(Layer):
+    # inputs: [decoder hidden states (batch, steps, units), target ids (batch, steps)];
+    # outputs the per-token cross entropy, sampled when training and exact otherwise
+    def __init__(self, vocab_size, num_sampled=num_sampled_default, word_counts=None, **kwargs):
+        super(SampledSoftmax, self).__init__(**kwargs)
+        self.vocab_size = vocab_size
+        self.num_sampled = min(num_sampled, vocab_size)
+        # not part of the config: models are rebuilt in code, and a full vocabulary's counts
+        # would not fit in an hdf5 attribute. without counts, candidates are drawn uniformly
+        self.word_counts = None if word_counts is None else [float(c) for c in np.maximum(word_counts, 1)]
+        self.supports_masking = True
+
+    def build(self, input_shape):
+        units = input_shape[0][-1]
+        self.kernel = self.add_weight(name='kernel', shape=(units, self.vocab_size), initializer='glorot_uniform')
+        self.bias = self.add_weight(name='bias', shape=(self.vocab_size,), initializer='zeros')
+        super(SampledSoftmax, self).build(input_shape)
+
+    def sample(self, labels):
+        import tensorflow as tf
+        if self.word_counts is None:
+            return tf.nn.uniform_candidate_sampler(labels, 1, self.num_sampled, True, self.vocab_size)
+        return tf.nn.fixed_unigram_candidate_sampler(labels, 1, self.num_sampled, True, self.vocab_size,
+            distortion=distortion, unigrams=self.word_counts)
+
+    def sampled_loss(self, hidden, labels):
+        import tensorflow as tf
+        sampled, true_expected, sampled_expected = self.sample(labels)
+        labels = labels[:, 0]
+        # columns of the kernel for the true words and the shared candidates only
+        true_weights = K.transpose(tf.gather(self.kernel, labels, axis=1))
+        true_logits = K.sum(hidden * true_weights, axis=1) + K.gather(self.bias, labels) - K.log(true_expected[:, 0])
+        sampled_logits = K.dot(hidden, tf.gather(self.kernel, sampled, axis=1)) + K.gather(self.bias, sampled) - K.log(sampled_expected)
+        # a candidate that is the token's own target is not a negative for it
+        hits = K.equal(K.expand_dims(labels, 1), K.expand_dims(sampled, 0))
+        sampled_logits = tf.where(hits, K.ones_like(sampled_logits) * -1e9, sampled_logits)
+        logits = K.concatenate([K.expand_dims(true_logits, 1), sampled_logits], axis=1)
+        return tf.reduce_logsumexp(logits, axis=1) - true_logits
+
+    def full_loss(self, hidden, labels):
+        import tensorflow as tf
+        logits = K.bias_add(K.dot(hidden, self.kernel), self.bias)
+        return tf.nn.sparse_softmax_cross_entropy_with_logits(labels=labels[:, 0], logits=logits)
+
+    def call(self, inputs, mask=None, training=None):
+        hidden, targets = inputs
+        flat_hidden = K.reshape(hidden, (-1, K.int_shape(hidden)[-1]))
+        labels = K.reshape(K.cast(targets, 'int64'), (-1, 1))
+        loss = K.in_train_phase(lambda: self.sampled_loss(flat_hidden, labels),
+            lambda: self.full_loss(flat_hidden, labels), training=training)
+        return K.reshape(loss, K.shape(targets))
+
+    def compute_output_shape(self, input_shape):
+        return input_shape[1]
+
+    def compute_mask(self, inputs, mask=None):
+        # padding positions of the titles, so keras leaves them out of the loss
+        return None if mask is None else mask[0]
+
+    def get_config(self):
+        config = {'vocab_size': self.vocab_size, 'num_sampled': self.num_sampled}
+        base_config = super(SampledSoftmax, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
+
+def sampled_softmax_loss(y_true, y_pred):
+    # the layer's output already is the loss; y_true is a placeholder of the same shape
+    return y_pred
+
+custom_objects = {'SampledSoftmax': SampledSoftmax, 'sampled_softmax_loss': sampled_softmax_loss}
@@ -0,0 +1,202 @@
+import contextlib
+import functools
+import os
+import threading
+import time
+
+# request counters and latency histograms for the predict and title generation paths, in
+# the prometheus text format: served over http (/metrics) and/or rewritten to a file every
+# few seconds for a node_exporter textfile collector. nothing is recorded until start()
+prefix = 'redditnet_'
+interval_default = 15.
+latency_buckets = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., 30.]
+size_buckets = [1, 2, 4, 8, 16, 32, 64, 128, 256, 512]
+
+# name: (type, help, buckets)
+definitions = {
+    'predict_requests_total': ('counter', 'classifier predictions served', None),
+    'predict_seconds': ('histogram', 'latency of one classifier prediction, image loading included', latency_buckets),
+    'batch_size': ('histogram', 'images per model call', size_buckets),
+    'title_requests_total': ('counter', 'title generation calls', None),
+    'title_phase_seconds': ('histogram', 'title generation latency by phase: encoder (cnn and projection), '
+        'decoder_step (one token for every row), beam (search bookkeeping between steps), decode (whole search)', latency_buckets),
+    'title_tokens_total': ('counter', 'title tokens generated, <END> included', None),
+    'cache_lookups_total': ('counter', 'cache lookups by cache and result (hit or miss)', None),
+    'cache_bytes': ('gauge', 'memory held by a cache', None),
+}
+
+def format_labels(labels, extra=None):
+    items = sorted(labels) + ([extra] if extra else [])
+    if not items:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in items) + '}'
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Registry(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        # name -> {labels tuple: value}, or for histograms {labels tuple: [bucket counts, sum, count]}
+        self.values = dict((name, {}) for name in definitions)
+
+    def inc(self, name, value=1, labels=()):
+        with self.lock:
+            series = self.values[name]
+            series[labels] = series.get(labels, 0) + value
+
+    def set(self, name, value, labels=()):
+        with self.lock:
+            self.values[name][labels] = value
+
+    def observe(self, name, value, labels=()):
+        buckets = definitions[name][2]
+        with self.lock:
+            series = self.values[name]
+            if labels not in series:
+                series[labels] = [[0] * len(buckets), 0., 0]
+            histogram = series[labels]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for name in sorted(definitions):
+                kind, help_text, buckets = definitions[name]
+                full_name = prefix + name
+                lines.append('# HELP {} {}'.format(full_name, help_text))
+                lines.append('# TYPE {} {}'.format(full_name, kind))
+                for labels, value in sorted(self.values[name].items()):
+                    if kind != 'histogram':
+                        lines.append('{}{} {}'.format(full_name, format_labels(labels), format_value(value)))
+                        continue
+                    counts, total, count = value
+                    for bound, bucket_count in zip(buckets + [float('inf')], counts + [count]):
+                        lines.append('{}_bucket{} {}'.format(full_name, format_labels(labels, ('le', format_value(bound))), bucket_count))
+                    lines.append('{}_sum{} {}'.format(full_name, format_labels(labels), format_value(total)))
+                    lines.append('{}_count{} {}'.format(full_name, format_labels(labels), count))
+        return '\n'.join(lines) + '\n'
+
+class Exporter(object):
+    def __init__(self, registry, port=None, path=None, interval=interval_default):
+        self.registry = registry
+        self.port = port
+        self.path = path
+        self.interval = interval
+        self.server = None
+        self.writer = None
+        self.stopped = threading.Event()
+
+    def start(self):
+        if self.port:
+            from http.server import BaseHTTPRequestHandler, HTTPServer
+            registry = self.registry
+
+            class Handler(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    if self.path.split('?')[0] != '/metrics':
+                        self.send_error(404)
+                        return
+                    body = registry.render().encode('utf-8')
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, *args):
+                    pass
+
+            self.server = HTTPServer(('', self.port), Handler)
+            thread = threading.Thread(target=self.server.serve_forever)
+            thread.daemon = True
+            thread.start()
+            print('serving metrics on http://localhost:{}/metrics'.format(self.server.server_port))
+        if self.path:
+            self.writer = threading.Thread(target=self.write_loop)
+            self.writer.daemon = True
+            self.writer.start()
+
+    def write(self):
+        # rename over the old file, so a scraper never reads half of it
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(self.registry.render())
+        os.rename(tmp_path, self.path)
+
+    def write_loop(self):
+        while not self.stopped.wait(self.interval):
+            self.write()
+
+    def stop(self):
+        self.stopped.set()
+        if self.writer is not None:
+            self.writer.join()
+            self.write()
+            print('metrics written to ' + self.path)
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+# module level registry like memory_profile's tracker, so models record without a handle
+registry = None
+exporter = None
+
+def add_arguments(parser):
+    parser.add_argument('--metrics_port', type=int, help='serve prometheus metrics on this port at /metrics')
+    parser.add_argument('--metrics_file', type=str, help='write prometheus metrics to this file (textfile collector)')
+    parser.add_argument('--metrics_interval', type=float, default=interval_default, help='seconds between metrics file writes')
+
+def start(port=None, path=None, interval=interval_default):
+    global registry, exporter
+    registry = Registry()
+    exporter = Exporter(registry, port, path, interval)
+    exporter.start()
+    return registry
+
+def start_from_config(config):
+    if getattr(config, 'metrics_port', None) or getattr(config, 'metrics_file', None):
+        start(config.metrics_port, config.metrics_file, config.metrics_interval)
+
+def stop():
+    global registry, exporter
+    if exporter is not None:
+        exporter.stop()
+    registry = None
+    exporter = None
+
+def inc(name, value=1, **labels):
+    if registry is not None:
+        registry.inc(name, value, tuple(sorted(labels.items())))
+
+def set_gauge(name, value, **labels):
+    if registry is not None:
+        registry.set(name, value, tuple(sorted(labels.items())))
+
+def observe(name, value, **labels):
+    if registry is not None:
+        registry.observe(name, value, tuple(sorted(labels.items())))
+
+@contextlib.contextmanager
+def timer(name, **labels):
+    start_time = time.time()
+    try:
+        yield
+    finally:
+        observe(name, time.time() - start_time, **labels)
+
+def timed(name, **labels):
+    # decorator form of timer()
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with timer(name, **labels):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,23 @@
+import os
+
+def parse_threads(spec):
+    # "intra:inter", e.g. "4:2"; 0 lets tensorflow pick
+    intra, _, inter = spec.partition(':')
+    return int(intra or 0), int(inter or 0)
+
+def configure_session(intra_op_threads=0, inter_op_threads=0):
+    # must run before the first model is built, or after K.clear_session()
+    from keras import backend as K
+    if K.backend() != 'tensorflow':
+        return
+    import tensorflow as tf
+    if intra_op_threads:
+        os.environ['OMP_NUM_THREADS'] = str(intra_op_threads)
+    session_config = tf.ConfigProto(intra_op_parallelism_threads=intra_op_threads,
+        inter_op_parallelism_threads=inter_op_threads)
+    K.set_session(tf.Session(config=session_config))
+
+def reset_session(intra_op_threads=0, inter_op_threads=0):
+    from keras import backend as K
+    K.clear_session()
+    configure_session(intra_op_threads, inter_op_threads)
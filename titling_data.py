@@ -8,6 +8,10 @@ from keras.preprocessing.text import text_to_word_sequence
 from keras.preprocessing.sequence import pad_sequences
 from keras.applications.vgg16 import preprocess_input
 
+import memory_profile
+import manifest
+import distributed
+
 NUM_SUBREDDITS = 20
 START_TOKEN = '<START>'
 PAD_TOKEN = '<PAD>'
@@ -15,15 +19,31 @@ UNKNOWN_TOKEN = '<UNK>'
 END_TOKEN = '<END>'
 
 class ImageTitlingDataGenerator(keras.utils.Sequence):
-    def __init__(self, json_path, ids_by_word, max_len, num_subreddits, batch_size=32):
-        with open(json_path) as f:
-            data = json.load(f)
-            self.posts = data['posts'][:100]
+    def __init__(self, json_path, ids_by_word, max_len, num_subreddits, batch_size=32, shard=False, bucketed=True, sparse_targets=False, indices=None):
+        columns = manifest.load_columns(json_path, ['path', 'subreddit', 'title'])
+        if indices is None:
+            indices = range(min(100, len(columns['path'])))
+        # positions in the split, e.g. a stratified subsample from create_small.sample_labels;
+        # dicts only for the posts used
+        self.posts = [{'path': columns['path'][i], 'subreddit': int(columns['subreddit'][i]), 'title': columns['title'][i]}
+            for i in indices]
+        if shard:
+            # this worker's part of the data when training data-parallel
+            self.posts = distributed.shard(self.posts)
 
         self.batch_size = batch_size
         self.num_subreddits = num_subreddits
         self.ids_by_word = ids_by_word
         self.max_len = max_len
+        # with bucketing, batches hold titles of similar length and are padded only to their
+        # longest title instead of max_len; the train model takes any sequence length
+        self.bucketed = bucketed
+        # target word ids as a fourth input instead of one-hot outputs, for the sampled
+        # softmax train model; the outputs are then a placeholder it ignores
+        self.sparse_targets = sparse_targets
+        self.lengths = np.array([title_length(post['title'], max_len) for post in self.posts])
+        self.real_tokens = 0
+        self.padded_tokens = 0
 
         self.on_epoch_end()
 
@@ -31,9 +51,22 @@ class ImageTitlingDataGenerator(keras.utils.Sequence):
         return int(np.floor(len(self.posts) / self.batch_size))
 
     def __getitem__(self, index):
-        start = index * self.batch_size
-        end = start + self.batch_size
-        indices = self.indices[start:end]
+        # a batch whose images are all unreadable would reach fit_generator with zero rows,
+        # so the next batches stand in for it
+        for offset in range(len(self)):
+            inputs, y = self.batch(self.batches[(index + offset) % len(self)])
+            if len(y):
+                return inputs, y
+            print('no readable image in batch {}, using the next one'.format((index + offset) % len(self)))
+        raise IOError('no readable image in any batch of {} posts'.format(len(self.posts)))
+
+    def batch(self, indices):
+        batch_len = self.lengths[indices].max() if self.bucketed else self.max_len
+        self.real_tokens += int(self.lengths[indices].sum())
+        self.padded_tokens += batch_len * len(indices)
+
+        if self.sparse_targets:
+            return self.sparse_batch(indices, batch_len)
 
         X_imgs = []
         X_subreddits = []
@@ -42,7 +75,12 @@ class ImageTitlingDataGenerator(keras.utils.Sequence):
 
         for i in indices:
             post = self.posts[i]
-            img, subreddit, title, target = model_input_output_from_post(post, self.ids_by_word, self.max_len)
+            try:
+                img, subreddit, title, target = model_input_output_from_post(post, self.ids_by_word, batch_len)
+            except IOError as e:
+                # a bad image that verify.py hasn't quarantined yet costs one sample, not the epoch
+                print('skipping unreadable image {}: {}'.format(post['path'], e))
+                continue
             X_imgs.append(img)
             X_subreddits.append(subreddit)
             X_title_indices.append(title)
@@ -55,15 +93,61 @@ class ImageTitlingDataGenerator(keras.utils.Sequence):
 
         return [X_imgs, X_subreddits, X_title_indices], y
 
+    def sparse_batch(self, indices, batch_len):
+        X_imgs = []
+        X_subreddits = np.zeros((len(indices), self.num_subreddits))
+        X_title_indices = np.full((len(indices), batch_len), self.ids_by_word[PAD_TOKEN], dtype=np.int32)
+        targets = np.full((len(indices), batch_len), self.ids_by_word[PAD_TOKEN], dtype=np.int32)
+        for i in indices:
+            post = self.posts[i]
+            try:
+                img = load_image(post['path'])
+            except IOError as e:
+                print('skipping unreadable image {}: {}'.format(post['path'], e))
+                continue
+            row = len(X_imgs)
+            X_imgs.append(img)
+            X_subreddits[row, post['subreddit']] = 1
+            inputs, outputs = title_ids(post['title'], self.ids_by_word, batch_len)
+            X_title_indices[row, :len(inputs)] = inputs
+            targets[row, :len(outputs)] = outputs
+        rows = len(X_imgs)
+        return [np.array(X_imgs), X_subreddits[:rows], X_title_indices[:rows], targets[:rows]], np.zeros((rows, batch_len))
+
     def on_epoch_end(self):
+        if self.padded_tokens:
+            print('\ntitle tokens: {} real of {} computed ({:.0f}% padding)'.format(self.real_tokens, self.padded_tokens,
+                100. * (self.padded_tokens - self.real_tokens) / self.padded_tokens))
+        self.real_tokens = 0
+        self.padded_tokens = 0
         self.indices = np.arange(len(self.posts))
         np.random.shuffle(self.indices)
+        if self.bucketed:
+            # stable sort of the shuffled order: random within a length, so buckets differ per epoch
+            self.indices = self.indices[np.argsort(self.lengths[self.indices], kind='mergesort')]
+        num_batches = len(self)
+        self.batches = [self.indices[i * self.batch_size:(i + 1) * self.batch_size] for i in range(num_batches)]
+        if self.bucketed:
+            # and the buckets themselves come in random order
+            np.random.shuffle(self.batches)
+
+def title_length(title, max_len):
+    # decoder steps of a title: <START> plus its words (targets are the words plus <END>)
+    return min(len(text_to_word_sequence(title)) + 1, max_len)
+
+def load_image(path):
+    img = np.array(Image.open(path), dtype=np.float64)
+    return preprocess_input(img)
+
+def title_ids(title, ids_by_word, max_len):
+    # decoder inputs (<START> + words) and targets (words + <END>) as word ids, unpadded
+    words = [ids_by_word.get(word, ids_by_word[UNKNOWN_TOKEN]) for word in text_to_word_sequence(title)[:max_len - 1]]
+    return [ids_by_word[START_TOKEN]] + words, words + [ids_by_word[END_TOKEN]]
 
 def model_input_output_from_post(post, ids_by_word, max_len):
     path = post['path']
     subreddit = post['subreddit']
-    img = np.array(Image.open(path), dtype=np.float64)
-    img = preprocess_input(img)
+    img = load_image(path)
 
     subreddit_one_hot = np.zeros(NUM_SUBREDDITS, dtype=np.float64)
     subreddit_one_hot[subreddit] = 1
@@ -108,6 +192,7 @@ def model_input_output_from_post(post, ids_by_word, max_len):
 
     return img, subreddit_one_hot, title_indices, y
 
+@memory_profile.phased('load')
 def get_data(json_path, ids_by_word):
     X_imgs = []
     X_subreddits = []
@@ -115,14 +200,13 @@ def get_data(json_path, ids_by_word):
     y = []
 
     max_len = 100
-    with open(json_path) as f:
-        data = json.load(f)
-        for post in data['posts']:
-            img, subreddit, title, target = model_input_output_from_post(post, ids_by_word, max_len)
-            X_imgs.append(img)
-            X_subreddits.append(subreddit)
-            X_title_indices.append(title)
-            y.append(target)
+    data = manifest.load(json_path)
+    for post in data['posts']:
+        img, subreddit, title, target = model_input_output_from_post(post, ids_by_word, max_len)
+        X_imgs.append(img)
+        X_subreddits.append(subreddit)
+        X_title_indices.append(title)
+        y.append(target)
 
     X_imgs = np.array(X_imgs)
     X_subreddits = np.array(X_subreddits)
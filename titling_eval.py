@@ -0,0 +1,178 @@
+import json
+import time
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+from keras.preprocessing.text import text_to_word_sequence
+
+import manifest
+import memory_profile
+from titling_data import PAD_TOKEN, load_image, title_ids
+
+# corpus-level title metrics over a whole split. n-gram counting is vectorized: every
+# n-gram becomes one integer key, and clipped matches come from unique/intersect over
+# (sentence, n-gram) pairs instead of per-sentence Counters
+max_order = 4
+decode_batch_size_default = 64
+
+class TokenIds(object):
+    # ids for every token seen in hypotheses and references, 1-based so 0 never occurs
+    def __init__(self):
+        self.ids = {}
+
+    def __call__(self, tokens):
+        return [self.ids.setdefault(token, len(self.ids) + 1) for token in tokens]
+
+def flatten(sentences):
+    lengths = np.array([len(s) for s in sentences], dtype=np.int64)
+    flat = np.array([t for s in sentences for t in s], dtype=np.int64)
+    return flat, lengths
+
+def ngram_keys(sentences, n, base):
+    # (sentence index, n-gram key) for every n-gram of every sentence
+    flat, lengths = flatten(sentences)
+    sentence_of = np.repeat(np.arange(len(sentences)), lengths)
+    ends = np.cumsum(lengths)
+    positions = np.arange(len(flat))
+    valid = positions + n <= ends[sentence_of] if len(flat) else np.zeros(0, dtype=bool)
+    starts = positions[valid]
+    keys = np.zeros(len(starts), dtype=np.int64)
+    for j in range(n):
+        keys = keys * base + flat[starts + j]
+    return sentence_of[valid], keys
+
+def clipped_matches(hypotheses, references, n, base):
+    # per-sentence clipped n-gram matches and hypothesis n-gram counts
+    h_sentences, h_keys = ngram_keys(hypotheses, n, base)
+    r_sentences, r_keys = ngram_keys(references, n, base)
+    # dense n-gram ids keep sentence * num_keys + key inside int64
+    _, dense = np.unique(np.concatenate([h_keys, r_keys]), return_inverse=True)
+    num_keys = max(int(dense.max()) + 1, 1) if len(dense) else 1
+    h_pairs = h_sentences * num_keys + dense[:len(h_keys)]
+    r_pairs = r_sentences * num_keys + dense[len(h_keys):]
+    h_unique, h_counts = np.unique(h_pairs, return_counts=True)
+    r_unique, r_counts = np.unique(r_pairs, return_counts=True)
+    _, h_index, r_index = np.intersect1d(h_unique, r_unique, assume_unique=True, return_indices=True)
+    clipped = np.minimum(h_counts[h_index], r_counts[r_index])
+    matches = np.bincount(h_unique[h_index] // num_keys, weights=clipped, minlength=len(hypotheses))
+    totals = np.bincount(h_sentences, minlength=len(hypotheses))
+    return matches, totals
+
+def corpus_scores(hypotheses, references):
+    # hypotheses/references: lists of token lists, one reference per hypothesis
+    token_ids = TokenIds()
+    hypotheses = [token_ids(h) for h in hypotheses]
+    references = [token_ids(r) for r in references]
+    base = len(token_ids.ids) + 1
+    if base ** max_order >= 2 ** 63:
+        raise ValueError('vocabulary of {} tokens is too large for int64 {}-gram keys'.format(base, max_order))
+
+    scores = {}
+    precisions = []
+    unigram_matches = None
+    for n in range(1, max_order + 1):
+        matches, totals = clipped_matches(hypotheses, references, n, base)
+        if n == 1:
+            unigram_matches = matches
+        precision = matches.sum() / float(totals.sum()) if totals.sum() else 0.
+        precisions.append(precision)
+        scores['precision_{}'.format(n)] = precision
+
+    hypothesis_length = float(sum(len(h) for h in hypotheses))
+    reference_length = float(sum(len(r) for r in references))
+    brevity_penalty = 1. if hypothesis_length > reference_length else np.exp(1 - reference_length / max(hypothesis_length, 1))
+    bleu = brevity_penalty * np.exp(np.mean(np.log(precisions))) if min(precisions) > 0 else 0.
+    scores['bleu'] = float(bleu)
+    scores['brevity_penalty'] = float(brevity_penalty)
+
+    # METEOR-style: recall-weighted harmonic mean of exact unigram precision and recall,
+    # per sentence then averaged (no stemming, synonyms or fragmentation penalty)
+    hypothesis_lengths = np.array([len(h) for h in hypotheses], dtype=np.float64)
+    reference_lengths = np.array([len(r) for r in references], dtype=np.float64)
+    precision = unigram_matches / np.maximum(hypothesis_lengths, 1)
+    recall = unigram_matches / np.maximum(reference_lengths, 1)
+    denominator = recall + 9 * precision
+    fmean = np.where(denominator > 0, 10 * precision * recall / np.where(denominator > 0, denominator, 1), 0.)
+    scores['meteor'] = float(fmean.mean()) if len(fmean) else 0.
+    return scores
+
+def teacher_forced_log_likelihood(model, h, c, posts, max_len):
+    # summed log p(reference title) per post and its token count, from the same encoder states
+    ids = [title_ids(post['title'], model.id_by_words, max_len) for post in posts]
+    length = max(len(inputs) for inputs, _ in ids)
+    pad_id = model.id_by_words[PAD_TOKEN]
+    inputs = np.full((len(posts), length), pad_id, dtype=np.int64)
+    targets = np.full((len(posts), length), pad_id, dtype=np.int64)
+    mask = np.zeros((len(posts), length), dtype=bool)
+    for i, (x, y) in enumerate(ids):
+        inputs[i, :len(x)] = x
+        targets[i, :len(y)] = y
+        mask[i, :len(y)] = True
+    log_likelihood = np.zeros(len(posts))
+    rows = np.arange(len(posts))
+    for t in range(length):
+        probs, h, c = model.decoder_step(inputs[:, t], h, c)
+        log_likelihood += np.where(mask[:, t], np.log(np.maximum(probs[rows, targets[:, t]], 1e-12)), 0.)
+    return log_likelihood, mask.sum(axis=1)
+
+def load_batch(posts):
+    return np.array([load_image(post['path']) for post in posts])
+
+@memory_profile.phased('evaluate split')
+def evaluate_split(model, json_path, predictions_path, beam_width=1, batch_size=decode_batch_size_default, perplexity=True):
+    posts = manifest.load(json_path)['posts']
+    batches = [posts[i:i + batch_size] for i in range(0, len(posts), batch_size)]
+    hypotheses = []
+    references = []
+    total_log_likelihood = 0.
+    total_tokens = 0
+    decode_seconds = 0.
+    generated_tokens = 0
+    start = time.time()
+    # images for the next batch load while the current one decodes
+    pool = ThreadPool(1)
+    try:
+        pending = pool.apply_async(load_batch, (batches[0],)) if batches else None
+        with open(predictions_path, 'w') as f:
+            for i, batch in enumerate(batches):
+                imgs = pending.get()
+                if i + 1 < len(batches):
+                    pending = pool.apply_async(load_batch, (batches[i + 1],))
+                decode_start = time.time()
+                h, c = model.encode(imgs, [post['subreddit'] for post in batch])
+                decoded = model.decode(h, c, beam_width)
+                decode_seconds += time.time() - decode_start
+                if perplexity:
+                    log_likelihood, tokens = teacher_forced_log_likelihood(model, h, c, batch, model.max_len)
+                    total_log_likelihood += log_likelihood.sum()
+                    total_tokens += tokens.sum()
+                for post, (word_ids, score) in zip(batch, decoded):
+                    title = model.title_from_ids(word_ids)
+                    generated_tokens += len(word_ids) + 1
+                    hypotheses.append(text_to_word_sequence(title))
+                    references.append(text_to_word_sequence(post['title']))
+                    f.write(json.dumps({'id': post['id'], 'subreddit': post['subreddit'], 'path': post['path'],
+                        'reference': post['title'], 'prediction': title, 'log_likelihood': score}) + '\n')
+                print('decoded {}/{} ({:.1f} images/s)'.format(min((i + 1) * batch_size, len(posts)), len(posts),
+                    min((i + 1) * batch_size, len(posts)) / max(decode_seconds, 1e-9)))
+    finally:
+        pool.close()
+        pool.join()
+
+    results = corpus_scores(hypotheses, references)
+    if perplexity and total_tokens:
+        results['perplexity'] = float(np.exp(-total_log_likelihood / total_tokens))
+    results.update({
+        'split': json_path,
+        'posts': len(posts),
+        'beam_width': beam_width,
+        'batch_size': batch_size,
+        'decode_seconds': decode_seconds,
+        'images_per_sec': len(posts) / decode_seconds if decode_seconds else 0.,
+        'tokens_per_sec': generated_tokens / decode_seconds if decode_seconds else 0.,
+        'wall_seconds': time.time() - start,
+        'predictions': predictions_path,
+    })
+    if model.prefix_cache is not None:
+        results['prefix_cache'] = model.prefix_cache.stats()
+    return results
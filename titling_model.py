@@ -1,9 +1,17 @@
+import time
+
 import numpy as np
 from keras.models import Model, load_model
 from keras import backend as K
 
 from keras.applications.vgg16 import VGG16
 from keras.layers import Dense, GlobalAveragePooling2D, Input, LSTM, Embedding, TimeDistributed, Reshape, Activation, Concatenate
+
+import memory_profile
+import checkpoint
+import serving_metrics
+from prefix_cache import PrefixStateCache, state_key, max_mb_default
+from sampled_softmax import SampledSoftmax, custom_objects, num_sampled_default
 # some code borrowed from https://blog.keras.io/using-pre-trained-word-embeddings-in-a-keras-model.html
 
 PROJECTION_LAYER = 'projection'
@@ -17,19 +25,28 @@ UNKNOWN_TOKEN = '<UNK>'
 END_TOKEN = '<END>'
 
 class ImageTitlingModel(object):
-    def __init__(self, words_by_id, id_by_words, num_subreddits=20, max_len=20):
+    def __init__(self, words_by_id, id_by_words, num_subreddits=20, max_len=20, encoder_weights='imagenet',
+            softmax='full', num_sampled=num_sampled_default, word_counts=None, prefix_cache_mb=max_mb_default):
         self.num_subreddits = num_subreddits
         self.max_len = max_len
         self.words_by_id = words_by_id
         self.id_by_words = id_by_words
+        # 'sampled' trains the output layer against num_sampled words drawn by word_counts
+        # (see sampled_softmax.py); the train model then takes the target ids as a fourth
+        # input and outputs the loss. inference always uses the full softmax
+        self.softmax = softmax
+        self.num_sampled = num_sampled
+        self.word_counts = word_counts
+        # decoder steps already taken for a (title, prefix); 0 turns it off
+        self.prefix_cache = PrefixStateCache(prefix_cache_mb) if prefix_cache_mb else None
 
         self.embedding_size = 512
         self.lstm_size = 512
 
-        self.create_models(self.lstm_size, self.embedding_size, num_subreddits, max_len)
+        self.create_models(self.lstm_size, self.embedding_size, num_subreddits, max_len, encoder_weights)
 
     def load_checkpoint(self, save_file):
-        self.train_model = load_model(save_file)
+        self.train_model = load_model(save_file, custom_objects=custom_objects)
         self.set_inference_weights_from_train()
         for layer in self.train_model.layers:
             if layer.name == 'embedding':
@@ -37,8 +54,19 @@ class ImageTitlingModel(object):
                 print('found embeddings weights!')
                 break
 
+    def restore_checkpoint(self, save_file):
+        # trainable weights and optimizer state from checkpoint.py; the train model must be compiled
+        initial_epoch = checkpoint.restore(self.train_model, save_file)
+        self.set_inference_weights_from_train()
+        for layer in self.train_model.layers:
+            if layer.name == 'embedding':
+                self.embedding_matrix = layer.get_weights()[0]
+                break
+        return initial_epoch
+
     def load_weights(self, save_file):
-        self.train_model.load_weights(save_file)
+        # by name, so weights trained with either softmax load into either train model
+        self.train_model.load_weights(save_file, by_name=True)
         self.set_inference_weights_from_train()
         for layer in self.train_model.layers:
             if layer.name == 'embedding':
@@ -46,7 +74,136 @@ class ImageTitlingModel(object):
                 print('found embeddings weights!')
                 break
 
+    def encode(self, imgs, subreddits):
+        # initial decoder states for a batch of preprocessed images and subreddit ids
+        subreddits_one_hot = np.zeros((len(subreddits), self.num_subreddits))
+        subreddits_one_hot[np.arange(len(subreddits)), subreddits] = 1
+        serving_metrics.observe('batch_size', len(imgs), model='title_encoder')
+        with serving_metrics.timer('title_phase_seconds', phase='encoder'):
+            encoder_output = self.inference_encoder_model.predict([imgs, subreddits_one_hot], batch_size=len(imgs))
+            return self.initial_states(encoder_output)
+
+    def initial_states(self, encoder_output):
+        # the projected image is the LSTM's first input, from zero states
+        zero = np.zeros((len(encoder_output), self.lstm_size))
+        _, h, c = self.inference_decoder_model.predict([encoder_output, zero, zero], batch_size=len(encoder_output))
+        return h, c
+
+    def decoder_step(self, word_ids, h, c):
+        # next-word probabilities and states for a batch of previous words
+        embeddings = self.embedding_matrix[word_ids]
+        with serving_metrics.timer('title_phase_seconds', phase='decoder_step'):
+            return self.inference_decoder_model.predict([embeddings, h, c], batch_size=len(embeddings))
+
+    def cached_decoder_step(self, keys, prefixes, word_ids, h, c):
+        # decoder_step for rows whose title (key) has consumed prefixes (ending in word_ids);
+        # only rows missing from the prefix cache are computed, and identical rows only once
+        if self.prefix_cache is None:
+            return self.decoder_step(word_ids, h, c)
+        entries = [None] * len(keys)
+        missing = {}
+        for i, cache_key in enumerate(zip(keys, prefixes)):
+            entries[i] = self.prefix_cache.get(cache_key)
+            if entries[i] is None:
+                missing.setdefault(cache_key, []).append(i)
+        if missing:
+            first = [rows[0] for rows in missing.values()]
+            probs, next_h, next_c = self.decoder_step(word_ids[first], h[first], c[first])
+            for j, (cache_key, rows) in enumerate(missing.items()):
+                entry = (probs[j].copy(), next_h[j].copy(), next_c[j].copy())
+                self.prefix_cache.put(cache_key, entry)
+                for i in rows:
+                    entries[i] = entry
+        return tuple(np.array([entry[part] for entry in entries]) for part in range(3))
+
+    def decode(self, h, c, beam_width=1):
+        # batched beam search (greedy for beam_width 1) over whole titles, scored by total log
+        # probability like generate_title_beam_search; returns (word ids, log likelihood) per row
+        n, k = len(h), beam_width
+        vocab_size = len(self.words_by_id)
+        start_id = self.id_by_words[START_TOKEN]
+        end_id = self.id_by_words[END_TOKEN]
+        rows = np.arange(n)[:, None]
+        keys = np.repeat([state_key(h[i], c[i]) for i in range(n)], k)
+        h = np.repeat(h, k, axis=0)
+        c = np.repeat(c, k, axis=0)
+        words = np.full(n * k, start_id, dtype=np.int64)
+        # only the first beam is live at the start, the others would duplicate it
+        scores = np.full((n, k), -np.inf)
+        scores[:, 0] = 0
+        history = np.zeros((n, k, 0), dtype=np.int64)
+        finished = np.zeros((n, k), dtype=bool)
+        decode_start = time.time()
+        beam_seconds = 0.
+        probs = np.zeros((n * k, vocab_size), dtype=np.float32)
+        for _ in range(self.max_len):
+            # finished titles don't need the decoder, their next word is fixed below
+            live = np.flatnonzero(~finished.ravel())
+            prefixes = [(start_id,) + tuple(prefix) for prefix in history.reshape(n * k, history.shape[2])[live].tolist()]
+            probs[live], step_h, step_c = self.cached_decoder_step(keys[live], prefixes, words[live], h[live], c[live])
+            next_h, next_c = h.copy(), c.copy()
+            next_h[live], next_c[live] = step_h, step_c
+            step_end = time.time()
+            log_probs = np.log(np.maximum(probs, 1e-12)).reshape(n, k, vocab_size)
+            # a finished title only continues as itself (one more <END>, at no cost)
+            log_probs[finished] = -np.inf
+            log_probs[finished, end_id] = 0
+            totals = (scores[:, :, None] + log_probs).reshape(n, k * vocab_size)
+            if k == 1:
+                top = np.argmax(totals, axis=1)[:, None]
+            else:
+                top = np.argpartition(-totals, k - 1, axis=1)[:, :k]
+                top = top[rows, np.argsort(-totals[rows, top], axis=1)]
+            scores = totals[rows, top]
+            beams, words = top // vocab_size, top % vocab_size
+            history = np.concatenate([history[rows, beams], words[:, :, None]], axis=2)
+            finished = finished[rows, beams] | (words == end_id)
+            previous = (rows * k + beams).ravel()
+            h, c = next_h[previous], next_c[previous]
+            words = words.ravel()
+            beam_seconds += time.time() - step_end
+            if finished.all():
+                break
+        serving_metrics.observe('title_phase_seconds', beam_seconds, phase='beam')
+        serving_metrics.observe('title_phase_seconds', time.time() - decode_start, phase='decode')
+        results = []
+        for i in range(n):
+            word_ids = [int(word_id) for word_id in history[i, 0]]
+            if end_id in word_ids:
+                word_ids = word_ids[:word_ids.index(end_id)]
+            results.append((word_ids, float(scores[i, 0])))
+            serving_metrics.inc('title_tokens_total', len(word_ids) + 1)
+        return results
+
+    def project_all_subreddits(self, features):
+        # the projection of [features, one_hot(s)] for every subreddit s in one matmul: the
+        # one-hot half of the kernel just adds row s, so it's features . W_f + b + W_s
+        kernel, bias = self.inference_encoder_model.get_layer(PROJECTION_LAYER).get_weights()
+        num_features = kernel.shape[0] - self.num_subreddits
+        return features.dot(kernel[:num_features]) + bias + kernel[num_features:]
+
+    def generate_titles_for_all_subreddits(self, img, beam_width=1):
+        # one VGG16 pass, then every subreddit's title decoded as one batch; returns
+        # (subreddit, title, log likelihood) from most to least likely
+        serving_metrics.inc('title_requests_total', mode='all_subreddits')
+        with serving_metrics.timer('title_phase_seconds', phase='encoder'):
+            features = self.feature_model.predict(np.array([img]))
+            h, c = self.initial_states(self.project_all_subreddits(features))
+        decoded = self.decode(h, c, beam_width)
+        ranked = sorted(range(self.num_subreddits), key=lambda s: decoded[s][1], reverse=True)
+        return [(s, self.title_from_ids(decoded[s][0]), decoded[s][1]) for s in ranked]
+
+    def title_from_ids(self, word_ids):
+        return ' '.join(self.words_by_id[word_id] for word_id in word_ids)
+
+    def generate_titles(self, imgs, subreddits, beam_width=1):
+        # batched generate_title/generate_title_beam_search: [(title, log likelihood)] per image
+        serving_metrics.inc('title_requests_total', mode='batch')
+        h, c = self.encode(imgs, subreddits)
+        return [(self.title_from_ids(word_ids), score) for word_ids, score in self.decode(h, c, beam_width)]
+
     def generate_title_beam_search(self, img, subreddit, k):
+        serving_metrics.inc('title_requests_total', mode='beam_search')
         subreddit_one_hot = np.zeros(self.num_subreddits)
         subreddit_one_hot[subreddit] = 1
         encoder_output = self.inference_encoder_model.predict([np.array([img]), np.array([subreddit_one_hot])])
@@ -56,6 +213,7 @@ class ImageTitlingModel(object):
         _, initial_h, initial_c = self.inference_decoder_model.predict([encoder_output, zero_h, zero_c])
 
         end_id = self.id_by_words[END_TOKEN]
+        key = state_key(initial_h, initial_c)
 
         def expand(seq, k):
             word_ids, prev_h, prev_c, p = seq
@@ -63,8 +221,7 @@ class ImageTitlingModel(object):
             if prev_word_id == end_id:
                 return None
 
-            prev_word = self.embedding_matrix[prev_word_id]
-            probs, h, c = self.inference_decoder_model.predict([np.array([prev_word]), prev_h, prev_c])
+            probs, h, c = self.cached_decoder_step([key], [tuple(word_ids)], np.array([prev_word_id]), prev_h, prev_c)
             probs = probs[0]
             top_k = np.argsort(probs)[-k:]
             top_k_candidates = []
@@ -100,6 +257,7 @@ class ImageTitlingModel(object):
         return ' '.join(title)
 
     def generate_title(self, img, subreddit):
+        serving_metrics.inc('title_requests_total', mode='greedy')
         subreddit_one_hot = np.zeros(self.num_subreddits)
         subreddit_one_hot[subreddit] = 1
         encoder_output = self.inference_encoder_model.predict([np.array([img]), np.array([subreddit_one_hot])])
@@ -109,14 +267,14 @@ class ImageTitlingModel(object):
         _, initial_h, initial_c = self.inference_decoder_model.predict([encoder_output, zero_h, zero_c])
 
         start_id = self.id_by_words[START_TOKEN]
-        start_embedding = self.embedding_matrix[start_id]
+        key = state_key(initial_h, initial_c)
+        prefix = (start_id,)
         prev_h = initial_h
         prev_c = initial_c
-        prev_word = start_embedding
         title = []
         end_id = self.id_by_words[END_TOKEN]
         while len(title) < self.max_len:
-            probs, h, c = self.inference_decoder_model.predict([np.array([prev_word]), prev_h, prev_c])
+            probs, h, c = self.cached_decoder_step([key], [prefix], np.array([prefix[-1]]), prev_h, prev_c)
             predicted_word_id = np.argmax(probs)
 
             if predicted_word_id == end_id:
@@ -125,13 +283,16 @@ class ImageTitlingModel(object):
             predicted_word = self.words_by_id[predicted_word_id]
             title.append(predicted_word)
 
-            prev_word = self.embedding_matrix[predicted_word_id]
+            prefix += (int(predicted_word_id),)
             prev_h = h
             prev_c = c
 
         return ' '.join(title)
 
     def set_inference_weights_from_train(self):
+        if self.prefix_cache is not None:
+            # cached states belong to the old weights
+            self.prefix_cache.clear()
         inference_models = [self.inference_encoder_model, self.inference_decoder_model]
         inference_layers = []
         for model in inference_models:
@@ -146,8 +307,9 @@ class ImageTitlingModel(object):
             train_layer = train_layers_by_name[inference_layer.name]
             inference_layer.set_weights(train_layer.get_weights())
 
-    def create_models(self, lstm_size, embedding_size, num_subreddits, max_len):
-        cnn_encoder = VGG16(weights='imagenet', include_top=False)
+    @memory_profile.phased('build model')
+    def create_models(self, lstm_size, embedding_size, num_subreddits, max_len, encoder_weights='imagenet'):
+        cnn_encoder = VGG16(weights=encoder_weights, include_top=False)
         for layer in cnn_encoder.layers:
             layer.trainable = False
 
@@ -166,10 +328,10 @@ class ImageTitlingModel(object):
         # during inference, we feed the output of the LSTM back into the LSTM
 
         # training model
-        train_titles = Input(shape=(max_len,), dtype='int32', name='train_titles_input')
+        # any title length, so length-bucketed batches are only padded to their longest title
+        train_titles = Input(shape=(None,), dtype='int32', name='train_titles_input')
         train_embedding_layer = Embedding(vocab_size,
             embedding_size,
-            input_length=max_len,
             mask_zero=True,
             name=EMBEDDING_LAYER)
         train_embeddings = train_embedding_layer(train_titles)
@@ -178,13 +340,19 @@ class ImageTitlingModel(object):
         train_decoder = LSTM(lstm_size, return_sequences=True, return_state=True, name=LSTM_LAYER)
         _, train_initial_h, train_initial_c = train_decoder(encoder_output_reshaped)
         train_hidden_states, _, _ = train_decoder(train_embeddings, initial_state=[train_initial_h, train_initial_c])
-        train_scores = TimeDistributed(Dense(vocab_size), name=SOFTMAX_LAYER)(train_hidden_states)
-        train_probs = Activation('softmax')(train_scores)
-
-        self.train_model = Model(inputs=[cnn_encoder.inputs[0], one_hot_subreddit, train_titles], outputs=[train_probs])
+        if self.softmax == 'sampled':
+            train_targets = Input(shape=(None,), dtype='int32', name='train_targets_input')
+            train_losses = SampledSoftmax(vocab_size, self.num_sampled, self.word_counts, name=SOFTMAX_LAYER)([train_hidden_states, train_targets])
+            self.train_model = Model(inputs=[cnn_encoder.inputs[0], one_hot_subreddit, train_titles, train_targets], outputs=[train_losses])
+        else:
+            train_scores = TimeDistributed(Dense(vocab_size), name=SOFTMAX_LAYER)(train_hidden_states)
+            train_probs = Activation('softmax')(train_scores)
+            self.train_model = Model(inputs=[cnn_encoder.inputs[0], one_hot_subreddit, train_titles], outputs=[train_probs])
 
         # inference encoder
         self.inference_encoder_model = Model(inputs=[cnn_encoder.inputs[0], one_hot_subreddit], outputs=[encoder_output])
+        # pooled CNN features alone, before the subreddit is mixed in by the projection
+        self.feature_model = Model(inputs=cnn_encoder.inputs[0], outputs=features)
 
         # inference decoder for words
         prev_word = Input(shape=(embedding_size,), dtype='float32', name='prev_word')
@@ -1,36 +1,141 @@
+import argparse
+import hashlib
 import json
+import multiprocessing
+import os
+import time
+
 from PIL import Image
 
-def get_data(json_path):
-    X_train = []
-    y_train = []
-    with open(json_path) as f:
-        data = json.load(f)
-        for post in data['posts']:
-            path = post['path']
-            label = post['subreddit']
-
-            img = np.array(Image.open(path))
-            X_train.append(img)
-
-            one_hot = np.zeros(NUM_CLASSES)
-            one_hot[label] = 1
-            y_train.append(one_hot)
-
-    X_train = np.array(X_train)
-    y_train = np.array(y_train)
-
-    return X_train, y_train
-
-def validate(json_path):
-    with open(json_path) as f:
-        data = json.load(f)
-        for post in data['posts']:
-            path = post['path']
-            
-            try:
-                img = Image.open(path)
-            except Exception as e:
-                print('post is bad:', post)
-
-validate('model.json')
+import manifest
+
+cache_path_default = 'verify_cache.json'
+json_paths_default = ['train.json', 'validation.json', 'test.json']
+min_bytes_default = 1024
+max_bytes_default = 20 * 1024 * 1024
+chunk_size = 16
+
+def file_hash(path):
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+def check(path, resolution=None, min_bytes=min_bytes_default, max_bytes=max_bytes_default):
+    # returns None if the image is usable, otherwise why it isn't
+    size = os.path.getsize(path)
+    if size < min_bytes:
+        return 'file too small ({} bytes)'.format(size)
+    if size > max_bytes:
+        return 'file too large ({} bytes)'.format(size)
+    img = Image.open(path)
+    # a full decode is the only reliable way to catch truncated files
+    img.load()
+    if img.mode != 'RGB':
+        return 'mode is {}, not RGB'.format(img.mode)
+    if resolution and img.size != (resolution, resolution):
+        return 'size is {}x{}, not {}x{}'.format(img.size[0], img.size[1], resolution, resolution)
+    return None
+
+# results by content hash from earlier runs, shared with the pool workers
+known_hashes = {}
+
+def init_worker(hashes):
+    known_hashes.update(hashes)
+
+def check_worker(task):
+    path, params = task
+    digest = None
+    try:
+        digest = file_hash(path)
+        # a renamed or re-downloaded copy of a checked file needs no decode
+        if digest in known_hashes:
+            return path, digest, known_hashes[digest]
+        reason = check(path, **params)
+    except Exception as e:
+        reason = '{}: {}'.format(type(e).__name__, e)
+    return path, digest, reason
+
+def load_cache(cache_path):
+    if not os.path.exists(cache_path):
+        return {'files': {}, 'hashes': {}}
+    with open(cache_path) as f:
+        return json.load(f)
+
+def save_cache(cache_path, cache):
+    tmp_path = cache_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(cache, f)
+    os.rename(tmp_path, cache_path)
+
+def validate(json_paths, resolution=None, workers=None, cache_path=cache_path_default,
+        quarantine_path=manifest.quarantine_path_default, min_bytes=min_bytes_default, max_bytes=max_bytes_default):
+    start = time.time()
+    params = {'resolution': resolution, 'min_bytes': min_bytes, 'max_bytes': max_bytes}
+    params_key = json.dumps(params, sort_keys=True)
+    cache = load_cache(cache_path)
+    if cache.get('params') != params_key:
+        # results depend on the checks, so a different resolution/size limit starts over
+        cache = {'params': params_key, 'files': {}, 'hashes': {}}
+
+    paths = []
+    for json_path in json_paths:
+        for post in manifest.load(json_path, honour_quarantine=False)['posts']:
+            paths.append(post['path'])
+    paths = sorted(set(paths))
+
+    results = {}
+    tasks = []
+    missing = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            missing.append(path)
+            continue
+        entry = cache['files'].get(path)
+        # unchanged files (same size and mtime) are not even re-hashed
+        if entry and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime and entry['sha1'] in cache['hashes']:
+            results[path] = cache['hashes'][entry['sha1']]
+        else:
+            cache['files'][path] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'sha1': None}
+            tasks.append((path, params))
+
+    print('{} images, {} cached, {} to check'.format(len(paths), len(results), len(tasks)))
+    if tasks:
+        pool = multiprocessing.Pool(workers, initializer=init_worker, initargs=(cache['hashes'],))
+        try:
+            for i, (path, digest, reason) in enumerate(pool.imap_unordered(check_worker, tasks, chunk_size)):
+                cache['files'][path]['sha1'] = digest
+                if digest is not None:
+                    cache['hashes'][digest] = reason
+                results[path] = reason
+                if (i + 1) % 1000 == 0:
+                    print('checked {}/{}'.format(i + 1, len(tasks)))
+        finally:
+            pool.close()
+            pool.join()
+    save_cache(cache_path, cache)
+
+    bad = [{'path': path, 'reason': 'missing'} for path in missing]
+    bad += [{'path': path, 'reason': reason} for path, reason in sorted(results.items()) if reason is not None]
+    for entry in bad:
+        print('post is bad: {} ({})'.format(entry['path'], entry['reason']))
+    manifest.write_quarantine(bad, quarantine_path)
+    print('{} bad images quarantined in {} ({:.1f}s)'.format(len(bad), quarantine_path, time.time() - start))
+    return bad
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='check every image is decodable, RGB and the expected size; quarantine the rest')
+    parser.add_argument('json_paths', type=str, nargs='*', help='post json files/splits to validate (default: train, validation and test)')
+    parser.add_argument('-r', type=int, help='expected square resolution, e.g. 1000')
+    parser.add_argument('-w', type=int, help='worker processes (default: cpu count)')
+    parser.add_argument('--min_bytes', type=int, default=min_bytes_default, help='smallest acceptable file size')
+    parser.add_argument('--max_bytes', type=int, default=max_bytes_default, help='largest acceptable file size')
+    parser.add_argument('--cache', type=str, default=cache_path_default, help='validation cache file')
+    parser.add_argument('--quarantine', type=str, default=manifest.quarantine_path_default, help='quarantine list the loaders skip')
+    args = parser.parse_args()
+
+    json_paths = args.json_paths or [p for p in json_paths_default if os.path.exists(p) or manifest.find(p)]
+    validate(json_paths, args.r, args.w, args.cache, args.quarantine, args.min_bytes, args.max_bytes)
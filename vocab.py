@@ -1,7 +1,16 @@
+import argparse
+import hashlib
+import multiprocessing
+import os
+import shutil
+import time
 import numpy as np
-from keras.preprocessing.text import text_to_word_sequence
 import json
-from collections import defaultdict
+from collections import Counter, defaultdict
+
+import memory_profile
+import manifest
+import pyramid
 
 START_TOKEN = '<START>'
 PAD_TOKEN = '<PAD>'
@@ -9,18 +18,34 @@ UNKNOWN_TOKEN = '<UNK>'
 END_TOKEN = '<END>'
 # important that PAD_TOKEN have index 0
 SPECIAL_TOKENS = [PAD_TOKEN, START_TOKEN, UNKNOWN_TOKEN, END_TOKEN]
+min_count_default = 5
+random_embedding_min_count_default = 20
+
+# built vocabularies (build_vocab): the words in id order with their training counts, so
+# ids don't depend on the order of the posts and a model's vocabulary can be saved with it
+vocab_version = 1
+vocab_path_default = 'vocab.json'
+experiment_vocab_file = 'vocab.json'
+titles_per_shard_default = 20000
+
+# keras' text_to_word_sequence with its default filters, so pool workers don't import keras
+filters = '!"#$%&()*+,-./:;<=>?@[\\]^_`{|}~\t\n'
+filter_table = str.maketrans(dict((c, ' ') for c in filters))
 
-def load_vocab(json_path):
+def text_to_word_sequence(text):
+    return [word for word in text.lower().translate(filter_table).split(' ') if word]
+
+@memory_profile.phased('load vocab')
+def load_vocab(json_path, return_counts=False, min_count=min_count_default):
     # maintain array so that ordering is consistent across runs
     # and words get mapped to same id
     # use set for performance reasons
     word_counts = defaultdict(int)
-    with open(json_path) as f:
-        data = json.load(f)
-        for post in data['posts']:
-            words = text_to_word_sequence(post['title'])
-            for w in words:
-                word_counts[w] += 1
+    titles = manifest.load_columns(json_path, ['title'])['title']
+    for title in titles:
+        words = text_to_word_sequence(title)
+        for w in words:
+            word_counts[w] += 1
 
     words_by_id = {}
     ids_by_word = {}
@@ -32,14 +57,24 @@ def load_vocab(json_path):
         i += 1
 
     for word, count in word_counts.items():
-        if count >= 5:
+        if count >= min_count:
             words_by_id[i] = word
             ids_by_word[word] = i
             i += 1
 
+    if return_counts:
+        # training frequency of every id, e.g. for sampling candidates in a sampled softmax;
+        # every title has one <START> and one <END>, and <UNK> stands for all the rare words
+        counts = np.zeros(len(words_by_id), dtype=np.int64)
+        counts[ids_by_word[START_TOKEN]] = len(titles)
+        counts[ids_by_word[END_TOKEN]] = len(titles)
+        for word, count in word_counts.items():
+            counts[ids_by_word.get(word, ids_by_word[UNKNOWN_TOKEN])] += count
+        return words_by_id, ids_by_word, counts
     return words_by_id, ids_by_word
 
-def load_limited_embedding_matrix(json_path, embedding_size):
+@memory_profile.phased('load vocab')
+def load_limited_embedding_matrix(json_path, embedding_size, min_count=random_embedding_min_count_default):
     glove_path = 'glove.6B.{}d.txt'.format(embedding_size)
     glove_index = {}
     with open(glove_path) as f:
@@ -56,16 +91,14 @@ def load_limited_embedding_matrix(json_path, embedding_size):
     unique_words = []
     word_counts = defaultdict(int)
     total_num_words = 0
-    with open(json_path) as f:
-        data = json.load(f)
-        for post in data['posts']:
-            words = text_to_word_sequence(post['title'])
-            total_num_words += len(words)
-            for w in words:
-                if w not in unique_words_set:
-                    unique_words_set.add(w)
-                    unique_words.append(w)
-                word_counts[w] += 1
+    for title in manifest.load_columns(json_path, ['title'])['title']:
+        words = text_to_word_sequence(title)
+        total_num_words += len(words)
+        for w in words:
+            if w not in unique_words_set:
+                unique_words_set.add(w)
+                unique_words.append(w)
+            word_counts[w] += 1
 
     print('total num words:', total_num_words)
     num_words = len(unique_words) + len(SPECIAL_TOKENS)
@@ -84,7 +117,7 @@ def load_limited_embedding_matrix(json_path, embedding_size):
     for word in unique_words:
         if word in glove_index:
             embedding = glove_index[word]
-        elif word_counts[word] >= 20:
+        elif word_counts[word] >= min_count:
             embedding = np.random.randn(embedding_size)
         else:
             # skip it, let it map to unknown token
@@ -101,6 +134,7 @@ def load_limited_embedding_matrix(json_path, embedding_size):
     print('total vocab size', len(embedding_matrix))
     return embedding_matrix, words_by_id, ids_by_word
 
+@memory_profile.phased('load vocab')
 def load_embedding_matrix():
     embedding_size = 50
 
@@ -134,3 +168,205 @@ def load_embedding_matrix():
             embedding_matrix[word_id] = embedding
 
     return embedding_matrix, words_by_id, ids_by_word
+
+#********************************* BUILT VOCABULARIES ***************************
+def prune(counts, capacity):
+    # misra-gries reduction to the capacity heaviest words: every count drops by the
+    # (capacity+1)-th largest, so a word's count is undercounted by at most the sum of the
+    # cuts, and any word with more than total/(capacity+1) occurrences survives. returns the cut
+    if len(counts) <= capacity:
+        return 0
+    cut = sorted(counts.values(), reverse=True)[capacity]
+    for word, count in list(counts.items()):
+        if count <= cut:
+            del counts[word]
+        else:
+            counts[word] = count - cut
+    return cut
+
+def shards(json_path, titles_per_shard):
+    # (source, start, stop, titles) tasks over the split; manifest splits are read by the
+    # workers from the memory mapped columns, json splits are loaded here and sent along
+    m = manifest.find(json_path)
+    if m is not None:
+        num_posts = len(m.indices(manifest.split_name(json_path)))
+        return [(json_path, start, min(start + titles_per_shard, num_posts), None)
+            for start in range(0, num_posts, titles_per_shard)]
+    titles = manifest.load_columns(json_path, ['title'], resolve_paths=False)['title']
+    return [(json_path, start, start + titles_per_shard, titles[start:start + titles_per_shard])
+        for start in range(0, len(titles), titles_per_shard)]
+
+def shard_titles(json_path, start, stop):
+    # titles of a manifest split's posts, skipping quarantined images like manifest.load
+    m = manifest.find(json_path)
+    indices = m.indices(manifest.split_name(json_path))[start:stop]
+    titles = m.values('title', indices)
+    if not manifest.load_quarantine():
+        return titles
+    keep = manifest.quarantine_mask(m.values('path', indices), pyramid.resolution_for_loading())
+    return [title for title, kept in zip(titles, keep) if kept]
+
+# set in every pool worker by init_worker
+worker_candidates = None
+worker_capacity = None
+
+def init_worker(candidates, capacity):
+    global worker_candidates, worker_capacity
+    worker_candidates = candidates
+    worker_capacity = capacity
+
+def count_shard(task):
+    # (word counts, titles, tokens, cuts) of one shard: exact, or a misra-gries sketch when
+    # there is a capacity, or exact for the candidate words only
+    json_path, start, stop, titles = task
+    if titles is None:
+        titles = shard_titles(json_path, start, stop)
+    counts = Counter()
+    num_titles = 0
+    num_tokens = 0
+    cuts = 0
+    for title in titles:
+        words = text_to_word_sequence(title)
+        num_titles += 1
+        num_tokens += len(words)
+        if worker_candidates is not None:
+            words = [word for word in words if word in worker_candidates]
+        counts.update(words)
+        if worker_capacity and len(counts) > 2 * worker_capacity:
+            cuts += prune(counts, worker_capacity)
+    if worker_capacity:
+        cuts += prune(counts, worker_capacity)
+    return counts, num_titles, num_tokens, cuts
+
+def count_words(tasks, processes, candidates=None, capacity=None):
+    # shards are merged in their order, so the result doesn't depend on the number of processes
+    counts = Counter()
+    num_titles = 0
+    num_tokens = 0
+    cuts = 0
+    if processes == 1:
+        init_worker(candidates, capacity)
+        results = map(count_shard, tasks)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(processes, initializer=init_worker, initargs=(candidates, capacity))
+        results = pool.imap(count_shard, tasks)
+    try:
+        for shard_counts, shard_titles_count, shard_tokens, shard_cuts in results:
+            counts.update(shard_counts)
+            num_titles += shard_titles_count
+            num_tokens += shard_tokens
+            cuts += shard_cuts
+            if capacity:
+                # merged misra-gries sketches are pruned back like a single one
+                cuts += prune(counts, capacity)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        init_worker(None, None)
+    return counts, num_titles, num_tokens, cuts
+
+def fingerprint(words):
+    return hashlib.sha1('\n'.join(words).encode('utf-8')).hexdigest()
+
+@memory_profile.phased('build vocab')
+def build_vocab(json_path, min_count=min_count_default, max_size=None, processes=None,
+        titles_per_shard=titles_per_shard_default, sketch_capacity=None):
+    # tokenizes and counts the split's titles in a process pool. with a sketch capacity,
+    # a first pass keeps only misra-gries sketches of that many words per shard and a second
+    # pass counts the surviving candidates exactly, so memory stays bounded whatever the
+    # corpus; a word no more frequent than the reported bound may then be missed. ids are
+    # ordered by count, then alphabetically
+    processes = processes or multiprocessing.cpu_count()
+    tasks = shards(json_path, titles_per_shard)
+    start_time = time.time()
+    max_undercount = None
+    if sketch_capacity:
+        sketch, num_titles, num_tokens, max_undercount = count_words(tasks, processes, capacity=sketch_capacity)
+        counts, _, _, _ = count_words(tasks, processes, candidates=frozenset(sketch))
+    else:
+        counts, num_titles, num_tokens, _ = count_words(tasks, processes)
+    seconds = time.time() - start_time
+
+    kept = sorted((word for word, count in counts.items() if count >= min_count), key=lambda word: (-counts[word], word))
+    if max_size is not None:
+        kept = kept[:max_size]
+    words = SPECIAL_TOKENS + kept
+    word_counts = [0] * len(SPECIAL_TOKENS) + [counts[word] for word in kept]
+    # every title has one <START> and one <END>, and <UNK> stands for all the other words
+    word_counts[SPECIAL_TOKENS.index(START_TOKEN)] = num_titles
+    word_counts[SPECIAL_TOKENS.index(END_TOKEN)] = num_titles
+    word_counts[SPECIAL_TOKENS.index(UNKNOWN_TOKEN)] = num_tokens - sum(word_counts[len(SPECIAL_TOKENS):])
+    return {
+        'version': vocab_version,
+        'source': json_path,
+        'fingerprint': fingerprint(words),
+        'min_count': min_count,
+        'max_size': max_size,
+        'sketch_capacity': sketch_capacity,
+        # a word missing from a sketched vocabulary that should be in it occurs at most this often
+        'max_undercount': max_undercount,
+        'num_titles': num_titles,
+        'num_tokens': num_tokens,
+        'distinct_words': len(counts) if not sketch_capacity else None,
+        'processes': processes,
+        'seconds': seconds,
+        'words': words,
+        'counts': word_counts,
+    }
+
+def write_vocab(vocab, path=vocab_path_default):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(vocab, f)
+    os.rename(tmp_path, path)
+
+@memory_profile.phased('load vocab')
+def read_vocab(path=vocab_path_default, return_counts=False):
+    # load_vocab's (words_by_id, ids_by_word[, counts]) from a built vocabulary
+    with open(path) as f:
+        vocab = json.load(f)
+    if vocab.get('version') != vocab_version:
+        raise ValueError('{} is a version {} vocabulary, expected version {}; rebuild it with vocab.py'.format(
+            path, vocab.get('version'), vocab_version))
+    words = vocab['words']
+    if words[:len(SPECIAL_TOKENS)] != SPECIAL_TOKENS or fingerprint(words) != vocab['fingerprint']:
+        raise ValueError('{} is corrupt: its words do not match its fingerprint'.format(path))
+    words_by_id = dict(enumerate(words))
+    ids_by_word = {word: i for i, word in enumerate(words)}
+    if return_counts:
+        return words_by_id, ids_by_word, np.array(vocab['counts'], dtype=np.int64)
+    return words_by_id, ids_by_word
+
+def save_for_experiment(path, experiment_dir):
+    # a trained model only works with its own ids, so the vocabulary goes with it
+    shutil.copyfile(path, experiment_dir + experiment_vocab_file)
+
+def load_for_experiment(experiment_dir, json_path, return_counts=False):
+    # the vocabulary saved with a titling experiment, else the one counted from its training split
+    path = experiment_dir + experiment_vocab_file
+    if os.path.exists(path):
+        return read_vocab(path, return_counts)
+    return load_vocab(json_path, return_counts)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='count the words of a split in parallel and write a versioned vocabulary')
+    parser.add_argument('--source', type=str, default=manifest.train_path_default, help='split to count the titles of')
+    parser.add_argument('--output', type=str, default=vocab_path_default, help='vocabulary to write (main_titling.py --vocab)')
+    parser.add_argument('--min_count', type=int, default=min_count_default, help='occurrences a word needs to get an id')
+    parser.add_argument('--max_size', type=int, help='keep at most this many of the most frequent words, special tokens aside')
+    parser.add_argument('--processes', type=int, help='tokenizing processes (default: one per core)')
+    parser.add_argument('--titles_per_shard', type=int, default=titles_per_shard_default, help='titles per pool task')
+    parser.add_argument('--sketch_capacity', type=int, help='bound memory with misra-gries sketches of this many words per shard')
+    parser.add_argument('-r', type=int, help='pyramid level whose quarantined images are skipped (default: the default level)')
+    args = parser.parse_args()
+
+    pyramid.select(args.r)
+    vocab = build_vocab(args.source, args.min_count, args.max_size, args.processes, args.titles_per_shard, args.sketch_capacity)
+    write_vocab(vocab, args.output)
+    print('{} titles, {} tokens in {:.1f}s on {} processes ({:.0f} titles/s)'.format(vocab['num_titles'], vocab['num_tokens'],
+        vocab['seconds'], vocab['processes'], vocab['num_titles'] / max(vocab['seconds'], 1e-9)))
+    if vocab['max_undercount'] is not None:
+        print('sketched counts: words occurring up to {} times may be missing'.format(vocab['max_undercount']))
+    print('wrote {} words to {}'.format(len(vocab['words']), args.output))
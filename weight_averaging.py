@@ -0,0 +1,77 @@
+import time
+
+from keras import backend as K
+from keras.callbacks import Callback
+
+import distributed
+
+# the keras side of distributed.py, imported only by processes that train
+
+class WeightAveraging(Callback):
+    def __init__(self, group, sync_every=distributed.sync_every_default, report_dir=None):
+        super(WeightAveraging, self).__init__()
+        self.group = group
+        self.sync_every = sync_every
+        self.report_dir = report_dir
+        self.unsynced = 0
+        self.images = 0
+        self.sync_seconds = 0.
+        self.syncs = 0
+
+    def sync(self, average=True):
+        start = time.time()
+        weights = self.model.trainable_weights
+        values = K.batch_get_value(weights)
+        if average:
+            vector = self.group.allreduce_mean(distributed.flatten(values))
+        else:
+            vector = self.group.broadcast(distributed.flatten(values) if self.group.rank == 0 else None)
+        K.batch_set_value(zip(weights, distributed.unflatten(vector, values)))
+        self.sync_seconds += time.time() - start
+        self.syncs += 1
+        self.unsynced = 0
+
+    def on_train_begin(self, logs=None):
+        # randomly initialised heads differ per process; start everyone from rank 0
+        self.sync(average=False)
+        self.start = time.time()
+
+    def steps_per_epoch(self):
+        # fit_generator knows its steps, fit its samples and batch size
+        if self.params.get('steps'):
+            return self.params['steps']
+        if self.params.get('samples') and self.params.get('batch_size'):
+            return -(-self.params['samples'] // self.params['batch_size'])
+        return None
+
+    def on_batch_end(self, batch, logs=None):
+        self.unsynced += 1
+        self.images += (logs or {}).get('size', 0)
+        # keras validates before on_epoch_end, so the last batch of an epoch always syncs
+        # and validation sees the averaged weights on every rank
+        if self.unsynced >= self.sync_every or batch + 1 == self.steps_per_epoch():
+            self.sync()
+
+    def on_epoch_end(self, epoch, logs=None):
+        # only when the steps per epoch are unknown
+        if self.unsynced:
+            self.sync()
+
+    def on_train_end(self, logs=None):
+        seconds = time.time() - self.start
+        stats = self.group.gather({'rank': self.group.rank, 'images': self.images, 'seconds': seconds,
+            'sync_seconds': self.sync_seconds, 'syncs': self.syncs})
+        if stats is not None and self.report_dir is not None:
+            distributed.record_scaling(self.report_dir, self.group.world_size, self.sync_every, stats)
+
+class StopBroadcast(Callback):
+    # last in every rank's callbacks: rank 0's stop_training (early stopping, decided by its
+    # chief-only callbacks) goes to every rank at the end of each epoch, so all ranks leave
+    # fit together instead of the others waiting in the next allreduce
+    def __init__(self, group):
+        super(StopBroadcast, self).__init__()
+        self.group = group
+
+    def on_epoch_end(self, epoch, logs=None):
+        stop = self.group.broadcast(bool(self.model.stop_training) if self.group.rank == 0 else None)
+        self.model.stop_training = stop